@@ -204,6 +204,9 @@ def analyze_dump(name, args):
 def _get_events(infile):
     rawdata = None
     events, rawdata = show.load_events_infile(infile)
+    trace = dump.load_trace(rawdata)
+    if trace:
+        return dump.trace_events_to_events(trace)
     if not events:
         events, _ = dump.dump_events(rawdata=rawdata)
     return events
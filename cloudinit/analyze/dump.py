@@ -2,6 +2,7 @@
 
 import calendar
 from datetime import datetime
+import json
 import sys
 
 from cloudinit import util
@@ -157,6 +158,82 @@ def dump_events(cisource=None, rawdata=None):
     return events, data
 
 
+def load_trace(rawdata):
+    """Return the list of Chrome trace events in rawdata, or None.
+
+    Trace files written by the trace reporting handler are json arrays left
+    unterminated, as the trace-event format allows, which are loaded too.
+    """
+    data = rawdata.strip()
+    if not data.startswith(('[', '{')):
+        return None
+    if data.startswith('[') and not data.endswith(']'):
+        data = data.rstrip(',') + ']'
+    try:
+        trace = json.loads(data)
+    except ValueError:
+        return None
+    if isinstance(trace, dict):
+        trace = trace.get('traceEvents')
+    if not isinstance(trace, list) or not trace:
+        return None
+    if not all(isinstance(event, dict) and 'ph' in event for event in trace):
+        return None
+    return trace
+
+
+def _contains(span, other):
+    """Return True when the span of the same boot contains the other span."""
+    return (span.get('args', {}).get('boot_id') ==
+            other.get('args', {}).get('boot_id') and
+            span['ts'] + span.get('dur', 0) > other['ts'])
+
+
+def trace_events_to_events(trace):
+    """Return the start and finish events of the complete events of trace.
+
+    Events are returned in chronological order with those of nested spans
+    between the start and finish events of their parent span, as events
+    parsed from cloud-init.log are. Boots are ordered as they first appear
+    in trace.
+    """
+    boots = {}  # Order of boots by boot id, as monotonic time restarts
+    for event in trace:
+        boots.setdefault(event.get('args', {}).get('boot_id'), len(boots))
+    spans = sorted(
+        (event for event in trace if event.get('ph') == 'X'),
+        key=lambda event: (boots[event.get('args', {}).get('boot_id')],
+                           event['ts'], -event.get('dur', 0)))
+    events = []
+    open_spans = []
+
+    def finish(span):
+        args = span.get('args', {})
+        events.append({
+            'name': span['name'],
+            'description': args.get('description', ''),
+            'origin': span.get('cat', 'cloudinit'),
+            'event_type': 'finish',
+            'result': args.get('result', 'SUCCESS'),
+            'timestamp': (args.get('timestamp', span['ts'] / 1e6) +
+                          span.get('dur', 0) / 1e6)})
+
+    for span in spans:
+        while open_spans and not _contains(open_spans[-1], span):
+            finish(open_spans.pop())
+        args = span.get('args', {})
+        events.append({
+            'name': span['name'],
+            'description': args.get('description', ''),
+            'origin': span.get('cat', 'cloudinit'),
+            'event_type': 'start',
+            'timestamp': args.get('timestamp', span['ts'] / 1e6)})
+        open_spans.append(span)
+    while open_spans:
+        finish(open_spans.pop())
+    return events
+
+
 def main():
     if len(sys.argv) > 1:
         cisource = open(sys.argv[1])
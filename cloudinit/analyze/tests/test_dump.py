@@ -1,10 +1,12 @@
 # This file is part of cloud-init. See LICENSE file for license information.
 
 from datetime import datetime
+import json
 from textwrap import dedent
 
 from cloudinit.analyze.dump import (
-    dump_events, parse_ci_logline, parse_timestamp)
+    dump_events, load_trace, parse_ci_logline, parse_timestamp,
+    trace_events_to_events)
 from cloudinit.util import which, write_file
 from cloudinit.tests.helpers import CiTestCase, mock, skipIf
 
@@ -188,3 +190,74 @@ class TestDumpEvents(CiTestCase):
         self.assertEqual(SAMPLE_LOGS.splitlines(), [d.strip() for d in data])
         m_parse_from_date.assert_has_calls(
             [mock.call("2016-08-30 21:53:25.972325+00:00")])
+
+
+def trace_span(name, ts, dur, boot_id='boot1', timestamp=None):
+    return {'name': name, 'cat': 'cloudinit', 'ph': 'X', 'ts': ts,
+            'dur': dur, 'pid': 1, 'tid': 1,
+            'args': {'boot_id': boot_id, 'description': name + ' desc',
+                     'result': 'SUCCESS',
+                     'timestamp': timestamp or ts / 1e6}}
+
+
+class TestLoadTrace(CiTestCase):
+
+    def test_load_trace_loads_unterminated_array(self):
+        """Trace arrays without closing bracket, as appended, are loaded."""
+        span = trace_span('init-local', 1e6, 2e6)
+        rawdata = '[\n%s,\n' % json.dumps(span)
+        self.assertEqual([span], load_trace(rawdata))
+        self.assertEqual([span], load_trace(rawdata.rstrip(',\n') + ']'))
+
+    def test_load_trace_loads_trace_events_object(self):
+        """The object form of Chrome traces is loaded."""
+        span = trace_span('init-local', 1e6, 2e6)
+        self.assertEqual(
+            [span], load_trace(json.dumps({'traceEvents': [span]})))
+
+    def test_load_trace_returns_none_on_other_data(self):
+        """Logs and dumped cloud-init events are not traces."""
+        self.assertIsNone(load_trace(SAMPLE_LOGS))
+        self.assertIsNone(load_trace(json.dumps(
+            [{'name': 'init-local', 'event_type': 'start'}])))
+        self.assertIsNone(load_trace('[]'))
+
+
+class TestTraceEventsToEvents(CiTestCase):
+
+    def test_nested_spans_become_nested_start_and_finish_events(self):
+        """Events of child spans are between those of their parent span."""
+        trace = [
+            {'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {}},
+            trace_span('init-local/search', 1e6, 0.5e6),
+            trace_span('init-local/check', 1.5e6, 0),
+            trace_span('init-local/write', 1.75e6, 0.25e6),
+            trace_span('init-local', 1e6, 1e6)]
+        events = trace_events_to_events(trace)
+        self.assertEqual(
+            [('start', 'init-local', 1.0),
+             ('start', 'init-local/search', 1.0),
+             ('finish', 'init-local/search', 1.5),
+             ('start', 'init-local/check', 1.5),
+             ('finish', 'init-local/check', 1.5),
+             ('start', 'init-local/write', 1.75),
+             ('finish', 'init-local/write', 2.0),
+             ('finish', 'init-local', 2.0)],
+            [(e['event_type'], e['name'], e['timestamp']) for e in events])
+        self.assertEqual(
+            {'name': 'init-local', 'description': 'init-local desc',
+             'origin': 'cloudinit', 'event_type': 'finish',
+             'result': 'SUCCESS', 'timestamp': 2.0}, events[-1])
+
+    def test_boots_are_ordered_as_they_appear_in_trace(self):
+        """Monotonic times restart each boot, boots keep the trace order."""
+        trace = [
+            trace_span('init-local', 9e6, 1e6, boot_id='boot1',
+                       timestamp=100),
+            trace_span('init-local', 1e6, 1e6, boot_id='boot2',
+                       timestamp=200)]
+        self.assertEqual(
+            [('start', 100), ('finish', 101), ('start', 200),
+             ('finish', 201)],
+            [(e['event_type'], e['timestamp'])
+             for e in trace_events_to_events(trace)])
@@ -5,8 +5,10 @@
 
 import logging
 
+from cloudinit import helpers
 from cloudinit import log
-from cloudinit.stages import Init
+from cloudinit.settings import BASE_CFG_SNAPSHOT
+from cloudinit import util
 
 
 def addLogHandlerCLI(logger, log_level):
@@ -17,9 +19,23 @@ def addLogHandlerCLI(logger, log_level):
 
 
 def read_cfg_paths():
-    """Return a Paths object based on the system configuration on disk."""
-    init = Init(ds_deps=[])
-    init.read_cfg()
-    return init.paths
+    """Return a Paths object based on the system configuration on disk.
+
+    The config is read from a valid base config snapshot when there is one,
+    without importing the boot stages.
+    """
+    base_cfg = helpers.read_base_config_snapshot(BASE_CFG_SNAPSHOT)
+    if base_cfg is None:
+        from cloudinit.stages import Init
+        init = Init(ds_deps=[], base_cfg_snapshot=BASE_CFG_SNAPSHOT)
+        init.read_cfg()
+        return init.paths
+    # Merged like stages.Init reads its config, without a datasource
+    cfg = helpers.ConfigMerger(
+        paths=helpers.Paths({}), base_cfg=base_cfg).cfg
+    path_cfgs = util.get_cfg_by_path(cfg, ('system_info', 'paths'), {})
+    if not isinstance(path_cfgs, dict):
+        path_cfgs = {}
+    return helpers.Paths(path_cfgs)
 
 # vi: ts=4 expandtab
@@ -22,27 +22,15 @@ import traceback
 from cloudinit import patcher
 patcher.patch()  # noqa
 
+from cloudinit import importer
 from cloudinit import log as logging
-from cloudinit import netinfo
-from cloudinit import signal_handler
-from cloudinit import sources
-from cloudinit import stages
-from cloudinit import url_helper
-from cloudinit import util
 from cloudinit import version
-from cloudinit import warnings
-
-from cloudinit import reporting
-from cloudinit.reporting import events
 
 from cloudinit.settings import (PER_INSTANCE, PER_ALWAYS, PER_ONCE,
-                                CLOUD_CONFIG)
+                                BASE_CFG_SNAPSHOT, CLOUD_CONFIG)
 
 from cloudinit import atomic_helper
 
-from cloudinit.config import cc_set_hostname
-from cloudinit import dhclient_hook
-
 
 # Welcome message template
 WELCOME_MSG_TPL = ("Cloud-init v. {version} running '{action}' at "
@@ -51,6 +39,9 @@ WELCOME_MSG_TPL = ("Cloud-init v. {version} running '{action}' at "
 # Module section template
 MOD_SECTION_TPL = "cloud_%s_modules"
 
+# Log of ds-identify under the run dir, reporting the platform facts it read
+DS_IDENTIFY_LOG = "ds-identify.log"
+
 # Frequency shortname to full name
 # (so users don't have to remember the full name...)
 FREQ_SHORT_NAMES = {
@@ -59,6 +50,31 @@ FREQ_SHORT_NAMES = {
     'once': PER_ONCE,
 }
 
+# Subcommands implemented outside of this module. Their modules are only
+# imported when the subcommand is selected so that light-weight subcommands
+# like 'status' and 'query' do not pay the import cost of the boot stages.
+# For the same reason util, url_helper and reporting are only imported by
+# the functions using them.
+# Each entry is (subcommand, help, module, parser function, handler function,
+# action name). Modules which set their own action have no handler function.
+LAZY_SUBCOMMANDS = (
+    ('query', 'Query standardized instance metadata from the command line.',
+     'cloudinit.cmd.query', 'get_parser', 'handle_args', 'render'),
+    ('dhclient-hook', 'Run the dhclient hook to record network info.',
+     'cloudinit.dhclient_hook', 'get_parser', None, None),
+    ('analyze', 'Devel tool: Analyze cloud-init logs and data',
+     'cloudinit.analyze.__main__', 'get_parser', None, None),
+    ('devel', 'Run development tools',
+     'cloudinit.cmd.devel.parser', 'get_parser', None, None),
+    ('collect-logs', 'Collect and tar all cloud-init debug info',
+     'cloudinit.cmd.devel.logs', 'get_parser', 'handle_collect_logs_args',
+     'collect-logs'),
+    ('clean', 'Remove logs and artifacts so cloud-init can re-run.',
+     'cloudinit.cmd.clean', 'get_parser', 'handle_clean_args', 'clean'),
+    ('status', 'Report cloud-init status or wait on completion.',
+     'cloudinit.cmd.status', 'get_parser', 'handle_status_args', 'status'),
+)
+
 LOG = logging.getLogger()
 
 
@@ -75,6 +91,8 @@ def print_exc(msg=''):
 
 
 def welcome(action, msg=None):
+    from cloudinit import util
+
     if not msg:
         msg = welcome_format(action)
     util.multi_log("%s\n" % (msg),
@@ -83,6 +101,8 @@ def welcome(action, msg=None):
 
 
 def welcome_format(action):
+    from cloudinit import util
+
     return WELCOME_MSG_TPL.format(
         version=version.version_string(),
         uptime=util.uptime(),
@@ -120,11 +140,15 @@ def run_module_section(mods, action_name, section):
 
 
 def apply_reporting_cfg(cfg):
+    from cloudinit import reporting
+
     if cfg.get('reporting'):
         reporting.update_configuration(cfg.get('reporting'))
 
 
 def parse_cmdline_url(cmdline, names=('cloud-config-url', 'url')):
+    from cloudinit import util
+
     data = util.keyval_str_to_dict(cmdline)
     for key in names:
         if key in data:
@@ -151,6 +175,8 @@ def attempt_cmdline_url(path, network=True, cmdline=None):
     Return value is a tuple of a logger function (logging.DEBUG)
     and a message indicating what happened.
     """
+    from cloudinit import url_helper
+    from cloudinit import util
 
     if cmdline is None:
         cmdline = util.get_cmdline()
@@ -212,6 +238,11 @@ def attempt_cmdline_url(path, network=True, cmdline=None):
 
 
 def main_init(name, args):
+    from cloudinit import netinfo
+    from cloudinit import sources
+    from cloudinit import stages
+    from cloudinit import util
+
     deps = [sources.DEP_FILESYSTEM, sources.DEP_NETWORK]
     if args.local:
         deps = [sources.DEP_FILESYSTEM]
@@ -238,9 +269,11 @@ def main_init(name, args):
         w_msg = welcome_format(name)
     else:
         w_msg = welcome_format("%s-local" % (name))
-    init = stages.Init(ds_deps=deps, reporter=args.reporter)
+    init = stages.Init(ds_deps=deps, reporter=args.reporter,
+                       base_cfg_snapshot=BASE_CFG_SNAPSHOT)
     # Stage 1
     init.read_cfg(extract_fns(args))
+    _cache_boot_facts(init)
     # Stage 2
     outfmt = None
     errfmt = None
@@ -423,6 +456,9 @@ def main_init(name, args):
 
 
 def di_report_warn(datasource, cfg):
+    from cloudinit import sources
+    from cloudinit import warnings
+
     if 'di_report' not in cfg:
         LOG.debug("no di_report found in config.")
         return
@@ -465,6 +501,10 @@ def di_report_warn(datasource, cfg):
 
 
 def main_modules(action_name, args):
+    from cloudinit import sources
+    from cloudinit import stages
+    from cloudinit import util
+
     name = args.mode
     # Cloud-init 'modules' stages are broken up into the following sub-stages
     # 1. Ensure that the init object fetches its config without errors
@@ -477,9 +517,11 @@ def main_modules(action_name, args):
     # 5. Run the modules for the given stage name
     # 6. Done!
     w_msg = welcome_format("%s:%s" % (action_name, name))
-    init = stages.Init(ds_deps=[], reporter=args.reporter)
+    init = stages.Init(ds_deps=[], reporter=args.reporter,
+                       base_cfg_snapshot=BASE_CFG_SNAPSHOT)
     # Stage 1
     init.read_cfg(extract_fns(args))
+    _cache_boot_facts(init)
     # Stage 2
     try:
         init.fetch(existing="trust")
@@ -517,6 +559,10 @@ def main_modules(action_name, args):
 
 
 def main_single(name, args):
+    from cloudinit import sources
+    from cloudinit import stages
+    from cloudinit import util
+
     # Cloud-init single stage is broken up into the following sub-stages
     # 1. Ensure that the init object fetches its config without errors
     # 2. Attempt to fetch the datasource (warn if it doesn't work)
@@ -527,9 +573,11 @@ def main_single(name, args):
     # 6. Done!
     mod_name = args.name
     w_msg = welcome_format(name)
-    init = stages.Init(ds_deps=[], reporter=args.reporter)
+    init = stages.Init(ds_deps=[], reporter=args.reporter,
+                       base_cfg_snapshot=BASE_CFG_SNAPSHOT)
     # Stage 1
     init.read_cfg(extract_fns(args))
+    _cache_boot_facts(init)
     # Stage 2
     try:
         init.fetch(existing="trust")
@@ -587,6 +635,8 @@ def main_single(name, args):
 
 
 def status_wrapper(name, args, data_d=None, link_d=None):
+    from cloudinit import util
+
     if data_d is None:
         data_d = os.path.normpath("/var/lib/cloud/data")
     if link_d is None:
@@ -686,8 +736,22 @@ def status_wrapper(name, args, data_d=None, link_d=None):
     return len(v1[mode]['errors'])
 
 
+def _cache_boot_facts(init):
+    """Look platform facts and block devices up once for this stage.
+
+    Platform facts are seeded by what ds-identify reported.
+    """
+    from cloudinit import util
+
+    util.cache_platform_facts(
+        seed_file=os.path.join(init.paths.run_dir, DS_IDENTIFY_LOG))
+    util.cache_block_devices()
+
+
 def _maybe_persist_instance_data(init):
     """Write instance-data.json file if absent and datasource is restored."""
+    from cloudinit import sources
+
     if init.ds_restored:
         instance_data_file = os.path.join(
             init.paths.run_dir, sources.INSTANCE_JSON_FILE)
@@ -701,6 +765,9 @@ def _maybe_set_hostname(init, stage, retry_stage):
     @param stage: String representing current stage in which we are running.
     @param retry_stage: String represented logs upon error setting hostname.
     """
+    from cloudinit.config import cc_set_hostname
+    from cloudinit import util
+
     cloud = init.cloudify()
     (hostname, _fqdn) = util.get_hostname_fqdn(
         init.cfg, cloud, metadata_only=True)
@@ -717,6 +784,17 @@ def main_features(name, args):
     sys.stdout.write('\n'.join(sorted(version.FEATURES)) + '\n')
 
 
+def _find_subcommand(sysv_args):
+    """Return the subcommand in sysv_args, skipping top level options."""
+    args = iter(sysv_args)
+    for arg in args:
+        if arg in ('--file', '-f'):
+            next(args, None)  # Skip the option's value
+        elif not arg.startswith('-'):
+            return arg
+    return None
+
+
 def main(sysv_args=None):
     if not sysv_args:
         sysv_args = sys.argv
@@ -786,67 +864,22 @@ def main(sysv_args=None):
                                      ' pass to this module'))
     parser_single.set_defaults(action=('single', main_single))
 
-    parser_query = subparsers.add_parser(
-        'query',
-        help='Query standardized instance metadata from the command line.')
-
-    parser_dhclient = subparsers.add_parser(
-        dhclient_hook.NAME, help=dhclient_hook.__doc__)
-    dhclient_hook.get_parser(parser_dhclient)
-
     parser_features = subparsers.add_parser('features',
                                             help=('list defined features'))
     parser_features.set_defaults(action=('features', main_features))
 
-    parser_analyze = subparsers.add_parser(
-        'analyze', help='Devel tool: Analyze cloud-init logs and data')
-
-    parser_devel = subparsers.add_parser(
-        'devel', help='Run development tools')
-
-    parser_collect_logs = subparsers.add_parser(
-        'collect-logs', help='Collect and tar all cloud-init debug info')
-
-    parser_clean = subparsers.add_parser(
-        'clean', help='Remove logs and artifacts so cloud-init can re-run.')
-
-    parser_status = subparsers.add_parser(
-        'status', help='Report cloud-init status or wait on completion.')
-
-    if sysv_args:
-        # Only load subparsers if subcommand is specified to avoid load cost
-        if sysv_args[0] == 'analyze':
-            from cloudinit.analyze.__main__ import get_parser as analyze_parser
-            # Construct analyze subcommand parser
-            analyze_parser(parser_analyze)
-        elif sysv_args[0] == 'devel':
-            from cloudinit.cmd.devel.parser import get_parser as devel_parser
-            # Construct devel subcommand parser
-            devel_parser(parser_devel)
-        elif sysv_args[0] == 'collect-logs':
-            from cloudinit.cmd.devel.logs import (
-                get_parser as logs_parser, handle_collect_logs_args)
-            logs_parser(parser_collect_logs)
-            parser_collect_logs.set_defaults(
-                action=('collect-logs', handle_collect_logs_args))
-        elif sysv_args[0] == 'clean':
-            from cloudinit.cmd.clean import (
-                get_parser as clean_parser, handle_clean_args)
-            clean_parser(parser_clean)
-            parser_clean.set_defaults(
-                action=('clean', handle_clean_args))
-        elif sysv_args[0] == 'query':
-            from cloudinit.cmd.query import (
-                get_parser as query_parser, handle_args as handle_query_args)
-            query_parser(parser_query)
-            parser_query.set_defaults(
-                action=('render', handle_query_args))
-        elif sysv_args[0] == 'status':
-            from cloudinit.cmd.status import (
-                get_parser as status_parser, handle_status_args)
-            status_parser(parser_status)
-            parser_status.set_defaults(
-                action=('status', handle_status_args))
+    requested = _find_subcommand(sysv_args)
+    for (subcmd, subcmd_help, modname, parser_fn, handler_fn,
+         action_name) in LAZY_SUBCOMMANDS:
+        subparser = subparsers.add_parser(subcmd, help=subcmd_help)
+        if requested == subcmd:
+            # Only load subparsers if subcommand is specified to avoid load
+            # cost
+            mod = importer.import_module(modname)
+            getattr(mod, parser_fn)(subparser)
+            if handler_fn:
+                subparser.set_defaults(
+                    action=(action_name, getattr(mod, handler_fn)))
 
     args = parser.parse_args(args=sysv_args)
 
@@ -859,6 +892,8 @@ def main(sysv_args=None):
         logging.setupBasicLogging()
 
     # Setup signal handlers before running
+    from cloudinit import signal_handler
+    from cloudinit import util
     signal_handler.attach_handlers()
 
     if name in ("modules", "init"):
@@ -879,20 +914,25 @@ def main(sysv_args=None):
         rname, rdesc = ("single/%s" % args.name,
                         "running single module %s" % args.name)
         report_on = args.report
-    else:
-        rname = name
-        rdesc = "running 'cloud-init %s'" % name
-        report_on = False
 
+    log_time_kwargs = {
+        'logfunc': LOG.debug, 'msg': "cloud-init mode '%s'" % name,
+        'get_uptime': True, 'func': functor, 'args': (name, args)}
+    if rname is None:
+        # Other subcommands never report events, so reporting and its
+        # handlers are not imported for them.
+        return util.log_time(**log_time_kwargs)
+
+    from cloudinit import reporting
+    from cloudinit.reporting import events
     args.reporter = events.ReportEventStack(
         rname, rdesc, reporting_enabled=report_on)
 
     with args.reporter:
-        retval = util.log_time(
-            logfunc=LOG.debug, msg="cloud-init mode '%s'" % name,
-            get_uptime=True, func=functor, args=(name, args))
-        reporting.flush_events()
-        return retval
+        retval = util.log_time(**log_time_kwargs)
+    # Flush once the stack reported finishing, so that event is not lost.
+    reporting.flush_events()
+    return retval
 
 
 if __name__ == '__main__':
@@ -13,12 +13,16 @@ from cloudinit.handlers.jinja_template import (
 from cloudinit.cmd.devel import addLogHandlerCLI, read_cfg_paths
 from cloudinit import log
 from cloudinit.sources import (
-    INSTANCE_JSON_FILE, INSTANCE_JSON_SENSITIVE_FILE, REDACT_SENSITIVE_VALUE)
+    INSTANCE_JSON_FILE, INSTANCE_JSON_SENSITIVE_FILE, REDACT_SENSITIVE_VALUE,
+    instance_data_index_path)
 from cloudinit import util
 
 NAME = 'query'
 LOG = log.getLogger(NAME)
 
+# Top-level query keys which are not read from instance-data.
+USER_DATA_KEYS = ('userdata', 'vendordata')
+
 
 def get_parser(parser=None):
     """Build or extend an arg parser for query utility.
@@ -66,6 +70,50 @@ def get_parser(parser=None):
     return parser
 
 
+def read_indexed_value(instance_data_fn, varname):
+    """Read a single value of instance_data_fn through its index.
+
+    @param instance_data_fn: Path to the instance-data.json file to query.
+    @param varname: The dot-delimited query varname of the value.
+
+    @return: Tuple of (found, value). found is False when there is no usable
+        index, the index is stale or it does not have varname.
+    """
+    index_fn = instance_data_index_path(instance_data_fn)
+    try:
+        index = util.load_json(util.load_file(index_fn, decode=False))
+        stat = os.stat(instance_data_fn)
+    except (IOError, OSError, TypeError, ValueError):
+        return (False, None)
+    if (index.get('size'), index.get('mtime')) != (
+            stat.st_size, stat.st_mtime):
+        LOG.debug('Ignoring stale instance-data index %s', index_fn)
+        return (False, None)
+    offsets = index.get('keys', {}).get(varname)
+    if not offsets:
+        return (False, None)
+    (start, end) = offsets
+    try:
+        with open(instance_data_fn, 'rb') as stream:
+            stream.seek(start)
+            blob = stream.read(end - start)
+        value = util.load_json(blob, root_types=(object,))
+    except (IOError, OSError, ValueError):
+        return (False, None)
+    if isinstance(value, dict):
+        value = convert_jinja_instance_data(value)
+    return (True, value)
+
+
+def _needs_user_data(args, key):
+    """Return True when the query of args may reference top-level key."""
+    if args.format:
+        return key in args.format
+    if args.varname:
+        return args.varname.split('.')[0] == key
+    return not args.list_keys
+
+
 def handle_args(name, args):
     """Handle calls to 'cloud-init query' as a subcommand."""
     paths = None
@@ -105,6 +153,13 @@ def handle_args(name, args):
     else:
         vendor_data_fn = os.path.join(paths.instance_link, 'vendor-data.txt')
 
+    if (args.varname and not args.format and
+            args.varname.split('.')[0] not in USER_DATA_KEYS):
+        # Read just the queried value when instance-data is indexed.
+        (found, response) = read_indexed_value(instance_data_fn, args.varname)
+        if found:
+            return _print_response(args, response)
+
     try:
         instance_json = util.load_file(instance_data_fn)
     except (IOError, OSError) as e:
@@ -115,14 +170,16 @@ def handle_args(name, args):
         return 1
 
     instance_data = util.load_json(instance_json)
-    if uid != 0:
-        instance_data['userdata'] = (
-            '<%s> file:%s' % (REDACT_SENSITIVE_VALUE, user_data_fn))
-        instance_data['vendordata'] = (
-            '<%s> file:%s' % (REDACT_SENSITIVE_VALUE, vendor_data_fn))
-    else:
-        instance_data['userdata'] = util.load_file(user_data_fn)
-        instance_data['vendordata'] = util.load_file(vendor_data_fn)
+    for (key, data_fn) in (('userdata', user_data_fn),
+                           ('vendordata', vendor_data_fn)):
+        if uid != 0:
+            instance_data[key] = (
+                '<%s> file:%s' % (REDACT_SENSITIVE_VALUE, data_fn))
+        elif _needs_user_data(args, key):
+            instance_data[key] = util.load_file(data_fn)
+        else:
+            # Not referenced by this query, avoid reading a large file.
+            instance_data[key] = None
     if args.format:
         payload = '## template: jinja\n{fmt}'.format(fmt=args.format)
         rendered_payload = render_jinja_payload(
@@ -142,13 +199,20 @@ def handle_args(name, args):
         except KeyError:
             LOG.error('Undefined instance-data key %s', args.varname)
             return 1
+    elif args.list_keys:
+        response = '\n'.join(sorted(response.keys()))
+    return _print_response(args, response)
+
+
+def _print_response(args, response):
+    """Print the response to a varname query, listing its keys if asked."""
+    if args.varname:
         if args.list_keys:
             if not isinstance(response, dict):
-                LOG.error("--list-keys provided but '%s' is not a dict", var)
+                LOG.error("--list-keys provided but '%s' is not a dict",
+                          args.varname.split('.')[-1])
                 return 1
             response = '\n'.join(sorted(response.keys()))
-    elif args.list_keys:
-        response = '\n'.join(sorted(response.keys()))
     if not isinstance(response, six.string_types):
         response = util.json_dumps(response)
     print(response)
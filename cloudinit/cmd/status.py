@@ -5,13 +5,18 @@
 """Define 'status' utility and handler as part of cloud-init commandline."""
 
 import argparse
+import ctypes
+import ctypes.util
+import errno
+import json
 import os
+import select
+import struct
 import sys
-from time import gmtime, strftime, sleep
+from time import gmtime, strftime, sleep, time as now
 
-from cloudinit.distros import uses_systemd
-from cloudinit.stages import Init
-from cloudinit.util import get_cmdline, load_file, load_json
+from cloudinit.cmd.devel import read_cfg_paths
+from cloudinit.util import get_cmdline, load_file, load_json, uses_systemd
 
 CLOUDINIT_DISABLED_FILE = '/etc/cloud/cloud-init.disabled'
 
@@ -22,6 +27,32 @@ STATUS_DONE = 'done'
 STATUS_ERROR = 'error'
 STATUS_DISABLED = 'disabled'
 
+# Seconds between status checks when waiting without inotify
+STATUS_POLL_INTERVAL = 0.25
+# Most seconds to wait on inotify before checking status regardless
+STATUS_RECHECK_INTERVAL = 10
+
+# Status of cloud-init is derived from these files in run_dir
+STATUS_FILES = ('status.json', 'result.json', 'enabled')
+
+# inotify(7) constants
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+INOTIFY_EVENT_FMT = 'iIII'
+INOTIFY_EVENT_SIZE = struct.calcsize(INOTIFY_EVENT_FMT)
+STATUS_WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE)
+
 
 def get_parser(parser=None):
     """Build or extend an arg parser for status utility.
@@ -43,23 +74,23 @@ def get_parser(parser=None):
     parser.add_argument(
         '-w', '--wait', action='store_true', default=False,
         help='Block waiting on cloud-init to complete')
+    parser.add_argument(
+        '-e', '--events', action='store_true', default=False,
+        help=('Block waiting on cloud-init to complete, printing a JSON'
+              ' object per line for each status or stage transition'))
     return parser
 
 
 def handle_status_args(name, args):
     """Handle calls to 'cloud-init status' as a subcommand."""
-    # Read configured paths
-    init = Init(ds_deps=[])
-    init.read_cfg()
-
-    status, status_detail, time = _get_status_details(init.paths)
-    if args.wait:
-        while status in (STATUS_ENABLED_NOT_RUN, STATUS_RUNNING):
-            sys.stdout.write('.')
-            sys.stdout.flush()
-            status, status_detail, time = _get_status_details(init.paths)
-            sleep(0.25)
-        sys.stdout.write('\n')
+    paths = read_cfg_paths()
+
+    if args.wait or args.events:
+        status, status_detail, time = _wait_on_status(paths, args.events)
+        if args.events:
+            return 1 if status == STATUS_ERROR else 0
+    else:
+        status, status_detail, time = _get_status_details(paths)
     if args.long:
         print('status: {0}'.format(status))
         if time:
@@ -70,6 +101,157 @@ def handle_status_args(name, args):
     return 1 if status == STATUS_ERROR else 0
 
 
+def _wait_on_status(paths, events=False):
+    """Block until cloud-init is neither waiting to run nor running.
+
+    Status is checked again whenever inotify reports a change to the files it
+    is derived from, or every STATUS_POLL_INTERVAL seconds when inotify is not
+    available.
+
+    @param paths: An initialized cloudinit.helpers.paths object.
+    @param events: When True, print a JSON object per line for each status or
+        stage transition, instead of progress dots.
+    @returns: The final 3-tuple of status, status_details and time.
+    """
+    try:
+        watcher = _StatusWatcher(paths, CLOUDINIT_DISABLED_FILE)
+    except (AttributeError, OSError):
+        watcher = None  # No inotify on this platform, poll instead
+    last_event = None
+    try:
+        while True:
+            if watcher:
+                # Watch before reading status so no change is missed.
+                watcher.watch()
+            (status, stage, status_detail, latest_event) = _read_status(
+                paths)
+            if events:
+                event = {'status': status, 'stage': stage,
+                         'detail': status_detail,
+                         'last_update': latest_event or None}
+                if event != last_event:
+                    last_event = event
+                    sys.stdout.write(json.dumps(event, sort_keys=True) + '\n')
+                    sys.stdout.flush()
+            if status not in (STATUS_ENABLED_NOT_RUN, STATUS_RUNNING):
+                break
+            if not events:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+            if watcher:
+                watcher.wait(STATUS_RECHECK_INTERVAL)
+            else:
+                sleep(STATUS_POLL_INTERVAL)
+    finally:
+        if watcher:
+            watcher.close()
+    if not events:
+        sys.stdout.write('\n')
+    return status, status_detail, _format_time(latest_event)
+
+
+class _StatusWatcher(object):
+    """Wait on inotify for changes to the files status is derived from.
+
+    status.json and result.json in run_dir are symlinks to files which are
+    replaced on each update, so the directories of their targets are watched
+    along with run_dir, its parent and the directory of the disable file.
+    """
+
+    def __init__(self, paths, disable_file):
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._paths = paths
+        self._disable_file = disable_file
+        self._watches = {}  # Watched directory by watch descriptor
+        self._names = {}  # Set of relevant file names by watched directory
+
+    def _watched_names(self):
+        """Return a dict of the file names to watch keyed by directory."""
+        run_dir = os.path.normpath(self._paths.run_dir)
+        names = {
+            run_dir: set(STATUS_FILES),
+            os.path.dirname(run_dir): set([os.path.basename(run_dir)]),
+            os.path.dirname(self._disable_file): set(
+                [os.path.basename(self._disable_file)])}
+        for fname in STATUS_FILES:
+            path = os.path.join(run_dir, fname)
+            if os.path.islink(path):
+                target = os.path.realpath(path)
+                names.setdefault(os.path.dirname(target), set()).add(
+                    os.path.basename(target))
+        return names
+
+    def watch(self):
+        """Watch the directories of status files which exist now."""
+        self._names = self._watched_names()
+        watched = set(self._watches.values())
+        for path in self._names:
+            if path in watched:
+                continue
+            wd = self._libc.inotify_add_watch(
+                self._fd, path.encode('utf-8'), STATUS_WATCH_MASK)
+            if wd >= 0:
+                self._watches[wd] = path
+
+    def wait(self, timeout):
+        """Block until a status file changed or timeout seconds passed."""
+        if not self._watches:
+            # Nothing to watch yet, not even the parent of run_dir.
+            sleep(STATUS_POLL_INTERVAL)
+            return
+        deadline = now() + timeout
+        while True:
+            remaining = deadline - now()
+            if remaining <= 0:
+                return
+            try:
+                (ready, _, _) = select.select([self._fd], [], [], remaining)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                return
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if self._is_status_change(data):
+                return
+
+    def _is_status_change(self, data):
+        """Return True when inotify event data affects a status file."""
+        offset = 0
+        changed = False
+        while offset + INOTIFY_EVENT_SIZE <= len(data):
+            (wd, mask, _cookie, length) = struct.unpack_from(
+                INOTIFY_EVENT_FMT, data, offset)
+            offset += INOTIFY_EVENT_SIZE
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                changed = True
+            elif mask & IN_IGNORED:
+                # The watched directory is gone, watch it again once back.
+                self._watches.pop(wd, None)
+                changed = True
+            elif wd in self._watches:
+                names = self._names.get(self._watches[wd], ())
+                if name.decode('utf-8', 'replace') in names:
+                    changed = True
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
 def _is_cloudinit_disabled(disable_file, paths):
     """Report whether cloud-init is disabled.
 
@@ -105,7 +287,27 @@ def _get_status_details(paths):
 
     Values are obtained from parsing paths.run_dir/status.json.
     """
+    status, _stage, status_detail, latest_event = _read_status(paths)
+    return status, status_detail, _format_time(latest_event)
+
+
+def _format_time(timestamp):
+    """Return a formatted UTC time of timestamp or '' when it is unset."""
+    if timestamp:
+        return strftime('%a, %d %b %Y %H:%M:%S %z', gmtime(timestamp))
+    return ''
+
+
+def _read_status(paths):
+    """Return a 4-tuple of status, stage, status_details and last event time.
+
+    @param paths: An initialized cloudinit.helpers.paths object.
+
+    The stage is None unless a stage is running. The time of the last event
+    is a timestamp, 0 when no stage started yet.
+    """
     status = STATUS_ENABLED_NOT_RUN
+    stage = None
     status_detail = ''
     status_v1 = {}
 
@@ -126,6 +328,7 @@ def _get_status_details(paths):
     for key, value in sorted(status_v1.items()):
         if key == 'stage':
             if value:
+                stage = value
                 status = STATUS_RUNNING
                 status_detail = 'Running in stage: {0}'.format(value)
         elif key == 'datasource':
@@ -144,11 +347,7 @@ def _get_status_details(paths):
         status_detail = '\n'.join(errors)
     elif status == STATUS_ENABLED_NOT_RUN and latest_event > 0:
         status = STATUS_DONE
-    if latest_event:
-        time = strftime('%a, %d %b %Y %H:%M:%S %z', gmtime(latest_event))
-    else:
-        time = ''
-    return status, status_detail, time
+    return status, stage, status_detail, latest_event
 
 
 def main():
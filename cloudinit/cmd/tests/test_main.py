@@ -58,7 +58,7 @@ class TestMain(FilesystemMockingTestCase):
             debug=False, files=None, force=False, local=False, reporter=None,
             subcommand='init')
         (_item1, item2) = wrap_and_call(
-            'cloudinit.cmd.main',
+            'cloudinit',
             {'util.close_stdin': True,
              'netinfo.debug_info': 'my net debug info',
              'util.fixup_output': ('outfmt', 'errfmt')},
@@ -87,7 +87,7 @@ class TestMain(FilesystemMockingTestCase):
             debug=False, files=None, force=False, local=False, reporter=None,
             subcommand='init')
         (_item1, item2) = wrap_and_call(
-            'cloudinit.cmd.main',
+            'cloudinit',
             {'util.close_stdin': True,
              'netinfo.debug_info': 'my net debug info',
              'util.fixup_output': ('outfmt', 'errfmt')},
@@ -137,10 +137,10 @@ class TestMain(FilesystemMockingTestCase):
             self.assertIsNone(args)
 
         (_item1, item2) = wrap_and_call(
-            'cloudinit.cmd.main',
+            'cloudinit',
             {'util.close_stdin': True,
              'netinfo.debug_info': 'my net debug info',
-             'cc_set_hostname.handle': {'side_effect': set_hostname},
+             'config.cc_set_hostname.handle': {'side_effect': set_hostname},
              'util.fixup_output': ('outfmt', 'errfmt')},
             main.main_init, 'init', cmdargs)
         self.assertEqual([], item2)
@@ -9,7 +9,8 @@ from collections import namedtuple
 from cloudinit.cmd import query
 from cloudinit.helpers import Paths
 from cloudinit.sources import (
-    REDACT_SENSITIVE_VALUE, INSTANCE_JSON_FILE, INSTANCE_JSON_SENSITIVE_FILE)
+    REDACT_SENSITIVE_VALUE, INSTANCE_JSON_FILE, INSTANCE_JSON_SENSITIVE_FILE,
+    _serialize_instance_data, write_instance_data_index)
 from cloudinit.tests.helpers import CiTestCase, mock
 from cloudinit.util import ensure_dir, write_file
 
@@ -28,6 +29,13 @@ class TestQuery(CiTestCase):
         self.tmp = self.tmp_dir()
         self.instance_data = self.tmp_path('instance-data', dir=self.tmp)
 
+    def write_indexed_instance_data(self, instance_data):
+        """Write instance_data and its index as persist_instance_data does."""
+        (content, offsets, _redacted, _offsets) = _serialize_instance_data(
+            instance_data)
+        write_file(self.instance_data, content, omode='w')
+        write_instance_data_index(self.instance_data, offsets)
+
     def test_handle_args_error_on_missing_param(self):
         """Error when missing required parameters and print usage."""
         args = self.args(
@@ -270,4 +278,87 @@ class TestQuery(CiTestCase):
         self.assertEqual('', m_stdout.getvalue())
         self.assertIn(expected_error, m_stderr.getvalue())
 
+    def test_handle_args_reads_varname_through_index(self):
+        """A varname is read through the index without loading all data."""
+        self.write_indexed_instance_data(
+            {'v1': {'key-2': 'value-2'}, 'ds': {'meta-data': {'a-b': 1}}})
+        args = self.args(
+            debug=False, dump_all=False, format=None,
+            instance_data=self.instance_data, list_keys=False,
+            user_data='ud', vendor_data='vd', varname=None)
+        for (varname, expected) in (
+                ('v1.key_2', 'value-2\n'), ('key_2', 'value-2\n'),
+                ('ds', '{\n "meta_data": {\n  "a_b": 1\n }\n}\n')):
+            args = args._replace(varname=varname)
+            with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
+                with mock.patch('os.getuid') as m_getuid:
+                    m_getuid.return_value = 100
+                    with mock.patch.object(
+                            query, 'convert_jinja_instance_data',
+                            wraps=query.convert_jinja_instance_data) as m_cv:
+                        self.assertEqual(
+                            0, query.handle_args('anyname', args))
+            self.assertEqual(expected, m_stdout.getvalue())
+            for call in m_cv.call_args_list:
+                self.assertNotIn('v1', call[0][0])
+
+    def test_handle_args_list_keys_through_index(self):
+        """--list-keys of a varname is answered through the index."""
+        self.write_indexed_instance_data({'v1': {'b': 1, 'a': {'c': 2}}})
+        args = self.args(
+            debug=False, dump_all=False, format=None,
+            instance_data=self.instance_data, list_keys=True,
+            user_data='ud', vendor_data='vd', varname='v1')
+        with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
+            with mock.patch('os.getuid') as m_getuid:
+                m_getuid.return_value = 100
+                self.assertEqual(0, query.handle_args('anyname', args))
+        self.assertEqual('a\nb\n', m_stdout.getvalue())
+
+    def test_handle_args_ignores_stale_index(self):
+        """An index of a since rewritten instance-data file is not used."""
+        self.write_indexed_instance_data({'my-var': 'indexed'})
+        write_file(self.instance_data, '{"my-var": "rewritten value"}')
+        args = self.args(
+            debug=False, dump_all=False, format=None,
+            instance_data=self.instance_data, list_keys=False,
+            user_data='ud', vendor_data='vd', varname='my_var')
+        with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
+            with mock.patch('os.getuid') as m_getuid:
+                m_getuid.return_value = 100
+                self.assertEqual(0, query.handle_args('anyname', args))
+        self.assertEqual('rewritten value\n', m_stdout.getvalue())
+
+    def test_handle_args_undefined_varname_falls_back_to_instance_data(self):
+        """Varnames missing from the index report undefined keys as before."""
+        self.write_indexed_instance_data({'my-var': 'it worked'})
+        args = self.args(
+            debug=False, dump_all=False, format=None,
+            instance_data=self.instance_data, list_keys=False,
+            user_data='ud', vendor_data='vd', varname='absent')
+        with mock.patch('sys.stderr', new_callable=StringIO) as m_stderr:
+            with mock.patch('os.getuid') as m_getuid:
+                m_getuid.return_value = 100
+                self.assertEqual(1, query.handle_args('anyname', args))
+        self.assertIn(
+            'ERROR: Undefined instance-data key absent', m_stderr.getvalue())
+
+    def test_handle_args_root_reads_only_queried_user_data(self):
+        """Root does not read user-data or vendor-data unless queried."""
+        write_file(self.instance_data, '{"my-var": "it worked"}')
+        vendor_data = self.tmp_path('vendor-data', dir=self.tmp)
+        write_file(vendor_data, 'vd')
+        absent_fn = self.tmp_path('absent', dir=self.tmp)
+        args = self.args(
+            debug=False, dump_all=False, format=None,
+            instance_data=self.instance_data, list_keys=False,
+            user_data=absent_fn, vendor_data=vendor_data, varname='my_var')
+        with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
+            with mock.patch('os.getuid') as m_getuid:
+                m_getuid.return_value = 0
+                self.assertEqual(0, query.handle_args('anyname', args))
+                args = args._replace(varname='vendordata')
+                self.assertEqual(0, query.handle_args('anyname', args))
+        self.assertEqual('it worked\nvd\n', m_stdout.getvalue())
+
 # vi: ts=4 expandtab
@@ -1,17 +1,19 @@
 # This file is part of cloud-init. See LICENSE file for license information.
 
 from collections import namedtuple
+import json
 import os
 from six import StringIO
 from textwrap import dedent
+import time
 
 from cloudinit.atomic_helper import write_json
 from cloudinit.cmd import status
-from cloudinit.util import ensure_file
-from cloudinit.tests.helpers import CiTestCase, wrap_and_call, mock
+from cloudinit.util import ensure_dir, ensure_file
+from cloudinit.tests.helpers import CiTestCase, skipIf, wrap_and_call, mock
 
 mypaths = namedtuple('MyPaths', 'run_dir')
-myargs = namedtuple('MyArgs', 'long wait')
+myargs = namedtuple('MyArgs', 'long wait events')
 
 
 class TestStatus(CiTestCase):
@@ -23,17 +25,6 @@ class TestStatus(CiTestCase):
         self.disable_file = self.tmp_path('cloudinit-disable', self.new_root)
         self.paths = mypaths(run_dir=self.new_root)
 
-        class FakeInit(object):
-            paths = self.paths
-
-            def __init__(self, ds_deps):
-                pass
-
-            def read_cfg(self):
-                pass
-
-        self.init_class = FakeInit
-
     def test__is_cloudinit_disabled_false_on_sysvinit(self):
         '''When not in an environment using systemd, return False.'''
         ensure_file(self.disable_file)  # Create the ignored disable file
@@ -112,12 +103,12 @@ class TestStatus(CiTestCase):
         '''When status.json does not exist yet, return 'not run'.'''
         self.assertFalse(
             os.path.exists(self.status_file), 'Unexpected status.json found')
-        cmdargs = myargs(long=False, wait=False)
+        cmdargs = myargs(long=False, wait=False, events=False)
         with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
             retcode = wrap_and_call(
                 'cloudinit.cmd.status',
                 {'_is_cloudinit_disabled': (False, ''),
-                 'Init': {'side_effect': self.init_class}},
+                 'read_cfg_paths': {'return_value': self.paths}},
                 status.handle_status_args, 'ignored', cmdargs)
         self.assertEqual(0, retcode)
         self.assertEqual('status: not run\n', m_stdout.getvalue())
@@ -132,13 +123,13 @@ class TestStatus(CiTestCase):
             status_file = os.path.join(self.paths.run_dir, 'status.json')
             return bool(not filepath == status_file)
 
-        cmdargs = myargs(long=True, wait=False)
+        cmdargs = myargs(long=True, wait=False, events=False)
         with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
             retcode = wrap_and_call(
                 'cloudinit.cmd.status',
                 {'os.path.exists': {'side_effect': fakeexists},
                  '_is_cloudinit_disabled': (True, 'disabled for some reason'),
-                 'Init': {'side_effect': self.init_class}},
+                 'read_cfg_paths': {'return_value': self.paths}},
                 status.handle_status_args, 'ignored', cmdargs)
         self.assertEqual(0, retcode)
         self.assertEqual(
@@ -157,12 +148,12 @@ class TestStatus(CiTestCase):
         write_json(self.status_file, {})
         self.assertFalse(
             os.path.exists(result_file), 'Unexpected result.json found')
-        cmdargs = myargs(long=False, wait=False)
+        cmdargs = myargs(long=False, wait=False, events=False)
         with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
             retcode = wrap_and_call(
                 'cloudinit.cmd.status',
                 {'_is_cloudinit_disabled': (False, ''),
-                 'Init': {'side_effect': self.init_class}},
+                 'read_cfg_paths': {'return_value': self.paths}},
                 status.handle_status_args, 'ignored', cmdargs)
         self.assertEqual(0, retcode)
         self.assertEqual('status: running\n', m_stdout.getvalue())
@@ -172,12 +163,12 @@ class TestStatus(CiTestCase):
         ensure_file(self.tmp_path('result.json', self.new_root))
         write_json(self.status_file,
                    {'v1': {'init': {'start': 1, 'finished': None}}})
-        cmdargs = myargs(long=False, wait=False)
+        cmdargs = myargs(long=False, wait=False, events=False)
         with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
             retcode = wrap_and_call(
                 'cloudinit.cmd.status',
                 {'_is_cloudinit_disabled': (False, ''),
-                 'Init': {'side_effect': self.init_class}},
+                 'read_cfg_paths': {'return_value': self.paths}},
                 status.handle_status_args, 'ignored', cmdargs)
         self.assertEqual(0, retcode)
         self.assertEqual('status: running\n', m_stdout.getvalue())
@@ -195,12 +186,12 @@ class TestStatus(CiTestCase):
                     'init': {'errors': [], 'start': 124.567,
                              'finished': 125.678},
                     'init-local': {'start': 123.45, 'finished': 123.46}}})
-        cmdargs = myargs(long=False, wait=False)
+        cmdargs = myargs(long=False, wait=False, events=False)
         with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
             retcode = wrap_and_call(
                 'cloudinit.cmd.status',
                 {'_is_cloudinit_disabled': (False, ''),
-                 'Init': {'side_effect': self.init_class}},
+                 'read_cfg_paths': {'return_value': self.paths}},
                 status.handle_status_args, 'ignored', cmdargs)
         self.assertEqual(0, retcode)
         self.assertEqual('status: done\n', m_stdout.getvalue())
@@ -216,12 +207,12 @@ class TestStatus(CiTestCase):
                         '[dsmode=net]'),
                     'init': {'start': 124.567, 'finished': 125.678},
                     'init-local': {'start': 123.45, 'finished': 123.46}}})
-        cmdargs = myargs(long=True, wait=False)
+        cmdargs = myargs(long=True, wait=False, events=False)
         with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
             retcode = wrap_and_call(
                 'cloudinit.cmd.status',
                 {'_is_cloudinit_disabled': (False, ''),
-                 'Init': {'side_effect': self.init_class}},
+                 'read_cfg_paths': {'return_value': self.paths}},
                 status.handle_status_args, 'ignored', cmdargs)
         self.assertEqual(0, retcode)
         expected = dedent('''\
@@ -241,12 +232,12 @@ class TestStatus(CiTestCase):
                     'init': {'errors': ['error1'], 'start': 124.567,
                              'finished': 125.678},
                     'init-local': {'start': 123.45, 'finished': 123.46}}})
-        cmdargs = myargs(long=False, wait=False)
+        cmdargs = myargs(long=False, wait=False, events=False)
         with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
             retcode = wrap_and_call(
                 'cloudinit.cmd.status',
                 {'_is_cloudinit_disabled': (False, ''),
-                 'Init': {'side_effect': self.init_class}},
+                 'read_cfg_paths': {'return_value': self.paths}},
                 status.handle_status_args, 'ignored', cmdargs)
         self.assertEqual(1, retcode)
         self.assertEqual('status: error\n', m_stdout.getvalue())
@@ -263,12 +254,12 @@ class TestStatus(CiTestCase):
                              'finished': 125.678},
                     'init-local': {'errors': ['error2', 'error3'],
                                    'start': 123.45, 'finished': 123.46}}})
-        cmdargs = myargs(long=True, wait=False)
+        cmdargs = myargs(long=True, wait=False, events=False)
         with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
             retcode = wrap_and_call(
                 'cloudinit.cmd.status',
                 {'_is_cloudinit_disabled': (False, ''),
-                 'Init': {'side_effect': self.init_class}},
+                 'read_cfg_paths': {'return_value': self.paths}},
                 status.handle_status_args, 'ignored', cmdargs)
         self.assertEqual(1, retcode)
         expected = dedent('''\
@@ -288,12 +279,12 @@ class TestStatus(CiTestCase):
             {'v1': {'stage': 'init',
                     'init': {'start': 124.456, 'finished': None},
                     'init-local': {'start': 123.45, 'finished': 123.46}}})
-        cmdargs = myargs(long=True, wait=False)
+        cmdargs = myargs(long=True, wait=False, events=False)
         with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
             retcode = wrap_and_call(
                 'cloudinit.cmd.status',
                 {'_is_cloudinit_disabled': (False, ''),
-                 'Init': {'side_effect': self.init_class}},
+                 'read_cfg_paths': {'return_value': self.paths}},
                 status.handle_status_args, 'ignored', cmdargs)
         self.assertEqual(0, retcode)
         expected = dedent('''\
@@ -305,7 +296,7 @@ class TestStatus(CiTestCase):
         self.assertEqual(expected, m_stdout.getvalue())
 
     def test_status_wait_blocks_until_done(self):
-        '''Specifying wait will poll every 1/4 second until done state.'''
+        '''Without inotify, wait polls every 1/4 second until done state.'''
         running_json = {
             'v1': {'stage': 'init',
                    'init': {'start': 124.456, 'finished': None},
@@ -327,20 +318,21 @@ class TestStatus(CiTestCase):
                 result_file = self.tmp_path('result.json', self.new_root)
                 ensure_file(result_file)
 
-        cmdargs = myargs(long=False, wait=True)
+        cmdargs = myargs(long=False, wait=True, events=False)
         with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
             retcode = wrap_and_call(
                 'cloudinit.cmd.status',
                 {'sleep': {'side_effect': fake_sleep},
+                 '_StatusWatcher': {'side_effect': OSError('no inotify')},
                  '_is_cloudinit_disabled': (False, ''),
-                 'Init': {'side_effect': self.init_class}},
+                 'read_cfg_paths': {'return_value': self.paths}},
                 status.handle_status_args, 'ignored', cmdargs)
         self.assertEqual(0, retcode)
-        self.assertEqual(4, self.sleep_calls)
-        self.assertEqual('....\nstatus: done\n', m_stdout.getvalue())
+        self.assertEqual(3, self.sleep_calls)
+        self.assertEqual('...\nstatus: done\n', m_stdout.getvalue())
 
     def test_status_wait_blocks_until_error(self):
-        '''Specifying wait will poll every 1/4 second until error state.'''
+        '''Without inotify, wait polls every 1/4 second until error state.'''
         running_json = {
             'v1': {'stage': 'init',
                    'init': {'start': 124.456, 'finished': None},
@@ -361,17 +353,60 @@ class TestStatus(CiTestCase):
             elif self.sleep_calls == 3:
                 write_json(self.status_file, error_json)
 
-        cmdargs = myargs(long=False, wait=True)
+        cmdargs = myargs(long=False, wait=True, events=False)
         with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
             retcode = wrap_and_call(
                 'cloudinit.cmd.status',
                 {'sleep': {'side_effect': fake_sleep},
+                 '_StatusWatcher': {'side_effect': OSError('no inotify')},
                  '_is_cloudinit_disabled': (False, ''),
-                 'Init': {'side_effect': self.init_class}},
+                 'read_cfg_paths': {'return_value': self.paths}},
                 status.handle_status_args, 'ignored', cmdargs)
         self.assertEqual(1, retcode)
-        self.assertEqual(4, self.sleep_calls)
-        self.assertEqual('....\nstatus: error\n', m_stdout.getvalue())
+        self.assertEqual(3, self.sleep_calls)
+        self.assertEqual('...\nstatus: error\n', m_stdout.getvalue())
+
+    def test_status_events_prints_json_per_transition(self):
+        '''Specifying events prints a JSON line per status transition.'''
+        running_json = {
+            'v1': {'stage': 'init',
+                   'init': {'start': 124.5, 'finished': None},
+                   'init-local': {'start': 123.5, 'finished': 123.75}}}
+        done_json = {
+            'v1': {'stage': None,
+                   'init': {'start': 124.5, 'finished': 125.5},
+                   'init-local': {'start': 123.5, 'finished': 123.75}}}
+
+        self.sleep_calls = 0
+
+        def fake_sleep(interval):
+            self.sleep_calls += 1
+            if self.sleep_calls == 1:
+                write_json(self.status_file, running_json)
+            elif self.sleep_calls == 3:
+                write_json(self.status_file, done_json)
+                result_file = self.tmp_path('result.json', self.new_root)
+                ensure_file(result_file)
+
+        cmdargs = myargs(long=False, wait=False, events=True)
+        with mock.patch('sys.stdout', new_callable=StringIO) as m_stdout:
+            retcode = wrap_and_call(
+                'cloudinit.cmd.status',
+                {'sleep': {'side_effect': fake_sleep},
+                 '_StatusWatcher': {'side_effect': OSError('no inotify')},
+                 '_is_cloudinit_disabled': (False, ''),
+                 'read_cfg_paths': {'return_value': self.paths}},
+                status.handle_status_args, 'ignored', cmdargs)
+        self.assertEqual(0, retcode)
+        self.assertEqual(3, self.sleep_calls)
+        self.assertEqual(
+            [{'status': 'not run', 'stage': None, 'detail': '',
+              'last_update': None},
+             {'status': 'running', 'stage': 'init',
+              'detail': 'Running in stage: init', 'last_update': 124.5},
+             {'status': 'done', 'stage': None, 'detail': '',
+              'last_update': 125.5}],
+            [json.loads(line) for line in m_stdout.getvalue().splitlines()])
 
     def test_status_main(self):
         '''status.main can be run as a standalone script.'''
@@ -384,9 +419,58 @@ class TestStatus(CiTestCase):
                     {'sys.argv': {'new': ['status']},
                      'sys.exit': {'side_effect': self.sys_exit},
                      '_is_cloudinit_disabled': (False, ''),
-                     'Init': {'side_effect': self.init_class}},
+                     'read_cfg_paths': {'return_value': self.paths}},
                     status.main)
         self.assertEqual(0, context_manager.exception.code)
         self.assertEqual('status: running\n', m_stdout.getvalue())
 
+
+@skipIf(not os.path.exists('/proc/sys/fs/inotify'), 'inotify unavailable')
+class TestStatusWatcher(CiTestCase):
+
+    def setUp(self):
+        super(TestStatusWatcher, self).setUp()
+        self.new_root = self.tmp_dir()
+        self.run_dir = self.tmp_path('run', self.new_root)
+        self.data_dir = self.tmp_path('data', self.new_root)
+        ensure_dir(self.run_dir)
+        ensure_dir(self.data_dir)
+        self.watcher = status._StatusWatcher(
+            mypaths(run_dir=self.run_dir),
+            self.tmp_path('cloud-init.disabled', self.new_root))
+        self.addCleanup(self.watcher.close)
+
+    def assertWakes(self, change):
+        """Assert wait returns promptly after change, long before timeout."""
+        self.watcher.watch()
+        change()
+        start = time.time()
+        self.watcher.wait(30)
+        self.assertLess(time.time() - start, 5)
+
+    def test_wait_wakes_on_status_file_creation(self):
+        '''Creating status.json in run_dir wakes waiters.'''
+        self.assertWakes(lambda: write_json(
+            os.path.join(self.run_dir, 'status.json'), {'v1': {}}))
+
+    def test_wait_wakes_on_symlinked_status_file_update(self):
+        '''Replacing the target of the status.json symlink wakes waiters.'''
+        status_path = os.path.join(self.data_dir, 'status.json')
+        write_json(status_path, {'v1': {}})
+        os.symlink(status_path, os.path.join(self.run_dir, 'status.json'))
+        self.assertWakes(lambda: write_json(status_path, {'v1': {'a': 1}}))
+
+    def test_wait_wakes_on_disable_file(self):
+        '''Creating the disable file wakes waiters.'''
+        self.assertWakes(lambda: ensure_file(
+            os.path.join(self.new_root, 'cloud-init.disabled')))
+
+    def test_wait_ignores_unrelated_files(self):
+        '''Changes to other files in run_dir do not wake waiters.'''
+        self.watcher.watch()
+        write_json(os.path.join(self.run_dir, 'instance-data.json'), {})
+        start = time.time()
+        self.watcher.wait(0.5)
+        self.assertGreaterEqual(time.time() - start, 0.5)
+
 # vi: ts=4 expandtab syntax=python
@@ -42,6 +42,34 @@ def fixup_module(mod, def_freq=PER_INSTANCE):
         setattr(mod, 'distros', [])
     if not hasattr(mod, 'osfamilies'):
         setattr(mod, 'osfamilies', [])
+    if not hasattr(mod, 'resources'):
+        setattr(mod, 'resources', None)
+    if not hasattr(mod, 'deepcopy_cfg'):
+        setattr(mod, 'deepcopy_cfg', False)
     return mod
 
+
+def module_dependencies(mods):
+    """Return, for each of mods, the indexes of earlier mods to wait for.
+
+    Modules declare the system resources they change in a 'resources' list.
+    A module has to wait for every earlier module sharing a resource with it.
+    Modules without declared resources may change anything, so they wait for
+    all earlier modules and all later modules wait for them.
+    """
+    declared = []
+    for mod in mods:
+        resources = getattr(mod, 'resources', None)
+        if isinstance(resources, (list, tuple, set, frozenset)):
+            declared.append(frozenset(resources))
+        else:
+            declared.append(None)
+    waits_for = []
+    for (index, resources) in enumerate(declared):
+        waits_for.append([
+            earlier for earlier in range(index)
+            if resources is None or declared[earlier] is None or
+            resources & declared[earlier]])
+    return waits_for
+
 # vi: ts=4 expandtab
@@ -224,6 +224,8 @@ from cloudinit import log as logging
 from cloudinit import templater
 from cloudinit import util
 
+resources = ['packages']
+
 LOG = logging.getLogger(__name__)
 
 # this will match 'XXX:YYY' (ie, 'cloud-archive:foo' or 'ppa:bar')
@@ -35,6 +35,7 @@ from cloudinit import util
 frequency = PER_INSTANCE
 
 distros = ['ubuntu', 'debian']
+resources = ['packages']
 
 DEFAULT_FILE = "/etc/apt/apt.conf.d/90cloud-init-pipelining"
 
@@ -42,6 +42,7 @@ from cloudinit.distros import ug_util
 from cloudinit import util
 
 distros = ['ubuntu', 'debian']
+resources = ['packages', 'users']
 
 
 def handle(name, cfg, cloud, log, args):
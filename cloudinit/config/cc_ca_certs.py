@@ -45,6 +45,7 @@ CA_CERT_SYSTEM_PATH = "/etc/ssl/certs/"
 CA_CERT_FULL_PATH = os.path.join(CA_CERT_PATH, CA_CERT_FILENAME)
 
 distros = ['ubuntu', 'debian']
+resources = ['ca-certificates', 'packages']
 
 
 def update_ca_certs():
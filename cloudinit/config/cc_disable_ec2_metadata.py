@@ -31,6 +31,7 @@ from cloudinit import util
 from cloudinit.settings import PER_ALWAYS
 
 frequency = PER_ALWAYS
+resources = ['network']
 
 REJECT_CMD_IF = ['route', 'add', '-host', '169.254.169.254', 'reject']
 REJECT_CMD_IP = ['ip', 'route', 'add', 'prohibit', '169.254.169.254']
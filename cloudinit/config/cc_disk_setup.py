@@ -140,6 +140,8 @@ def handle(_name, cfg, cloud, log, _args):
                               func=mkpart, args=(disk, definition))
             except Exception as e:
                 util.logexc(LOG, "Failed partitioning operation\n%s" % e)
+            # partitions changed, probe block devices again
+            util.invalidate_block_devices()
 
     fs_setup = cfg.get("fs_setup")
     if isinstance(fs_setup, list):
@@ -158,6 +160,8 @@ def handle(_name, cfg, cloud, log, _args):
                               func=mkfs, args=(definition,))
             except Exception as e:
                 util.logexc(LOG, "Failed during filesystem operation\n%s" % e)
+            # filesystems changed, probe block devices again
+            util.invalidate_block_devices()
 
 
 def update_disk_setup_devices(disk_setup, tformer):
@@ -36,6 +36,7 @@ from cloudinit.settings import PER_INSTANCE
 from cloudinit import util
 
 frequency = PER_INSTANCE
+resources = ['console', 'ssh']
 
 # This is a tool that cloud init provides
 HELPER_TOOL_TPL = '%s/cloud-init/write-ssh-key-fingerprints'
@@ -26,6 +26,7 @@ frequency = PER_INSTANCE
 NTP_CONF = '/etc/ntp.conf'
 NR_POOL_SERVERS = 4
 distros = ['centos', 'debian', 'fedora', 'opensuse', 'rhel', 'sles', 'ubuntu']
+resources = ['ntp', 'packages']
 
 NTP_CLIENT_CONFIG = {
     'chrony': {
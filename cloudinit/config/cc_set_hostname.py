@@ -48,6 +48,8 @@ import os
 from cloudinit.atomic_helper import write_json
 from cloudinit import util
 
+resources = ['hostname']
+
 
 class SetHostnameError(Exception):
     """Raised when the distro runs into an exception when setting hostname.
@@ -87,6 +87,8 @@ from cloudinit import util
 
 from string import ascii_letters, digits
 
+resources = ['ssh', 'users']
+
 LOG = logging.getLogger(__name__)
 
 # We are removing certain 'painful' letters/numbers
@@ -67,6 +67,7 @@ using the ``ssh_genkeytypes`` config flag, which accepts a list of host key
 types to use. For each host key type for which this module has been instructed
 to create a keypair, if a key of the same type is already present on the
 system (i.e. if ``ssh_deletekeys`` was false), no key will be generated.
+The missing key types are generated concurrently.
 
 Supported host key types for the ``ssh_keys`` and the ``ssh_genkeytypes``
 config flags are:
@@ -110,14 +111,18 @@ config flags are:
         blacklist: <list of key types> (Defaults to [dsa])
 """
 
+from concurrent import futures
 import glob
 import os
 import sys
 
 from cloudinit.distros import ug_util
+from cloudinit.reporting import events
 from cloudinit import ssh_util
 from cloudinit import util
 
+resources = ['ssh', 'users']
+
 
 GENERATE_KEY_NAMES = ['rsa', 'dsa', 'ecdsa', 'ed25519']
 KEY_FILE_TPL = '/etc/ssh/ssh_host_%s_key'
@@ -174,28 +179,7 @@ def handle(_name, cfg, cloud, log, _args):
         genkeys = util.get_cfg_option_list(cfg,
                                            'ssh_genkeytypes',
                                            GENERATE_KEY_NAMES)
-        lang_c = os.environ.copy()
-        lang_c['LANG'] = 'C'
-        for keytype in genkeys:
-            keyfile = KEY_FILE_TPL % (keytype)
-            if os.path.exists(keyfile):
-                continue
-            util.ensure_dir(os.path.dirname(keyfile))
-            cmd = ['ssh-keygen', '-t', keytype, '-N', '', '-f', keyfile]
-
-            # TODO(harlowja): Is this guard needed?
-            with util.SeLinuxGuard("/etc/ssh", recursive=True):
-                try:
-                    out, err = util.subp(cmd, capture=True, env=lang_c)
-                    sys.stdout.write(util.decode_binary(out))
-                except util.ProcessExecutionError as e:
-                    err = util.decode_binary(e.stderr).lower()
-                    if (e.exit_code == 1 and
-                            err.lower().startswith("unknown key")):
-                        log.debug("ssh-keygen: unknown key type '%s'", keytype)
-                    else:
-                        util.logexc(log, "Failed generating key type %s to "
-                                    "file %s", keytype, keyfile)
+        generate_host_keys(genkeys, log, parent=cloud.reporter)
 
     if "ssh_publish_hostkeys" in cfg:
         host_key_blacklist = util.get_cfg_option_list(
@@ -237,6 +221,69 @@ def handle(_name, cfg, cloud, log, _args):
         util.logexc(log, "Applying SSH credentials failed!")
 
 
+def _generate_host_key(keytype, keyfile, env, log, parent):
+    """Run ssh-keygen for keytype under its own reporting event.
+
+    @return: ssh-keygen output, or None if the key was not generated.
+    """
+    cmd = ['ssh-keygen', '-t', keytype, '-N', '', '-f', keyfile]
+    myrep = events.ReportEventStack(
+        name="keygen-%s" % keytype,
+        description="generating ssh host key type %s" % keytype,
+        parent=parent)
+    with myrep:
+        try:
+            out, _err = util.subp(cmd, capture=True, env=env)
+            return util.decode_binary(out)
+        except util.ProcessExecutionError as e:
+            err = util.decode_binary(e.stderr).lower()
+            if (e.exit_code == 1 and
+                    err.lower().startswith("unknown key")):
+                log.debug("ssh-keygen: unknown key type '%s'", keytype)
+                myrep.message = "unknown key type %s" % keytype
+            else:
+                util.logexc(log, "Failed generating key type %s to "
+                            "file %s", keytype, keyfile)
+                myrep.result = events.status.WARN
+                myrep.message = "failed generating key type %s" % keytype
+    return None
+
+
+def generate_host_keys(keytypes, log, parent=None):
+    """Generate missing host keys of keytypes concurrently.
+
+    Each key type is generated by its own ssh-keygen process and reported
+    as a sub-event of an ssh-host-keys event under parent. SELinux contexts
+    of /etc/ssh are restored once, after all keys were generated. Output of
+    ssh-keygen is written to stdout in keytypes order.
+    """
+    lang_c = os.environ.copy()
+    lang_c['LANG'] = 'C'
+    missing = []
+    for keytype in keytypes:
+        keyfile = KEY_FILE_TPL % (keytype)
+        if os.path.exists(keyfile):
+            continue
+        util.ensure_dir(os.path.dirname(keyfile))
+        missing.append((keytype, keyfile))
+    if not missing:
+        return
+    myrep = events.ReportEventStack(
+        name="ssh-host-keys",
+        description="generating ssh host keys %s" % ', '.join(
+            keytype for (keytype, _keyfile) in missing),
+        parent=parent)
+    with myrep, util.SeLinuxGuard("/etc/ssh", recursive=True):
+        with futures.ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            outputs = [
+                executor.submit(_generate_host_key, keytype, keyfile, lang_c,
+                                log, myrep)
+                for (keytype, keyfile) in missing]
+        for output in outputs:
+            if output.result():
+                sys.stdout.write(output.result())
+
+
 def apply_credentials(keys, user, disable_root, disable_root_opts):
 
     keys = set(keys)
@@ -34,6 +34,8 @@ from cloudinit.distros import ug_util
 from cloudinit import ssh_util
 from cloudinit import util
 
+resources = ['console', 'ssh', 'users']
+
 
 def _split_hash(bin_hash):
     split_up = []
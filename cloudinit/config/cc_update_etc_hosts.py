@@ -55,6 +55,7 @@ from cloudinit import util
 from cloudinit.settings import PER_ALWAYS
 
 frequency = PER_ALWAYS
+resources = ['hostname']
 
 
 def handle(name, cfg, cloud, log, _args):
@@ -37,6 +37,7 @@ from cloudinit.settings import PER_ALWAYS
 from cloudinit import util
 
 frequency = PER_ALWAYS
+resources = ['hostname']
 
 
 def handle(name, cfg, cloud, log, _args):
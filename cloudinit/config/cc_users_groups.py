@@ -131,6 +131,7 @@ from cloudinit.settings import PER_INSTANCE
 LOG = logging.getLogger(__name__)
 
 frequency = PER_INSTANCE
+resources = ['users']
 
 
 def handle(name, cfg, cloud, _log, _args):
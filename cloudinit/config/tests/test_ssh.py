@@ -2,8 +2,12 @@
 
 import os.path
 
+import six
+
 from cloudinit.config import cc_ssh
+from cloudinit.reporting import events
 from cloudinit import ssh_util
+from cloudinit import util
 from cloudinit.tests.helpers import CiTestCase, mock
 import logging
 
@@ -343,3 +347,77 @@ class TestHandleSsh(CiTestCase):
         cc_ssh.handle("name", cfg, cloud, LOG, None)
         self.assertEqual([mock.call(expected_call)],
                          cloud.datasource.publish_host_keys.call_args_list)
+
+
+@mock.patch(MODPATH + "util.SeLinuxGuard")
+@mock.patch(MODPATH + "util.subp")
+class TestGenerateHostKeys(CiTestCase):
+    """Test cc_ssh.generate_host_keys."""
+
+    with_logs = True
+
+    def setUp(self):
+        super(TestGenerateHostKeys, self).setUp()
+        self.key_tpl = os.path.join(self.tmp_dir(), 'ssh_host_%s_key')
+        patcher = mock.patch.object(cc_ssh, 'KEY_FILE_TPL', self.key_tpl)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stdout = six.StringIO()
+        patcher = mock.patch(MODPATH + "sys.stdout", self.stdout)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _fake_keygen(self, cmd, capture, env):
+        keytype = cmd[2]
+        if keytype == 'dsa':
+            raise util.ProcessExecutionError(
+                exit_code=1, stderr='unknown key type dsa')
+        if keytype == 'ecdsa':
+            raise util.ProcessExecutionError(exit_code=2, stderr='boom')
+        return ('%s generated\n' % keytype, '')
+
+    @mock.patch('cloudinit.reporting.events.report_finish_event')
+    def test_generates_missing_keys_once_relabeled(
+            self, m_finish, m_subp, m_guard):
+        """Missing keys are generated, reported and relabeled once."""
+        open(self.key_tpl % 'ed25519', 'w').close()
+        m_subp.side_effect = self._fake_keygen
+        cc_ssh.generate_host_keys(['rsa', 'dsa', 'ecdsa', 'ed25519'], LOG)
+        self.assertEqual(
+            ['dsa', 'ecdsa', 'rsa'],
+            sorted(call[0][0][2] for call in m_subp.call_args_list))
+        for call in m_subp.call_args_list:
+            self.assertEqual('C', call[1]['env']['LANG'])
+        m_guard.assert_called_once_with("/etc/ssh", recursive=True)
+        self.assertEqual('rsa generated\n', self.stdout.getvalue())
+        finished = dict(
+            (call[0][0], call[0][2]) for call in m_finish.call_args_list)
+        self.assertEqual(
+            {'ssh-host-keys': 'WARN', 'ssh-host-keys/keygen-rsa': 'SUCCESS',
+             'ssh-host-keys/keygen-dsa': 'SUCCESS',
+             'ssh-host-keys/keygen-ecdsa': 'WARN'}, finished)
+        self.assertIn("ssh-keygen: unknown key type 'dsa'",
+                      self.logs.getvalue())
+        self.assertIn('Failed generating key type ecdsa',
+                      self.logs.getvalue())
+
+    @mock.patch('cloudinit.reporting.events.report_finish_event')
+    def test_reports_under_parent(self, m_finish, m_subp, m_guard):
+        """Key generation is reported as sub-events of the parent."""
+        m_subp.side_effect = self._fake_keygen
+        parent = events.ReportEventStack(
+            name='config-ssh', description='running config-ssh',
+            parent=events.ReportEventStack(
+                name='modules-config', description='config modules'))
+        cc_ssh.generate_host_keys(['rsa'], LOG, parent=parent)
+        self.assertEqual(
+            ['modules-config/config-ssh/ssh-host-keys/keygen-rsa',
+             'modules-config/config-ssh/ssh-host-keys'],
+            [call[0][0] for call in m_finish.call_args_list])
+
+    def test_nothing_to_generate(self, m_subp, m_guard):
+        """No ssh-keygen or relabel happens when all keys exist."""
+        open(self.key_tpl % 'rsa', 'w').close()
+        cc_ssh.generate_host_keys(['rsa'], LOG)
+        self.assertEqual(0, m_subp.call_count)
+        self.assertEqual(0, m_guard.call_count)
@@ -0,0 +1,157 @@
+# This file is part of cloud-init. See LICENSE file for license information.
+
+"""Copy-on-write views of merged cloud config.
+
+Stages hand the merged cloud config to the distro, datasources and every
+config module. Deep copying it for each of them is costly when user-data
+carries large write_files or apt payloads. Instead each consumer gets a
+view: a dict (or list) holding a shallow copy of one level of the shared
+config, whose nested dicts and lists are wrapped in views only once they
+are accessed. Changes made through a view stay private to it and never
+reach the shared config.
+
+Views are dict and list instances, so isinstance checks and json, yaml
+and pickle serialization work as before. Use thaw() or copy.deepcopy()
+to get plain, fully independent copies.
+"""
+
+import copy
+
+import yaml
+
+from cloudinit import safeyaml
+
+
+def view(obj):
+    """Return a copy-on-write view of obj if it is a dict or list."""
+    if type(obj) is dict:
+        return ConfigView(obj)
+    if type(obj) is list:
+        return ConfigListView(obj)
+    return obj
+
+
+def thaw(obj):
+    """Return a plain deep copy of obj, views included."""
+    if isinstance(obj, dict):
+        # dict.items and list.__iter__ skip wrapping values in views
+        return dict(
+            (key, thaw(value)) for (key, value) in dict.items(obj))
+    if isinstance(obj, list):
+        return [thaw(value) for value in list.__iter__(obj)]
+    return copy.deepcopy(obj)
+
+
+class ConfigView(dict):
+    """Copy-on-write view of a dict, see the module docstring."""
+
+    def _wrapped(self, key):
+        value = dict.__getitem__(self, key)
+        wrapped = view(value)
+        if wrapped is not value:
+            dict.__setitem__(self, key, wrapped)
+        return wrapped
+
+    def __getitem__(self, key):
+        return self._wrapped(key)
+
+    def __iter__(self):
+        # Defined so that dict(), update() and ** go through __getitem__
+        return dict.__iter__(self)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self._wrapped(key)
+        return default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self._wrapped(key)
+        dict.__setitem__(self, key, default)
+        return default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self._wrapped(key)
+            dict.__delitem__(self, key)
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        (key, value) = dict.popitem(self)
+        return (key, view(value))
+
+    def items(self):
+        return [(key, self._wrapped(key)) for key in dict.keys(self)]
+
+    def values(self):
+        return [self._wrapped(key) for key in dict.keys(self)]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (dict, (thaw(self),))
+
+
+class ConfigListView(list):
+    """Copy-on-write view of a list, see the module docstring."""
+
+    def _wrapped(self, index):
+        value = list.__getitem__(self, index)
+        wrapped = view(value)
+        if wrapped is not value:
+            list.__setitem__(self, index, wrapped)
+        return wrapped
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._wrapped(i) for i in range(len(self))[index]]
+        return self._wrapped(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._wrapped(index)
+
+    def __reversed__(self):
+        for index in reversed(range(len(self))):
+            yield self._wrapped(index)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def pop(self, index=-1):
+        value = self._wrapped(index)
+        list.pop(self, index)
+        return value
+
+    def copy(self):
+        return list(self)
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (list, (thaw(self),))
+
+
+for _dumper in (yaml.dumper.Dumper, yaml.dumper.SafeDumper,
+                safeyaml.NoAliasSafeDumper):
+    _dumper.add_representer(
+        ConfigView, yaml.representer.SafeRepresenter.represent_dict)
+    _dumper.add_representer(
+        ConfigListView, yaml.representer.SafeRepresenter.represent_list)
+
+# vi: ts=4 expandtab
@@ -15,7 +15,6 @@ from six import StringIO
 import abc
 import os
 import re
-import stat
 
 from cloudinit import importer
 from cloudinit import log as logging
@@ -26,6 +25,7 @@ from cloudinit.net import renderers
 from cloudinit import ssh_util
 from cloudinit import type_utils
 from cloudinit import util
+from cloudinit.util import uses_systemd
 
 from cloudinit.distros.parsers import hosts
 
@@ -802,12 +802,4 @@ def set_etc_timezone(tz, tz_file=None, tz_conf="/etc/timezone",
     return
 
 
-def uses_systemd():
-    try:
-        res = os.lstat('/run/systemd/system')
-        return stat.S_ISDIR(res.st_mode)
-    except Exception:
-        return False
-
-
 # vi: ts=4 expandtab
@@ -6,6 +6,7 @@
 #
 # This file is part of cloud-init. See LICENSE file for license information.
 
+from concurrent import futures
 import functools
 import json
 
@@ -50,7 +51,16 @@ class MetadataLeafDecoder(object):
 # See: http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/
 #         ec2-instance-metadata.html
 class MetadataMaterializer(object):
-    def __init__(self, blob, base_url, caller, leaf_decoder=None):
+    """Crawl an EC2-style metadata tree into a dictionary.
+
+    When max_workers is greater than 1, the tree is crawled breadth-first and
+    all directory listings and leaves at a given depth are fetched
+    concurrently by a pool of at most max_workers threads. The resulting
+    dictionary is identical to the one produced by the serial crawl.
+    """
+
+    def __init__(self, blob, base_url, caller, leaf_decoder=None,
+                 max_workers=None):
         self._blob = blob
         self._md = None
         self._base_url = base_url
@@ -59,6 +69,7 @@ class MetadataMaterializer(object):
             self._leaf_decoder = MetadataLeafDecoder()
         else:
             self._leaf_decoder = leaf_decoder
+        self._max_workers = max_workers
 
     def _parse(self, blob):
         leaves = {}
@@ -106,23 +117,27 @@ class MetadataMaterializer(object):
     def materialize(self):
         if self._md is not None:
             return self._md
-        self._md = self._materialize(self._blob, self._base_url)
+        if self._max_workers and self._max_workers > 1:
+            with futures.ThreadPoolExecutor(
+                    max_workers=self._max_workers) as executor:
+                self._md = self._materialize_concurrent(
+                    self._blob, self._base_url, executor)
+        else:
+            self._md = self._materialize(self._blob, self._base_url)
         return self._md
 
-    def _materialize(self, blob, base_url):
-        (leaves, children) = self._parse(blob)
-        child_contents = {}
-        for c in children:
-            child_url = url_helper.combine_url(base_url, c)
-            if not child_url.endswith("/"):
-                child_url += "/"
-            child_blob = self._caller(child_url)
-            child_contents[c] = self._materialize(child_blob, child_url)
+    def _child_url(self, base_url, child):
+        child_url = url_helper.combine_url(base_url, child)
+        if not child_url.endswith("/"):
+            child_url += "/"
+        return child_url
+
+    def _join(self, base_url, child_contents, leaves, leaf_blobs):
         leaf_contents = {}
         for (field, resource) in leaves.items():
             leaf_url = url_helper.combine_url(base_url, resource)
-            leaf_blob = self._caller(leaf_url)
-            leaf_contents[field] = self._leaf_decoder(field, leaf_blob)
+            leaf_contents[field] = self._leaf_decoder(
+                field, leaf_blobs[leaf_url])
         joined = {}
         joined.update(child_contents)
         for field in leaf_contents.keys():
@@ -133,6 +148,61 @@ class MetadataMaterializer(object):
                 joined[field] = leaf_contents[field]
         return joined
 
+    def _materialize(self, blob, base_url):
+        (leaves, children) = self._parse(blob)
+        child_contents = {}
+        for c in children:
+            child_url = self._child_url(base_url, c)
+            child_blob = self._caller(child_url)
+            child_contents[c] = self._materialize(child_blob, child_url)
+        leaf_blobs = {}
+        for resource in leaves.values():
+            leaf_url = url_helper.combine_url(base_url, resource)
+            leaf_blobs[leaf_url] = self._caller(leaf_url)
+        return self._join(base_url, child_contents, leaves, leaf_blobs)
+
+    def _fetch_all(self, urls, executor):
+        """Fetch urls using executor, returning blobs in the same order.
+
+        The first failure cancels any fetches not yet started and is raised.
+        """
+        pending = [executor.submit(self._caller, url) for url in urls]
+        try:
+            return [future.result() for future in pending]
+        except Exception:
+            for future in pending:
+                future.cancel()
+            raise
+
+    def _materialize_concurrent(self, blob, base_url, executor):
+        # Crawl breadth-first so that each level of the tree is fetched in a
+        # single concurrent batch and no worker ever blocks on another.
+        tree = {}
+        leaf_blobs = {}
+        level = [(base_url, blob)]
+        while level:
+            dir_urls = []
+            leaf_urls = []
+            for (url, dir_blob) in level:
+                (leaves, children) = self._parse(dir_blob)
+                tree[url] = (leaves, children)
+                dir_urls.extend(self._child_url(url, c) for c in children)
+                leaf_urls.extend(
+                    url_helper.combine_url(url, resource)
+                    for resource in leaves.values())
+            blobs = self._fetch_all(dir_urls + leaf_urls, executor)
+            leaf_blobs.update(zip(leaf_urls, blobs[len(dir_urls):]))
+            level = list(zip(dir_urls, blobs[:len(dir_urls)]))
+        return self._assemble(base_url, tree, leaf_blobs)
+
+    def _assemble(self, base_url, tree, leaf_blobs):
+        (leaves, children) = tree[base_url]
+        child_contents = {}
+        for c in children:
+            child_contents[c] = self._assemble(
+                self._child_url(base_url, c), tree, leaf_blobs)
+        return self._join(base_url, child_contents, leaves, leaf_blobs)
+
 
 def skip_retry_on_codes(status_codes, _request_args, cause):
     """Returns False if cause.code is in status_codes."""
@@ -169,7 +239,7 @@ def _get_instance_metadata(tree, api_version='latest',
                            metadata_address='http://169.254.169.254',
                            ssl_details=None, timeout=5, retries=5,
                            leaf_decoder=None, headers_cb=None,
-                           exception_cb=None):
+                           exception_cb=None, max_workers=None):
     md_url = url_helper.combine_url(metadata_address, api_version, tree)
     caller = functools.partial(
         url_helper.read_file_or_url, ssl_details=ssl_details,
@@ -183,7 +253,8 @@ def _get_instance_metadata(tree, api_version='latest',
         response = caller(md_url)
         materializer = MetadataMaterializer(response.contents,
                                             md_url, mcaller,
-                                            leaf_decoder=leaf_decoder)
+                                            leaf_decoder=leaf_decoder,
+                                            max_workers=max_workers)
         md = materializer.materialize()
         if not isinstance(md, (dict)):
             md = {}
@@ -197,7 +268,7 @@ def get_instance_metadata(api_version='latest',
                           metadata_address='http://169.254.169.254',
                           ssl_details=None, timeout=5, retries=5,
                           leaf_decoder=None, headers_cb=None,
-                          exception_cb=None):
+                          exception_cb=None, max_workers=None):
     # Note, 'meta-data' explicitly has trailing /.
     # this is required for CloudStack (LP: #1356855)
     return _get_instance_metadata(tree='meta-data/', api_version=api_version,
@@ -205,19 +276,21 @@ def get_instance_metadata(api_version='latest',
                                   ssl_details=ssl_details, timeout=timeout,
                                   retries=retries, leaf_decoder=leaf_decoder,
                                   headers_cb=headers_cb,
-                                  exception_cb=exception_cb)
+                                  exception_cb=exception_cb,
+                                  max_workers=max_workers)
 
 
 def get_instance_identity(api_version='latest',
                           metadata_address='http://169.254.169.254',
                           ssl_details=None, timeout=5, retries=5,
                           leaf_decoder=None, headers_cb=None,
-                          exception_cb=None):
+                          exception_cb=None, max_workers=None):
     return _get_instance_metadata(tree='dynamic/instance-identity',
                                   api_version=api_version,
                                   metadata_address=metadata_address,
                                   ssl_details=ssl_details, timeout=timeout,
                                   retries=retries, leaf_decoder=leaf_decoder,
                                   headers_cb=headers_cb,
-                                  exception_cb=exception_cb)
+                                  exception_cb=exception_cb,
+                                  max_workers=max_workers)
 # vi: ts=4 expandtab
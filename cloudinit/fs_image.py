@@ -0,0 +1,617 @@
+# This file is part of cloud-init. See LICENSE file for license information.
+
+"""Read files from ISO9660 and VFAT images without mounting them.
+
+Seed media such as config drives and NoCloud cidata disks are small
+filesystems holding a handful of files. Reading them straight from the
+block device or image file avoids a mount and umount per candidate device
+and works where mounting is not permitted, such as unprivileged containers.
+
+Only what seed media use is supported: ISO9660 with Rock Ridge or Joliet
+names and FAT12, FAT16 or FAT32 with long file names. Anything else raises
+ImageError so callers can fall back to mounting.
+"""
+
+from collections import namedtuple
+import errno
+import os
+import shutil
+import struct
+
+ISO9660 = 'iso9660'
+VFAT = 'vfat'
+FSTYPES = (ISO9660, VFAT)
+
+# Seed media are small, more file data than this is better off mounted.
+DEFAULT_MAX_EXTRACT_BYTES = 32 * 1024 * 1024
+
+# Limits which guard against loops and bogus sizes in corrupt images.
+MAX_DIRECTORY_DEPTH = 32
+MAX_FAT_BYTES = 16 * 1024 * 1024
+
+_Node = namedtuple('_Node', ['name', 'is_dir', 'location', 'size'])
+
+
+class ImageError(Exception):
+    """The image is not a readable filesystem of the requested type."""
+
+
+def _byte(data, offset):
+    return bytearray(data[offset:offset + 1])[0]
+
+
+class FilesystemImage(object):
+    """Base class for read-only filesystem images opened by open_image."""
+
+    fstype = None
+    # Lookups ignore case, as the kernel does for this filesystem.
+    case_insensitive = False
+
+    def __init__(self, fp):
+        self._fp = fp
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._fp.close()
+
+    @classmethod
+    def probe(cls, fp):
+        """Return True if fp looks like an image of this filesystem."""
+        raise NotImplementedError()
+
+    def _root(self):
+        raise NotImplementedError()
+
+    def _children(self, node):
+        raise NotImplementedError()
+
+    def _read_node(self, node):
+        raise NotImplementedError()
+
+    def _read(self, offset, length):
+        self._fp.seek(offset)
+        data = self._fp.read(length)
+        if len(data) != length:
+            raise ImageError(
+                'Short read of %d bytes at offset %d' % (length, offset))
+        return data
+
+    def _list(self, node):
+        children = self._children(node)
+        for child in children:
+            if (not child.name or child.name in ('.', '..') or
+                    '/' in child.name or '\0' in child.name):
+                raise ImageError('Invalid file name %r' % child.name)
+        return children
+
+    def _lookup(self, path):
+        node = self._root()
+        for part in path.split('/'):
+            if not part:
+                continue
+            if not node.is_dir:
+                raise IOError(errno.ENOTDIR, 'Not a directory', path)
+            children = self._list(node)
+            matches = [c for c in children if c.name == part]
+            if not matches and self.case_insensitive:
+                matches = [
+                    c for c in children if c.name.lower() == part.lower()]
+            if not matches:
+                raise IOError(errno.ENOENT, 'No such file in image', path)
+            node = matches[0]
+        return node
+
+    def _walk(self, node, path, depth=0):
+        if depth > MAX_DIRECTORY_DEPTH:
+            raise ImageError('Directories nested too deep at %s' % path)
+        for child in self._list(node):
+            child_path = os.path.join(path, child.name)
+            yield (child_path, child)
+            if child.is_dir:
+                for item in self._walk(child, child_path, depth + 1):
+                    yield item
+
+    def listdir(self, path='/'):
+        """Return the names in directory path of the image."""
+        node = self._lookup(path)
+        if not node.is_dir:
+            raise IOError(errno.ENOTDIR, 'Not a directory', path)
+        return [child.name for child in self._list(node)]
+
+    def read_file(self, path):
+        """Return the content of file path in the image as bytes."""
+        node = self._lookup(path)
+        if node.is_dir:
+            raise IOError(errno.EISDIR, 'Is a directory', path)
+        return self._read_node(node)
+
+    def walk(self, path='/'):
+        """Yield (path, is_dir, size) for everything below path.
+
+        Directories are yielded before their content.
+        """
+        node = self._lookup(path)
+        for (child_path, child) in self._walk(node, path.strip('/')):
+            yield (child_path, child.is_dir, child.size)
+
+
+class Iso9660Image(FilesystemImage):
+    """ISO9660 image, using Rock Ridge or else Joliet names when present."""
+
+    fstype = ISO9660
+
+    SECTOR_SIZE = 2048
+    FIRST_DESCRIPTOR = 16
+    MAX_DESCRIPTORS = 32
+    JOLIET_ESCAPES = (b'%/@', b'%/C', b'%/E')
+    # Directory record flags
+    FLAG_DIRECTORY = 0x02
+    FLAG_ASSOCIATED = 0x04
+    FLAG_MULTI_EXTENT = 0x80
+    # Rock Ridge NM flags
+    NM_CONTINUE = 0x01
+    NM_CURRENT = 0x02
+    NM_PARENT = 0x04
+    MAX_CONTINUATIONS = 16
+
+    def __init__(self, fp):
+        super(Iso9660Image, self).__init__(fp)
+        primary = joliet = None
+        for index in range(self.MAX_DESCRIPTORS):
+            descriptor = self._read(
+                (self.FIRST_DESCRIPTOR + index) * self.SECTOR_SIZE,
+                self.SECTOR_SIZE)
+            if descriptor[1:6] != b'CD001':
+                raise ImageError('Invalid ISO9660 volume descriptor')
+            vd_type = _byte(descriptor, 0)
+            if vd_type == 255:
+                break
+            if vd_type == 1 and primary is None:
+                primary = descriptor
+            elif vd_type == 2 and descriptor[88:91] in self.JOLIET_ESCAPES:
+                joliet = descriptor
+        if primary is None:
+            raise ImageError('No ISO9660 primary volume descriptor')
+
+        self.susp_skip = None
+        self.joliet = False
+        self._use_descriptor(primary)
+        root_records = self._records(self._root_record)
+        if root_records:
+            self.susp_skip = self._susp_skip(root_records[0])
+        if self.susp_skip is None and joliet is not None:
+            self.joliet = True
+            self._use_descriptor(joliet)
+
+    @property
+    def rock_ridge(self):
+        return self.susp_skip is not None
+
+    def _use_descriptor(self, descriptor):
+        self.block_size = struct.unpack_from('<H', descriptor, 128)[0]
+        if self.block_size not in (512, 1024, 2048):
+            raise ImageError('Invalid ISO9660 block size %d' % self.block_size)
+        self._root_record = self._parse_record(descriptor[156:190])
+
+    def _parse_record(self, record):
+        (ext_attr_len, extent) = struct.unpack_from('<BI', record, 1)
+        size = struct.unpack_from('<I', record, 10)[0]
+        flags, unit_size, gap = struct.unpack_from('<BBB', record, 25)
+        name_len = _byte(record, 32)
+        if flags & self.FLAG_MULTI_EXTENT or unit_size or gap:
+            raise ImageError('Multi-extent and interleaved files unsupported')
+        su_start = 33 + name_len + (1 - name_len % 2)
+        return {'location': extent + ext_attr_len, 'size': size,
+                'flags': flags, 'name': record[33:33 + name_len],
+                'system_use': record[su_start:]}
+
+    def _records(self, directory):
+        """Return the parsed records of an ISO9660 directory."""
+        data = self._read(
+            directory['location'] * self.block_size, directory['size'])
+        records = []
+        offset = 0
+        while offset < len(data):
+            length = _byte(data, offset)
+            if length == 0:
+                # Records do not cross sectors, continue in the next one
+                offset = (offset // self.SECTOR_SIZE + 1) * self.SECTOR_SIZE
+                continue
+            if length < 34 or offset + length > len(data):
+                raise ImageError('Invalid ISO9660 directory record')
+            records.append(self._parse_record(data[offset:offset + length]))
+            offset += length
+        return records
+
+    def _susp_skip(self, dot_record):
+        """Return SUSP skip length if the root '.' record has an SP entry."""
+        area = dot_record['system_use']
+        if (area[0:2] == b'SP' and len(area) >= 7 and
+                area[4:6] == b'\xbe\xef'):
+            return _byte(area, 6)
+        return None
+
+    def _susp_entries(self, area):
+        """Yield (signature, entry) of a System Use area and continuations."""
+        continuations = 0
+        while area:
+            offset = 0
+            next_area = None
+            while offset + 4 <= len(area):
+                signature = area[offset:offset + 2]
+                length = _byte(area, offset + 2)
+                if length < 4 or offset + length > len(area):
+                    break
+                entry = area[offset:offset + length]
+                offset += length
+                if signature == b'ST':
+                    break
+                elif signature == b'CE':
+                    block, ce_offset, ce_length = struct.unpack_from(
+                        '<I4xI4xI', entry, 4)
+                    next_area = (block, ce_offset, ce_length)
+                else:
+                    yield (signature, entry)
+            if next_area is None:
+                break
+            continuations += 1
+            if continuations > self.MAX_CONTINUATIONS:
+                raise ImageError('Too many Rock Ridge continuation areas')
+            (block, ce_offset, ce_length) = next_area
+            area = self._read(
+                block * self.block_size + ce_offset, ce_length)
+
+    def _rock_ridge_name(self, record):
+        name = b''
+        for (signature, entry) in self._susp_entries(
+                record['system_use'][self.susp_skip:]):
+            if signature == b'NM':
+                flags = _byte(entry, 4)
+                if flags & (self.NM_CURRENT | self.NM_PARENT):
+                    continue
+                name += entry[5:]
+            elif signature in (b'SL', b'CL', b'RE'):
+                raise ImageError(
+                    'Rock Ridge %s entries unsupported' %
+                    signature.decode('ascii'))
+        return name.decode('utf-8', 'replace') if name else None
+
+    def _name(self, record):
+        if self.rock_ridge:
+            name = self._rock_ridge_name(record)
+            if name:
+                return name
+        if self.joliet:
+            name = record['name'].decode('utf-16-be')
+        else:
+            # Mapped as the kernel does by default with map=normal
+            name = record['name'].decode('ascii', 'replace').lower()
+        if not record['flags'] & self.FLAG_DIRECTORY and name.endswith(';1'):
+            name = name[:-2]
+        return name.rstrip('.') or name
+
+    def _root(self):
+        return _Node('', True, self._root_record, self._root_record['size'])
+
+    def _children(self, node):
+        children = []
+        for record in self._records(node.location):
+            if record['name'] in (b'\x00', b'\x01'):
+                continue
+            if record['flags'] & self.FLAG_ASSOCIATED:
+                continue
+            children.append(_Node(
+                self._name(record),
+                bool(record['flags'] & self.FLAG_DIRECTORY),
+                record, record['size']))
+        return children
+
+    def _read_node(self, node):
+        return self._read(
+            node.location['location'] * self.block_size, node.size)
+
+    @classmethod
+    def probe(cls, fp):
+        fp.seek(cls.FIRST_DESCRIPTOR * cls.SECTOR_SIZE)
+        return fp.read(6)[1:6] == b'CD001'
+
+
+class VfatImage(FilesystemImage):
+    """FAT12, FAT16 or FAT32 image with VFAT long file names."""
+
+    fstype = VFAT
+    case_insensitive = True
+
+    ENTRY_SIZE = 32
+    ATTR_VOLUME_ID = 0x08
+    ATTR_DIRECTORY = 0x10
+    ATTR_LONG_NAME = 0x0F
+    DELETED = 0xE5
+    LFN_LAST = 0x40
+    # Windows NT flags in a short entry for names with lower case parts
+    NT_LOWER_BASE = 0x08
+    NT_LOWER_EXT = 0x10
+
+    def __init__(self, fp):
+        super(VfatImage, self).__init__(fp)
+        boot = self._read(0, 512)
+        (self.sector_size, self.sectors_per_cluster, reserved, fats,
+         root_entries, total_16, _media, fat_size_16) = struct.unpack_from(
+            '<HBHBHHBH', boot, 11)
+        (total_32, fat_size_32) = struct.unpack_from('<II', boot, 32)
+        fat_size = fat_size_16 or fat_size_32
+        total = total_16 or total_32
+        root_sectors = ((root_entries * self.ENTRY_SIZE +
+                         self.sector_size - 1) // self.sector_size)
+        fats_end = reserved + fats * fat_size
+        self.data_start = fats_end + root_sectors
+        if not fat_size or total <= self.data_start:
+            raise ImageError('Invalid FAT geometry')
+        self.cluster_count = (
+            (total - self.data_start) // self.sectors_per_cluster)
+        self.cluster_size = self.sector_size * self.sectors_per_cluster
+        if self.cluster_count < 4085:
+            self.fat_bits = 12
+        elif self.cluster_count < 65525:
+            self.fat_bits = 16
+        else:
+            self.fat_bits = 32
+
+        fat_bytes = min(fat_size * self.sector_size,
+                        (self.cluster_count + 2) * 4)
+        if fat_bytes > MAX_FAT_BYTES:
+            raise ImageError('FAT of %d bytes too large' % fat_bytes)
+        self._fat = self._read(reserved * self.sector_size, fat_bytes)
+        if self.fat_bits == 32:
+            self._root_node = _Node(
+                '', True, struct.unpack_from('<I', boot, 44)[0], None)
+        else:
+            # FAT12 and FAT16 keep the root directory in a fixed area
+            self._root_area = (fats_end * self.sector_size,
+                               root_entries * self.ENTRY_SIZE)
+            self._root_node = _Node('', True, None, None)
+
+    def _next_cluster(self, cluster):
+        if self.fat_bits == 12:
+            value = struct.unpack_from('<H', self._fat, cluster + cluster // 2)
+            value = value[0] >> 4 if cluster & 1 else value[0] & 0xFFF
+            end = 0xFF8
+        elif self.fat_bits == 16:
+            value = struct.unpack_from('<H', self._fat, cluster * 2)[0]
+            end = 0xFFF8
+        else:
+            value = struct.unpack_from('<I', self._fat, cluster * 4)[0]
+            value &= 0x0FFFFFFF
+            end = 0x0FFFFFF8
+        return None if value >= end else value
+
+    def _read_chain(self, cluster, size=None):
+        """Read the cluster chain starting at cluster, up to size bytes."""
+        runs = []
+        seen = 0
+        while cluster is not None:
+            if cluster < 2 or cluster >= self.cluster_count + 2:
+                raise ImageError('Invalid FAT cluster %d' % cluster)
+            seen += 1
+            if seen > self.cluster_count:
+                raise ImageError('Loop in FAT cluster chain')
+            if runs and runs[-1][0] + runs[-1][1] == cluster:
+                runs[-1][1] += 1
+            else:
+                runs.append([cluster, 1])
+            if size is not None and seen * self.cluster_size >= size:
+                break
+            cluster = self._next_cluster(cluster)
+        data = b''.join(
+            self._read(
+                (self.data_start + (start - 2) * self.sectors_per_cluster) *
+                self.sector_size, count * self.cluster_size)
+            for (start, count) in runs)
+        if size is not None:
+            if len(data) < size:
+                raise ImageError('FAT cluster chain shorter than file')
+            data = data[:size]
+        return data
+
+    def _short_name(self, entry):
+        base = bytearray(entry[0:8].rstrip(b' '))
+        if base and base[0] == 0x05:
+            base[0] = self.DELETED
+        ext = entry[8:11].rstrip(b' ')
+        nt_flags = _byte(entry, 12)
+        base = bytes(base).decode('cp437')
+        ext = ext.decode('cp437')
+        if nt_flags & self.NT_LOWER_BASE:
+            base = base.lower()
+        if nt_flags & self.NT_LOWER_EXT:
+            ext = ext.lower()
+        return base + '.' + ext if ext else base
+
+    @staticmethod
+    def _lfn_checksum(short_name):
+        checksum = 0
+        for char in bytearray(short_name):
+            checksum = (((checksum & 1) << 7) + (checksum >> 1) + char) & 0xFF
+        return checksum
+
+    def _long_name(self, lfn_entries, short_name):
+        """Return the long name from lfn_entries if they belong to the
+        short entry with short_name, otherwise None."""
+        if not lfn_entries:
+            return None
+        first_sequence = _byte(lfn_entries[0], 0)
+        if not first_sequence & self.LFN_LAST:
+            return None
+        count = first_sequence & 0x1F
+        checksum = self._lfn_checksum(short_name)
+        if count != len(lfn_entries):
+            return None
+        chars = b''
+        for (index, entry) in enumerate(lfn_entries):
+            if (_byte(entry, 0) & 0x1F != count - index or
+                    _byte(entry, 13) != checksum):
+                return None
+            chars = entry[1:11] + entry[14:26] + entry[28:32] + chars
+        name = chars.decode('utf-16-le', 'replace')
+        return name.split('\0', 1)[0].rstrip(u'\uffff')
+
+    def _root(self):
+        return self._root_node
+
+    def _children(self, node):
+        if node.location is None:
+            data = self._read(*self._root_area)
+        else:
+            data = self._read_chain(node.location)
+        children = []
+        lfn_entries = []
+        for offset in range(0, len(data), self.ENTRY_SIZE):
+            entry = data[offset:offset + self.ENTRY_SIZE]
+            first = _byte(entry, 0)
+            if first == 0:
+                break
+            if first == self.DELETED:
+                lfn_entries = []
+                continue
+            attr = _byte(entry, 11)
+            if attr == self.ATTR_LONG_NAME:
+                if first & self.LFN_LAST:
+                    lfn_entries = []
+                lfn_entries.append(entry)
+                continue
+            if attr & self.ATTR_VOLUME_ID:
+                lfn_entries = []
+                continue
+            name = self._long_name(lfn_entries, entry[0:11])
+            lfn_entries = []
+            if name is None:
+                name = self._short_name(entry)
+            if name in ('.', '..'):
+                continue
+            (cluster_high, ) = struct.unpack_from('<H', entry, 20)
+            (cluster_low, size) = struct.unpack_from('<HI', entry, 26)
+            is_dir = bool(attr & self.ATTR_DIRECTORY)
+            children.append(_Node(
+                name, is_dir, (cluster_high << 16) | cluster_low,
+                None if is_dir else size))
+        return children
+
+    def _read_node(self, node):
+        if not node.size:
+            return b''
+        return self._read_chain(node.location, node.size)
+
+    @classmethod
+    def probe(cls, fp):
+        fp.seek(0)
+        boot = fp.read(512)
+        if len(boot) != 512 or boot[510:512] != b'\x55\xaa':
+            return False
+        if _byte(boot, 0) not in (0xEB, 0xE9):
+            return False
+        (sector_size, sectors_per_cluster, reserved, fats) = (
+            struct.unpack_from('<HBHB', boot, 11))
+        return (sector_size in (512, 1024, 2048, 4096) and
+                sectors_per_cluster > 0 and
+                sectors_per_cluster & (sectors_per_cluster - 1) == 0 and
+                reserved > 0 and fats > 0)
+
+
+IMAGE_READERS = (Iso9660Image, VfatImage)
+
+
+def open_image(path, fstypes=None):
+    """Open the ISO9660 or VFAT image at path, a block device or file.
+
+    @param fstypes: Filesystem types to accept, default FSTYPES.
+    @return: FilesystemImage instance, to be closed by the caller.
+    @raises ImageError: path is unreadable or not an image of fstypes.
+    """
+    if fstypes is None:
+        fstypes = FSTYPES
+    try:
+        fp = open(path, 'rb')
+    except (IOError, OSError) as e:
+        raise ImageError('Unable to open %s: %s' % (path, e))
+    try:
+        for reader in IMAGE_READERS:
+            if reader.fstype in fstypes and reader.probe(fp):
+                return reader(fp)
+    except (IOError, OSError, struct.error) as e:
+        fp.close()
+        raise ImageError('Unable to read %s: %s' % (path, e))
+    except Exception:
+        fp.close()
+        raise
+    fp.close()
+    raise ImageError('%s is not a %s image' % (path, ' or '.join(fstypes)))
+
+
+def _add_lowercase_aliases(target):
+    """Symlink the lower case name to each name in target which differs.
+
+    Mounted case insensitive filesystems find USER-DATA as user-data, the
+    copy in target needs an alias for that.
+
+    @return: The aliases created directly in target.
+    """
+    aliases = []
+    for (dirpath, dirnames, filenames) in os.walk(target):
+        names = set(dirnames + filenames)
+        for name in sorted(names):
+            alias = name.lower()
+            if alias in names:
+                continue
+            names.add(alias)
+            os.symlink(name, os.path.join(dirpath, alias))
+            if dirpath == target:
+                aliases.append(os.path.join(dirpath, alias))
+    return aliases
+
+
+def extract_image(path, target, fstypes=None,
+                  max_bytes=DEFAULT_MAX_EXTRACT_BYTES):
+    """Copy all files of the image at path into the existing target dir.
+
+    Names in case insensitive images also get a lower case alias.
+
+    @return: The filesystem type which was read.
+    @raises ImageError: when path is not an image of fstypes or holds more
+        than max_bytes of file data. Nothing is left in target then.
+    """
+    with open_image(path, fstypes) as image:
+        created = []
+        total = 0
+        try:
+            for (relpath, node) in image._walk(image._root(), ''):
+                dest = os.path.join(target, relpath)
+                if '/' not in relpath:
+                    created.append(dest)
+                if node.is_dir:
+                    os.mkdir(dest)
+                    continue
+                total += node.size
+                if total > max_bytes:
+                    raise ImageError(
+                        '%s holds more than %d bytes' % (path, max_bytes))
+                with open(dest, 'wb') as stream:
+                    stream.write(image._read_node(node))
+            if image.case_insensitive:
+                created.extend(_add_lowercase_aliases(target))
+        except Exception as e:
+            for dest in created:
+                if os.path.isdir(dest):
+                    shutil.rmtree(dest)
+                elif os.path.lexists(dest):
+                    os.unlink(dest)
+            if isinstance(e, (IOError, OSError, struct.error, UnicodeError)):
+                raise ImageError('Unable to read %s: %s' % (path, e))
+            raise
+        return image.fstype
+
+# vi: ts=4 expandtab
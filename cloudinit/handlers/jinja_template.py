@@ -142,4 +142,47 @@ def convert_jinja_instance_data(data, prefix='', sep='/', decode_paths=()):
             result[key] = value
     return result
 
+
+def convert_jinja_instance_data_index(offsets):
+    """Return an index of instance-data values by their query varname.
+
+    Keys are converted as convert_jinja_instance_data converts them, including
+    the top-level aliases of the values of v<N> keys, and joined by dots. Keys
+    containing dots can not be queried and are left out.
+
+    @param offsets: An iterable of (keys, start, end) tuples giving the
+        offsets of the value at each path of keys in instance-data.json.
+    @return: Dict of [start, end] offsets keyed by varname.
+    """
+    tree = {}
+    for (keys, start, end) in offsets:
+        children = tree
+        for key in keys[:-1]:
+            children = children.setdefault(key, [None, None, {}])[2]
+        node = children.setdefault(keys[-1], [None, None, {}])
+        node[0:2] = [start, end]
+
+    def convert(children):
+        result = {}
+        for key, (start, end, subchildren) in sorted(children.items()):
+            if '-' in key:
+                key = key.replace('-', '_')
+            result[key] = (start, end, convert(subchildren))
+            if re.match(r'v\d+', key):
+                result.update(result[key][2])
+        return result
+
+    index = {}
+
+    def flatten(converted, prefix=None):
+        for key, (start, end, subconverted) in converted.items():
+            if '.' in key:
+                continue
+            varname = key if prefix is None else prefix + '.' + key
+            index[varname] = [start, end]
+            flatten(subconverted, varname)
+
+    flatten(convert(tree))
+    return index
+
 # vi: ts=4 expandtab
@@ -10,22 +10,30 @@
 
 from time import time
 
+import base64
 import contextlib
+import email
+import email.message
 import os
 
+import six
 from six import StringIO
 from six.moves.configparser import (
     NoSectionError, NoOptionError, RawConfigParser)
 
 from cloudinit.settings import (PER_INSTANCE, PER_ALWAYS, PER_ONCE,
-                                CFG_ENV_NAME)
+                                CFG_ENV_NAME, CLOUD_CONFIG, RUN_CLOUD_CONFIG)
 
 from cloudinit import log as logging
 from cloudinit import type_utils
 from cloudinit import util
+from cloudinit import version
 
 LOG = logging.getLogger(__name__)
 
+# Version of the base config snapshot format, see read_base_config_snapshot.
+BASE_CFG_SNAPSHOT_FORMAT_VERSION = 1
+
 
 class LockFailure(Exception):
     pass
@@ -337,6 +345,7 @@ class Paths(object):
             "userdata_raw": "user-data.txt",
             "userdata": "user-data.txt.i",
             "obj_pkl": "obj.pkl",
+            "obj_json": "obj.json",
             "cloud_config": "cloud-config.txt",
             "vendor_cloud_config": "vendor-cloud-config.txt",
             "data": "data",
@@ -454,6 +463,107 @@ class DefaultingConfigParser(RawConfigParser):
         return contents
 
 
+def json_cache_encode(value):
+    """Return value as json-compatible types, tagging non-json types.
+
+    @raises TypeError: for values which cannot be cached as json.
+    """
+    if value is None or isinstance(value, (bool, float) + six.integer_types):
+        return value
+    if isinstance(value, six.text_type):
+        return value
+    if isinstance(value, bytes):
+        return {'__ci_type__': 'bytes',
+                'value': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, list):
+        return [json_cache_encode(item) for item in value]
+    if isinstance(value, tuple):
+        return {'__ci_type__': 'tuple',
+                'value': [json_cache_encode(item) for item in value]}
+    if isinstance(value, dict):
+        encoded = {}
+        for (key, item) in value.items():
+            if not isinstance(key, six.text_type):
+                raise TypeError("Non-string key %r" % (key,))
+            encoded[key] = json_cache_encode(item)
+        return encoded
+    if isinstance(value, email.message.Message):
+        return {'__ci_type__': 'mime', 'value': value.as_string()}
+    raise TypeError("Unable to cache %s" % type(value))
+
+
+def json_cache_decode(value):
+    """Reverse json_cache_encode."""
+    if isinstance(value, list):
+        return [json_cache_decode(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if set(value.keys()) == set(['__ci_type__', 'value']):
+        if value['__ci_type__'] == 'bytes':
+            return base64.b64decode(value['value'])
+        if value['__ci_type__'] == 'tuple':
+            return tuple(json_cache_decode(item) for item in value['value'])
+        if value['__ci_type__'] == 'mime':
+            return email.message_from_string(value['value'])
+    return dict(
+        (key, json_cache_decode(item)) for (key, item) in value.items())
+
+
+def _file_fingerprint(fname):
+    """Return size, mtime and sha256 of the content of fname or None."""
+    try:
+        fstat = os.stat(fname)
+        contents = util.load_file(fname, decode=False)
+    except (IOError, OSError):
+        return None
+    return [fstat.st_size, fstat.st_mtime, util.hash_blob(contents, 'sha256')]
+
+
+def base_config_key(confd):
+    """Return the key of a base config snapshot read with conf.d confd.
+
+    The key changes whenever cloud-init, the kernel cmdline, the system or
+    runtime config files, or the set of .cfg files in confd change.
+    """
+    fnames = [CLOUD_CONFIG, RUN_CLOUD_CONFIG]
+    confd_names = None
+    if confd and os.path.isdir(confd):
+        confd_names = sorted(
+            fname for fname in os.listdir(confd) if fname.endswith('.cfg'))
+        fnames.extend(os.path.join(confd, fname) for fname in confd_names)
+    return {
+        'version': version.version_string(),
+        'cmdline': util.hash_blob(util.get_cmdline(), 'sha256'),
+        'conf_d': [confd, confd_names],
+        'files': dict((fname, _file_fingerprint(fname)) for fname in fnames),
+    }
+
+
+def read_base_config_snapshot(snapshot_file):
+    """Return the base config held by a valid snapshot_file.
+
+    Snapshots are written by stages.fetch_base_config. Reading one does not
+    need the boot stages, so light-weight subcommands can use it.
+
+    @return: The base config, or None if the snapshot is missing, invalid
+        or stale.
+    """
+    record = None
+    try:
+        contents = util.load_file(snapshot_file, quiet=True)
+        if contents:
+            record = util.load_json(contents)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        LOG.debug("Ignoring base config snapshot %s: %s", snapshot_file, e)
+    if isinstance(record, dict) and record.get(
+            'format') == BASE_CFG_SNAPSHOT_FORMAT_VERSION:
+        key = record.get('key')
+        if key and key == base_config_key(key['conf_d'][0]):
+            return json_cache_decode(record['config'])
+        LOG.debug("Base config snapshot %s is stale", snapshot_file)
+    return None
+
+
 def identity(object):
     return object
 
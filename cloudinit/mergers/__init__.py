@@ -5,6 +5,7 @@
 # This file is part of cloud-init. See LICENSE file for license information.
 
 import re
+import threading
 
 import six
 
@@ -19,6 +20,10 @@ DEF_MERGE_TYPE = "list()+dict()+str()"
 MERGER_PREFIX = 'm_'
 MERGER_ATTR = 'Merger'
 
+# Caches of string_extract_mergers and construct results
+_PARSED_MERGERS = {}
+_CONSTRUCTED_MERGERS = {}
+
 
 class UnknownMerger(object):
     # Named differently so auto-method finding
@@ -55,10 +60,62 @@ class LookupMerger(UnknownMerger):
             self._lookups = []
         else:
             self._lookups = lookups
+        # Merge methods by type of source, filled in on first use
+        self._methods = {}
+        # Stack of merges deferred through merge_later, per thread
+        self._local = threading.local()
 
     def __str__(self):
         return 'LookupMerger: (%s)' % (len(self._lookups))
 
+    def _find_method(self, source):
+        source_type = type(source)
+        meth = self._methods.get(source_type)
+        if meth is not None:
+            return meth
+        type_name = type_utils.obj_name(source)
+        method_name = "_on_%s" % (type_name.lower())
+        meth = getattr(self, method_name, None)
+        if not meth:
+            for merger in self._lookups:
+                if hasattr(merger, method_name):
+                    meth = getattr(merger, method_name)
+                    break
+        if not meth:
+            def meth(value, merge_with):
+                return UnknownMerger._handle_unknown(
+                    self, method_name, value, merge_with)
+        # Classes, functions and modules are named after themselves
+        if type_name == source_type.__name__:
+            self._methods[source_type] = meth
+        return meth
+
+    # Merges are done without recursion, so that deeply nested config
+    # can not exhaust the stack. Mergers hand nested values they want
+    # merged to merge_later, and they are merged once the merger returns.
+    def resolve(self, func, *args):
+        """Return func(*args) once all merges it deferred are done."""
+        pending = []
+        outer = getattr(self._local, 'pending', None)
+        self._local.pending = pending
+        try:
+            result = func(*args)
+            while pending:
+                (container, key, value, merge_with) = pending.pop()
+                meth = self._find_method(value)
+                container[key] = meth(value, merge_with)
+        finally:
+            self._local.pending = outer
+        return result
+
+    def merge(self, source, merge_with):
+        return self.resolve(
+            self._find_method(source), source, merge_with)
+
+    def merge_later(self, container, key, value, merge_with):
+        """Set container[key] to value merged with merge_with later on."""
+        self._local.pending.append((container, key, value, merge_with))
+
     # For items which can not be merged by the parent this object
     # will lookup in a internally maintained set of objects and
     # find which one of those objects can perform the merge. If
@@ -104,6 +161,14 @@ def dict_extract_mergers(config):
 
 
 def string_extract_mergers(merge_how):
+    parsed_mergers = _PARSED_MERGERS.get(merge_how)
+    if parsed_mergers is None:
+        parsed_mergers = _string_extract_mergers(merge_how)
+        _PARSED_MERGERS[merge_how] = parsed_mergers
+    return [(m_name, list(m_ops)) for (m_name, m_ops) in parsed_mergers]
+
+
+def _string_extract_mergers(merge_how):
     parsed_mergers = []
     for m_name in merge_how.split("+"):
         # Canonicalize the name (so that it can be found
@@ -129,6 +194,25 @@ def default_mergers():
 
 
 def construct(parsed_mergers):
+    """Return a merger for parsed_mergers.
+
+    Mergers keep no state between merges, so one merger is built for each
+    distinct parsed_mergers and then reused.
+    """
+    try:
+        key = tuple((m_name, tuple(m_ops)) for (m_name, m_ops)
+                    in parsed_mergers)
+        hash(key)
+    except TypeError:
+        return _construct(parsed_mergers)
+    merger = _CONSTRUCTED_MERGERS.get(key)
+    if merger is None:
+        merger = _construct(parsed_mergers)
+        _CONSTRUCTED_MERGERS[key] = merger
+    return merger
+
+
+def _construct(parsed_mergers):
     mergers_to_be = []
     for (m_name, m_ops) in parsed_mergers:
         if not m_name.startswith(MERGER_PREFIX):
@@ -42,24 +42,26 @@ class Merger(object):
 
     def _do_dict_replace(self, value, merge_with, do_replace):
 
-        def merge_same_key(old_v, new_v):
+        def recurse(new_v):
             if do_replace:
-                return new_v
+                return False
             if isinstance(new_v, (list, tuple)) and self._recurse_array:
-                return self._merger.merge(old_v, new_v)
+                return True
             if isinstance(new_v, six.string_types) and self._recurse_str:
-                return self._merger.merge(old_v, new_v)
+                return True
             if isinstance(new_v, (dict)) and self._recurse_dict:
-                return self._merger.merge(old_v, new_v)
-            # Otherwise leave it be...
-            return old_v
+                return True
+            return False
 
         for (k, v) in merge_with.items():
             if k in value:
                 if v is None and self._allow_delete:
                     value.pop(k)
-                else:
-                    value[k] = merge_same_key(value[k], v)
+                elif do_replace:
+                    value[k] = v
+                elif recurse(v):
+                    self._merger.merge_later(value, k, value[k], v)
+                # Otherwise leave it be...
             else:
                 value[k] = v
         return value
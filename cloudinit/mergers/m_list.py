@@ -39,7 +39,10 @@ class Merger(object):
                                                         self._recurse_array)
 
     def _on_tuple(self, value, merge_with):
-        return tuple(self._on_list(list(value), merge_with))
+        # Nested merges must be done before conversion. Tuples never come
+        # from yaml, so resolving them right away does not recurse deeply.
+        return tuple(self._merger.resolve(
+            self._on_list, list(value), merge_with))
 
     def _on_list(self, value, merge_with):
         if (self._method == 'replace' and
@@ -57,23 +60,27 @@ class Merger(object):
             merged_list.extend(merge_with)
             return merged_list
 
-        def merge_same_index(old_v, new_v):
-            if self._method == 'no_replace':
-                # Leave it be...
-                return old_v
+        def recurse(new_v):
             if isinstance(new_v, (list, tuple)) and self._recurse_array:
-                return self._merger.merge(old_v, new_v)
+                return True
             if isinstance(new_v, six.string_types) and self._recurse_str:
-                return self._merger.merge(old_v, new_v)
+                return True
             if isinstance(new_v, (dict)) and self._recurse_dict:
-                return self._merger.merge(old_v, new_v)
-            return new_v
+                return True
+            return False
 
         # Ok now we are replacing same indexes
         merged_list.extend(value)
+        if self._method == 'no_replace':
+            # Leave them be...
+            return merged_list
         common_len = min(len(merged_list), len(merge_with))
         for i in range(0, common_len):
-            merged_list[i] = merge_same_index(merged_list[i], merge_with[i])
+            if recurse(merge_with[i]):
+                self._merger.merge_later(
+                    merged_list, i, merged_list[i], merge_with[i])
+            else:
+                merged_list[i] = merge_with[i]
         return merged_list
 
 # vi: ts=4 expandtab
@@ -5,15 +5,17 @@
 #
 # This file is part of cloud-init. See LICENSE file for license information.
 
+import contextlib
 import errno
 import logging
 import os
 import re
+from collections import OrderedDict
 from functools import partial
 
 from cloudinit.net.network_state import mask_to_net_prefix
 from cloudinit import util
-from cloudinit.url_helper import UrlError, readurl
+from cloudinit.url_helper import UrlError, close_pooled_sessions, readurl
 
 LOG = logging.getLogger(__name__)
 SYS_CLASS_NET = "/sys/class/net/"
@@ -364,22 +366,23 @@ def find_fallback_nic_on_linux(blacklist_drivers=None):
     if not blacklist_drivers:
         blacklist_drivers = []
 
+    snapshot = get_net_device_snapshot()
     if 'net.ifnames=0' in util.get_cmdline():
         LOG.debug('Stable ifnames disabled by net.ifnames=0 in /proc/cmdline')
     else:
-        unstable = [device for device in get_devicelist()
-                    if device != 'lo' and not is_renamed(device)]
+        unstable = [name for name, dev in snapshot.devices.items()
+                    if name != 'lo' and not dev.is_renamed]
         if len(unstable):
             LOG.debug('Found unstable nic names: %s; calling udevadm settle',
                       unstable)
             msg = 'Waiting for udev events to settle'
             util.log_time(LOG.debug, msg, func=util.udevadm_settle)
+            snapshot.invalidate()
 
     # get list of interfaces that could have connections
     invalid_interfaces = set(['lo'])
-    potential_interfaces = set([device for device in get_devicelist()
-                                if device_driver(device) not in
-                                blacklist_drivers])
+    potential_interfaces = set([name for name, dev in snapshot.devices.items()
+                                if dev.driver not in blacklist_drivers])
     potential_interfaces = potential_interfaces.difference(invalid_interfaces)
     # sort into interfaces with carrier, interfaces which could have carrier,
     # and ignore interfaces that are definitely disconnected
@@ -388,13 +391,14 @@ def find_fallback_nic_on_linux(blacklist_drivers=None):
     for interface in potential_interfaces:
         if interface.startswith("veth"):
             continue
-        if is_bridge(interface):
+        dev = snapshot.devices[interface]
+        if dev.is_bridge:
             # skip any bridges
             continue
-        if is_bond(interface):
+        if dev.is_bond:
             # skip any bonds
             continue
-        if is_netfailover(interface):
+        if dev.is_netfailover:
             # ignore netfailover primary/standby interfaces
             continue
         carrier = read_sys_net_int(interface, 'carrier')
@@ -537,6 +541,7 @@ def wait_for_physdevs(netcfg, strict=True):
             util.log_time(LOG.debug, msg, func=settle)
 
         # update present_macs after settles
+        invalidate_net_device_snapshot()
         present_macs = get_interfaces_by_mac().keys()
 
     msg = 'Not all expected physical devices present: %s' % missing
@@ -767,6 +772,7 @@ def _rename_interfaces(renames, strict_present=True, strict_busy=True,
                 errors.append(
                     "[unknown] Error performing %s%s for %s, %s: %s" %
                     (op, params, mac, new_name, e))
+        invalidate_net_device_snapshot()
 
     if len(errors):
         raise Exception('\n'.join(errors))
@@ -835,7 +841,8 @@ def get_interfaces_by_mac_on_linux():
 
     Bridges and any devices that have a 'stolen' mac are excluded."""
     ret = {}
-    for name, mac, _driver, _devid in get_interfaces():
+    snapshot = get_net_device_snapshot()
+    for name, mac, _driver, _devid in snapshot.interfaces():
         if mac in ret:
             raise RuntimeError(
                 "duplicate mac found! both '%s' and '%s' have mac '%s'" %
@@ -843,7 +850,7 @@ def get_interfaces_by_mac_on_linux():
         ret[mac] = name
         # Try to get an Infiniband hardware address (in 6 byte Ethernet format)
         # for the interface.
-        ib_mac = get_ib_interface_hwaddr(name, True)
+        ib_mac = snapshot.devices[name].ib_hwaddr(True)
         if ib_mac:
             if ib_mac in ret:
                 raise RuntimeError(
@@ -853,44 +860,178 @@ def get_interfaces_by_mac_on_linux():
     return ret
 
 
+class NetDevice(object):
+    """The sysfs attributes of a net device, each read at most once.
+
+    Attributes are read through the module's sysfs helpers on first access
+    and remembered for the lifetime of the owning NetDeviceSnapshot.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._attrs = {}
+
+    def _read(self, attr, func, *args, **kwargs):
+        try:
+            return self._attrs[attr]
+        except KeyError:
+            value = self._attrs[attr] = func(self.name, *args, **kwargs)
+            return value
+
+    @property
+    def has_own_mac(self):
+        return self._read('has_own_mac', interface_has_own_mac)
+
+    @property
+    def is_bridge(self):
+        return self._read('is_bridge', is_bridge)
+
+    @property
+    def is_bond(self):
+        return self._read('is_bond', is_bond)
+
+    @property
+    def is_vlan(self):
+        return self._read('is_vlan', is_vlan)
+
+    @property
+    def master(self):
+        return self._read('master', get_master)
+
+    @property
+    def master_is_bridge_or_bond(self):
+        return self._read('master_is_bridge_or_bond', master_is_bridge_or_bond)
+
+    @property
+    def driver(self):
+        return self._read('driver', device_driver)
+
+    @property
+    def device_id(self):
+        return self._read('device_id', device_devid)
+
+    @property
+    def is_netfailover(self):
+        return self._read('is_netfailover', is_netfailover)
+
+    @property
+    def is_renamed(self):
+        return self._read('is_renamed', is_renamed)
+
+    @property
+    def mac(self):
+        return self._read('mac', get_interface_mac)
+
+    def ib_hwaddr(self, ethernet_format):
+        return self._read(('ib_hwaddr', ethernet_format),
+                          get_ib_interface_hwaddr, ethernet_format)
+
+
+class NetDeviceSnapshot(object):
+    """The net devices present and their sysfs attributes.
+
+    The device list is read on first use and each device attribute at most
+    once, so that device discovery helpers sharing a snapshot do not walk
+    /sys/class/net over and over. Link state such as carrier or operstate
+    is not part of the snapshot. Call invalidate() once devices may have
+    been added, removed or renamed.
+    """
+
+    def __init__(self):
+        self._devices = None
+
+    @property
+    def devices(self):
+        """OrderedDict of NetDevice by device name."""
+        if self._devices is None:
+            self._devices = OrderedDict(
+                (name, NetDevice(name)) for name in get_devicelist())
+        return self._devices
+
+    def invalidate(self):
+        """Forget all devices, re-reading them on next use."""
+        self._devices = None
+
+    def interfaces(self):
+        """Return list of interface tuples (name, mac, driver, device_id)
+
+        Bridges and any devices that have a 'stolen' mac are excluded."""
+        ret = []
+        # 16 somewhat arbitrarily chosen.  Normally a mac is 6 '00:' tokens.
+        zero_mac = ':'.join(('00',) * 16)
+        for name, dev in self.devices.items():
+            if not dev.has_own_mac:
+                continue
+            if dev.is_bridge:
+                continue
+            if dev.is_vlan:
+                continue
+            if dev.is_bond:
+                continue
+            if dev.master is not None and not dev.master_is_bridge_or_bond:
+                continue
+            if dev.is_netfailover:
+                continue
+            mac = dev.mac
+            # some devices may not have a mac (tun0)
+            if not mac:
+                continue
+            # skip nics that have no mac (00:00....)
+            if name != 'lo' and mac == zero_mac[:len(mac)]:
+                continue
+            ret.append((name, mac, dev.driver, dev.device_id))
+        return ret
+
+
+_ACTIVE_SNAPSHOT = None
+
+
+@contextlib.contextmanager
+def net_device_snapshot():
+    """Share one NetDeviceSnapshot among device discovery in this context.
+
+    Nested contexts share the outermost snapshot.
+    """
+    global _ACTIVE_SNAPSHOT
+    if _ACTIVE_SNAPSHOT is not None:
+        yield _ACTIVE_SNAPSHOT
+        return
+    _ACTIVE_SNAPSHOT = NetDeviceSnapshot()
+    try:
+        yield _ACTIVE_SNAPSHOT
+    finally:
+        _ACTIVE_SNAPSHOT = None
+
+
+def get_net_device_snapshot():
+    """Return the shared snapshot when in net_device_snapshot() or a new one.
+    """
+    if _ACTIVE_SNAPSHOT is not None:
+        return _ACTIVE_SNAPSHOT
+    return NetDeviceSnapshot()
+
+
+def invalidate_net_device_snapshot():
+    """Invalidate the shared snapshot after devices changed or were renamed.
+    """
+    if _ACTIVE_SNAPSHOT is not None:
+        _ACTIVE_SNAPSHOT.invalidate()
+
+
 def get_interfaces():
     """Return list of interface tuples (name, mac, driver, device_id)
 
     Bridges and any devices that have a 'stolen' mac are excluded."""
-    ret = []
-    devs = get_devicelist()
-    # 16 somewhat arbitrarily chosen.  Normally a mac is 6 '00:' tokens.
-    zero_mac = ':'.join(('00',) * 16)
-    for name in devs:
-        if not interface_has_own_mac(name):
-            continue
-        if is_bridge(name):
-            continue
-        if is_vlan(name):
-            continue
-        if is_bond(name):
-            continue
-        if get_master(name) is not None and not master_is_bridge_or_bond(name):
-            continue
-        if is_netfailover(name):
-            continue
-        mac = get_interface_mac(name)
-        # some devices may not have a mac (tun0)
-        if not mac:
-            continue
-        # skip nics that have no mac (00:00....)
-        if name != 'lo' and mac == zero_mac[:len(mac)]:
-            continue
-        ret.append((name, mac, device_driver(name), device_devid(name)))
-    return ret
+    return get_net_device_snapshot().interfaces()
 
 
 def get_ib_hwaddrs_by_interface():
     """Build a dictionary mapping Infiniband interface names to their hardware
     address."""
     ret = {}
-    for name, _, _, _ in get_interfaces():
-        ib_mac = get_ib_interface_hwaddr(name, False)
+    snapshot = get_net_device_snapshot()
+    for name, _, _, _ in snapshot.interfaces():
+        ib_mac = snapshot.devices[name].ib_hwaddr(False)
         if ib_mac:
             if ib_mac in ret:
                 raise RuntimeError(
@@ -991,6 +1132,8 @@ class EphemeralIPv4Network(object):
         """Teardown anything we set up."""
         for cmd in self.cleanup_cmds:
             util.subp(cmd, capture=True)
+        # Connections made over the ephemeral network are no longer usable
+        close_pooled_sessions()
 
     def _delete_address(self, address, prefix):
         """Perform the ip command to remove the specified address."""
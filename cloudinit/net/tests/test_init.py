@@ -511,6 +511,73 @@ class TestGetInterfaceMAC(CiTestCase):
         self.assertEqual(['eth1', 'eth2'], sorted(interface_names))
 
 
+class TestNetDeviceSnapshot(CiTestCase):
+
+    def setUp(self):
+        super(TestNetDeviceSnapshot, self).setUp()
+        sys_mock = mock.patch('cloudinit.net.get_sys_class_path')
+        self.m_sys_path = sys_mock.start()
+        self.sysdir = self.tmp_dir() + '/'
+        self.m_sys_path.return_value = self.sysdir
+        self.addCleanup(sys_mock.stop)
+        write_file(os.path.join(self.sysdir, 'eth0', 'addr_assign_type'), '0')
+        write_file(
+            os.path.join(self.sysdir, 'eth0', 'address'), 'aa:bb:cc:aa:bb:cc')
+
+    def test_attributes_are_read_once(self):
+        """Device attributes are read once per snapshot."""
+        snapshot = net.NetDeviceSnapshot()
+        with mock.patch('cloudinit.net.get_interface_mac',
+                        return_value='aa:bb:cc:aa:bb:cc') as m_mac:
+            snapshot.interfaces()
+            snapshot.interfaces()
+        self.assertEqual(1, m_mac.call_count)
+
+    def test_invalidate_rereads_devices(self):
+        """After invalidate the snapshot reflects current devices."""
+        snapshot = net.NetDeviceSnapshot()
+        self.assertEqual(['eth0'], list(snapshot.devices))
+        write_file(os.path.join(self.sysdir, 'eth1', 'address'), 'mac1')
+        self.assertEqual(['eth0'], list(snapshot.devices))
+        snapshot.invalidate()
+        self.assertEqual(['eth0', 'eth1'], sorted(snapshot.devices))
+
+    def test_context_shares_snapshot_with_discovery(self):
+        """Discovery helpers share the snapshot of net_device_snapshot."""
+        self.assertIsNot(
+            net.get_net_device_snapshot(), net.get_net_device_snapshot())
+        with net.net_device_snapshot() as snapshot:
+            self.assertIs(snapshot, net.get_net_device_snapshot())
+            with net.net_device_snapshot() as nested:
+                self.assertIs(snapshot, nested)
+            self.assertEqual(
+                {'aa:bb:cc:aa:bb:cc': 'eth0'}, net.get_interfaces_by_mac())
+            write_file(os.path.join(self.sysdir, 'eth1', 'addr_assign_type'),
+                       '0')
+            write_file(
+                os.path.join(self.sysdir, 'eth1', 'address'),
+                'dd:ee:ff:dd:ee:ff')
+            self.assertEqual(['eth0'], [i[0] for i in net.get_interfaces()])
+            net.invalidate_net_device_snapshot()
+            self.assertEqual(
+                ['eth0', 'eth1'], sorted(i[0] for i in net.get_interfaces()))
+        self.assertIsNot(snapshot, net.get_net_device_snapshot())
+
+    @mock.patch('cloudinit.net.util.subp')
+    def test_rename_invalidates_snapshot(self, m_subp):
+        """Renaming interfaces invalidates the shared snapshot."""
+        with net.net_device_snapshot() as snapshot:
+            self.assertEqual(['eth0'], list(snapshot.devices))
+            os.rename(os.path.join(self.sysdir, 'eth0'),
+                      os.path.join(self.sysdir, 'ens3'))
+            net._rename_interfaces(
+                [('aa:bb:cc:aa:bb:cc', 'ens3', None, None)],
+                current_info={'eth0': {
+                    'downable': True, 'device_id': None, 'driver': None,
+                    'mac': 'aa:bb:cc:aa:bb:cc', 'name': 'eth0', 'up': False}})
+            self.assertEqual(['ens3'], list(snapshot.devices))
+
+
 class TestInterfaceHasOwnMAC(CiTestCase):
 
     def setUp(self):
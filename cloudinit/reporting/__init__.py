@@ -9,6 +9,8 @@ The reporting framework is intended to allow all parts of cloud-init to
 report events in a structured manner.
 """
 
+import copy
+
 from ..registry import DictRegistry
 from .handlers import available_handlers
 
@@ -23,18 +25,38 @@ def update_configuration(config):
     :param config:
         The dictionary containing changes to apply.  If a key is given
         with a False-ish value, the registered handler matching that name
-        will be unregistered.
+        will be unregistered.  A handler whose config is unchanged is kept,
+        replaced and unregistered handlers are closed.
     """
     for handler_name, handler_config in config.items():
         if not handler_config:
+            _close_handler(handler_name)
             instantiated_handler_registry.unregister_item(
                 handler_name, force=True)
             continue
+        registered = instantiated_handler_registry.registered_items.get(
+            handler_name)
+        if (registered is not None and
+                _handler_configs.get(handler_name) == (
+                    registered, handler_config)):
+            continue
+        applied_config = copy.deepcopy(handler_config)
         handler_config = handler_config.copy()
         cls = available_handlers.registered_items[handler_config.pop('type')]
+        _close_handler(handler_name)
         instantiated_handler_registry.unregister_item(handler_name)
         instance = cls(**handler_config)
         instantiated_handler_registry.register_item(handler_name, instance)
+        _handler_configs[handler_name] = (instance, applied_config)
+
+
+def _close_handler(handler_name):
+    """Close the handler registered as handler_name, if any."""
+    _handler_configs.pop(handler_name, None)
+    handler = instantiated_handler_registry.registered_items.get(
+        handler_name)
+    if handler is not None and hasattr(handler, 'close'):
+        handler.close()
 
 
 def flush_events():
@@ -43,6 +65,8 @@ def flush_events():
             handler.flush()
 
 
+# Handler instance and config applied by update_configuration, by name
+_handler_configs = {}
 instantiated_handler_registry = DictRegistry()
 update_configuration(DEFAULT_CONFIG)
 
@@ -9,7 +9,9 @@ The events here are designed to be used with reporting.
 They can be published to registered handlers with report_event.
 """
 import base64
+import os
 import os.path
+import threading
 import time
 
 from . import instantiated_handler_registry
@@ -29,6 +31,16 @@ class _nameset(set):
 
 status = _nameset(("SUCCESS", "WARN", "FAIL"))
 
+try:
+    monotonic = time.monotonic
+    process_time = time.process_time
+except AttributeError:  # python 2
+    monotonic = time.time
+
+    def process_time():
+        times = os.times()
+        return times[0] + times[1]
+
 
 class ReportingEvent(object):
     """Encapsulation of event formatting."""
@@ -58,10 +70,12 @@ class ReportingEvent(object):
 class FinishReportingEvent(ReportingEvent):
 
     def __init__(self, name, description, result=status.SUCCESS,
-                 post_files=None):
+                 post_files=None, span=None):
         super(FinishReportingEvent, self).__init__(
             FINISH_EVENT_TYPE, name, description)
         self.result = result
+        # Timing of the finished ReportEventStack, see ReportEventStack.span
+        self.span = span
         if post_files is None:
             post_files = []
         self.post_files = post_files
@@ -96,13 +110,13 @@ def report_event(event):
 
 
 def report_finish_event(event_name, event_description,
-                        result=status.SUCCESS, post_files=None):
+                        result=status.SUCCESS, post_files=None, span=None):
     """Report a "finish" event.
 
     See :py:func:`.report_event` for parameter details.
     """
     event = FinishReportingEvent(event_name, event_description, result,
-                                 post_files=post_files)
+                                 post_files=post_files, span=span)
     return report_event(event)
 
 
@@ -177,6 +191,7 @@ class ReportEventStack(object):
         else:
             self.fullname = self.name
         self.children = {}
+        self._start = None
 
     def __repr__(self):
         return ("ReportEventStack(%s, %s, reporting_enabled=%s)" %
@@ -186,6 +201,7 @@ class ReportEventStack(object):
         self.result = status.SUCCESS
         if self.reporting_enabled:
             report_start_event(self.fullname, self.description)
+            self._start = (time.time(), monotonic(), process_time())
         if self.parent:
             self.parent.children[self.name] = (None, None)
         return self
@@ -229,7 +245,30 @@ class ReportEventStack(object):
             self.parent.children[self.name] = (result, msg)
         if self.reporting_enabled:
             report_finish_event(self.fullname, msg, result,
-                                post_files=self.post_files)
+                                post_files=self.post_files, span=self.span())
+
+    def span(self):
+        """Return a dict of the timing of this stack since it was entered.
+
+        The span holds the wall clock timestamp, monotonic start and duration
+        in seconds, the process CPU seconds spent, the pid, thread id and
+        stage of the stack, and the fullname and description of the stack
+        and of its parent.
+        """
+        if self._start is None:
+            return None
+        (timestamp, start, cpu_start) = self._start
+        return {
+            'name': self.fullname,
+            'description': self.description,
+            'parent': self.parent.fullname if self.parent else None,
+            'stage': self.fullname.split('/', 1)[0],
+            'timestamp': timestamp,
+            'start': start,
+            'duration': monotonic() - start,
+            'cpu_time': process_time() - cpu_start,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident}
 
 
 def _collect_file_info(files):
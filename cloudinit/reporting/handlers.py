@@ -4,12 +4,14 @@ import abc
 import uuid
 import fcntl
 import json
+import mmap
 import six
 import os
 import struct
 import threading
 import time
 
+from collections import OrderedDict, deque
 from cloudinit import log as logging
 from cloudinit.registry import DictRegistry
 from cloudinit import (url_helper, util)
@@ -44,6 +46,10 @@ class ReportingHandler(object):
         """Ensure ReportingHandler has published all events"""
         pass
 
+    def close(self):
+        """Flush events before the handler is unregistered."""
+        self.flush()
+
 
 class LogHandler(ReportingHandler):
     """Publishes events to the cloud-init log at the ``DEBUG`` log level."""
@@ -75,9 +81,34 @@ class PrintHandler(ReportingHandler):
 
 
 class WebHookHandler(ReportingHandler):
+    """Posts events as json to a web hook endpoint.
+
+    By default each event is posted as it is published. With batch_events,
+    events are queued and posted by a background thread as a json list of
+    events, so that a slow or unreachable endpoint does not delay boot.
+    """
+
+    # Seconds to sleep before the first retry of a batch, doubled on each
+    # further retry up to MAX_RETRY_DELAY
+    RETRY_DELAY = 1
+    MAX_RETRY_DELAY = 30
+
     def __init__(self, endpoint, consumer_key=None, token_key=None,
                  token_secret=None, consumer_secret=None, timeout=None,
-                 retries=None):
+                 retries=None, batch_events=False, batch_interval=1.0,
+                 batch_size=100, max_queue_size=1000, flush_timeout=10.0):
+        """
+        @param batch_events: When True, post events in batches from a
+            background thread instead of posting each event on publish.
+        @param batch_interval: Seconds to collect events for a batch before
+            posting it.
+        @param batch_size: Post a batch as soon as it holds this many
+            events.
+        @param max_queue_size: Most events to queue. Events published while
+            the queue is full are dropped and counted in dropped_events.
+        @param flush_timeout: Most seconds flush waits for queued events to
+            be posted.
+        """
         super(WebHookHandler, self).__init__()
 
         if any([consumer_key, token_key, token_secret, consumer_secret]):
@@ -90,20 +121,215 @@ class WebHookHandler(ReportingHandler):
         self.timeout = timeout
         self.retries = retries
         self.ssl_details = util.fetch_ssl_details()
-
-    def publish_event(self, event):
+        self.batch_events = batch_events
+        self.batch_interval = batch_interval
+        self.batch_size = max(int(batch_size), 1)
+        self.max_queue_size = max_queue_size
+        self.flush_timeout = flush_timeout
+        self.posted_events = 0
+        self.failed_events = 0
+        self.dropped_events = 0
+        if batch_events:
+            self._queue = deque()
+            self._pending = 0  # Events queued or being posted
+            self._flushing = 0
+            self._closed = False
+            self._cond = threading.Condition()
+            self.publish_thread = threading.Thread(
+                target=self._publish_batch_routine)
+            self.publish_thread.daemon = True
+            self.publish_thread.start()
+
+    def _readurl(self, data, retries):
         if self.oauth_helper:
             readurl = self.oauth_helper.readurl
         else:
             readurl = url_helper.readurl
+        return readurl(
+            self.endpoint, data=data, timeout=self.timeout,
+            retries=retries, ssl_details=self.ssl_details)
+
+    def publish_event(self, event):
+        if self.batch_events:
+            return self._queue_event(event)
         try:
-            return readurl(
-                self.endpoint, data=json.dumps(event.as_dict()),
-                timeout=self.timeout,
-                retries=self.retries, ssl_details=self.ssl_details)
+            return self._readurl(json.dumps(event.as_dict()), self.retries)
         except Exception:
             LOG.warning("failed posting event: %s", event.as_string())
 
+    def _queue_event(self, event):
+        with self._cond:
+            if self._closed:
+                LOG.warning("webhook for %s closed, dropping event: %s",
+                            self.endpoint, event.as_string())
+                self.dropped_events += 1
+                return
+            if len(self._queue) >= self.max_queue_size:
+                if not self.dropped_events:
+                    LOG.warning(
+                        "webhook queue full, dropping events for %s",
+                        self.endpoint)
+                self.dropped_events += 1
+                return
+            self._queue.append(event)
+            self._pending += 1
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _next_batch(self):
+        """Block until a batch is due and return its events.
+
+        @return: The events of the batch, or None once the handler was
+            closed and no events are left.
+        """
+        with self._cond:
+            while not self._queue:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            deadline = time.time() + self.batch_interval
+            while (len(self._queue) < self.batch_size and
+                   not self._flushing and not self._closed):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [self._queue.popleft()
+                    for _ in range(min(self.batch_size, len(self._queue)))]
+
+    def _post_batch(self, batch):
+        """Post batch as a json list, retrying with exponential backoff."""
+        data = json.dumps([event.as_dict() for event in batch])
+        retries = 3 if self.retries is None else self.retries
+        delay = self.RETRY_DELAY
+        for attempt in range(retries + 1):
+            try:
+                self._readurl(data, retries=0)
+                return True
+            except Exception as e:
+                if attempt == retries:
+                    LOG.warning(
+                        "failed posting %d events to %s: %s",
+                        len(batch), self.endpoint, e)
+                    return False
+            time.sleep(delay)
+            delay = min(delay * 2, self.MAX_RETRY_DELAY)
+
+    def _publish_batch_routine(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            posted = self._post_batch(batch)
+            with self._cond:
+                if posted:
+                    self.posted_events += len(batch)
+                else:
+                    self.failed_events += len(batch)
+                self._pending -= len(batch)
+                self._cond.notify_all()
+
+    def flush(self):
+        """Post queued events, waiting at most flush_timeout seconds."""
+        if not self.batch_events:
+            return
+        deadline = time.time() + self.flush_timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._pending:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        LOG.warning(
+                            "%d events not posted to %s within %s seconds",
+                            self._pending, self.endpoint, self.flush_timeout)
+                        break
+                    self._cond.wait(remaining)
+            finally:
+                self._flushing -= 1
+        if self.dropped_events or self.failed_events:
+            LOG.warning(
+                "webhook %s: %d events posted, %d failed, %d dropped",
+                self.endpoint, self.posted_events, self.failed_events,
+                self.dropped_events)
+
+    def close(self):
+        """Flush queued events and stop the background thread.
+
+        Events still queued when flush_timeout expires are posted by the
+        thread before it stops, as long as the process is running.
+        """
+        if not self.batch_events:
+            return
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class TraceHandler(ReportingHandler):
+    """Appends the spans of finished event stacks to a trace file.
+
+    The trace file is a Chrome trace-event json array of complete events,
+    which trace viewers and 'cloud-init analyze' load. Each cloud-init stage
+    appends its events, so the array is left unterminated as the trace-event
+    format allows. Timestamps and durations are monotonic microseconds, and
+    the args of each event hold the wall clock timestamp, description,
+    result, stage, parent and CPU seconds of the event stack. Monotonic
+    time restarts on each boot, so the args also hold the boot id.
+    """
+
+    TRACE_FILE = '/var/log/cloud-init-trace.json'
+    BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+
+    def __init__(self, trace_file=TRACE_FILE):
+        super(TraceHandler, self).__init__()
+        self.trace_file = trace_file
+        self.boot_id = util.load_file(self.BOOT_ID_FILE, quiet=True).strip()
+        self._named_pids = set()
+
+    def _trace_events(self, event):
+        span = event.span
+        trace_events = []
+        if span['pid'] not in self._named_pids:
+            self._named_pids.add(span['pid'])
+            trace_events.append({
+                'name': 'process_name', 'ph': 'M', 'pid': span['pid'],
+                'tid': span['tid'],
+                'args': {'name': 'cloud-init %s' % span['stage']}})
+        trace_events.append({
+            'name': span['name'], 'cat': event.origin, 'ph': 'X',
+            'ts': round(span['start'] * 1e6, 3),
+            'dur': round(span['duration'] * 1e6, 3),
+            'pid': span['pid'], 'tid': span['tid'],
+            'args': {
+                'timestamp': span['timestamp'], 'boot_id': self.boot_id,
+                'description': span['description'],
+                'result': event.result, 'stage': span['stage'],
+                'parent': span['parent'],
+                'cpu_time': round(span['cpu_time'], 6)}})
+        return trace_events
+
+    def publish_event(self, event):
+        if getattr(event, 'span', None) is None:
+            return  # Only finished event stacks are traced
+        data = ''.join(
+            json.dumps(trace_event, separators=(',', ':'), sort_keys=True) +
+            ',\n' for trace_event in self._trace_events(event))
+        try:
+            with open(self.trace_file, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0, os.SEEK_END)
+                if not f.tell():
+                    data = '[\n' + data
+                f.write(data)
+                f.flush()
+                fcntl.flock(f, fcntl.LOCK_UN)
+        except (OSError, IOError) as e:
+            LOG.warning("failed writing trace event to %s: %s",
+                        self.trace_file, e)
+
 
 class HyperVKvpReportingHandler(ReportingHandler):
     """
@@ -125,6 +351,7 @@ class HyperVKvpReportingHandler(ReportingHandler):
     HV_KVP_RECORD_SIZE = (HV_KVP_EXCHANGE_MAX_KEY_SIZE +
                           HV_KVP_EXCHANGE_MAX_VALUE_SIZE)
     EVENT_PREFIX = 'CLOUD_INIT'
+    BATCH_EVENT_TYPE = 'batch'
     MSG_KEY = 'msg'
     RESULT_KEY = 'result'
     DESC_IDX_KEY = 'msg_i'
@@ -134,13 +361,30 @@ class HyperVKvpReportingHandler(ReportingHandler):
 
     def __init__(self,
                  kvp_file_path=KVP_POOL_FILE_GUEST,
-                 event_types=None):
+                 event_types=None,
+                 aggregate_events=False,
+                 max_pool_records=None):
+        """
+        @param aggregate_events: When True, events of the same stage which
+            are published together are coalesced into records holding a json
+            list of events, instead of one record per event.
+        @param max_pool_records: Optional cap on the number of records in
+            the pool file. Once reached, the oldest cloud-init records are
+            evicted to make room for new ones. Records written by other
+            producers are never evicted.
+        """
         super(HyperVKvpReportingHandler, self).__init__()
         self._kvp_file_path = kvp_file_path
         HyperVKvpReportingHandler._truncate_guest_pool_file(
             self._kvp_file_path)
 
         self._event_types = event_types
+        self._aggregate_events = aggregate_events
+        self._max_pool_records = max_pool_records
+        self._record_struct = struct.Struct("%ds%ds" % (
+            self.HV_KVP_EXCHANGE_MAX_KEY_SIZE,
+            self.HV_KVP_EXCHANGE_MAX_VALUE_SIZE))
+        self._batch_key_prefixes = {}
         self.q = JQueue()
         self.incarnation_no = self._get_incarnation_no()
         self.event_key_prefix = u"{0}|{1}".format(self.EVENT_PREFIX,
@@ -231,14 +475,47 @@ class HyperVKvpReportingHandler(ReportingHandler):
         return {'key': k, 'value': v}
 
     def _append_kvp_item(self, record_data):
-        with open(self._kvp_file_path, 'ab') as f:
+        with open(self._kvp_file_path, 'a+b') as f:
             fcntl.flock(f, fcntl.LOCK_EX)
+            if self._max_pool_records:
+                new_records = (sum(len(data) for data in record_data) //
+                               self.HV_KVP_RECORD_SIZE)
+                self._evict_kvp_items(f, new_records)
             for data in record_data:
                 f.write(data)
             f.flush()
             fcntl.flock(f, fcntl.LOCK_UN)
 
-    def _break_down(self, key, meta_data, description):
+    def _evict_kvp_items(self, f, new_records):
+        """
+        Drop the oldest cloud-init records from the locked pool file f so
+        that new_records more fit within max_pool_records.
+        """
+        f.seek(0)
+        pool_data = f.read()
+        record_count = len(pool_data) // self.HV_KVP_RECORD_SIZE
+        excess = record_count + new_records - self._max_pool_records
+        if excess <= 0:
+            return
+        cloud_init_key = (self.EVENT_PREFIX + '|').encode('utf-8')
+        kept = []
+        evicted = 0
+        for idx in range(record_count):
+            offset = idx * self.HV_KVP_RECORD_SIZE
+            record = pool_data[offset:offset + self.HV_KVP_RECORD_SIZE]
+            if evicted < excess and record.startswith(cloud_init_key):
+                evicted += 1
+                continue
+            kept.append(record)
+        if not evicted:
+            return
+        LOG.debug("Evicting %d cloud-init records from kvp pool file %s",
+                  evicted, self._kvp_file_path)
+        kept.append(pool_data[record_count * self.HV_KVP_RECORD_SIZE:])
+        f.truncate(0)
+        f.write(b''.join(kept))
+
+    def _break_down_values(self, meta_data, description):
         del meta_data[self.MSG_KEY]
         des_in_json = json.dumps(description)
         des_in_json = des_in_json[1:(len(des_in_json) - 1)]
@@ -257,20 +534,18 @@ class HyperVKvpReportingHandler(ReportingHandler):
                 message_place_holder,
                 '"{key}":"{desc}"'.format(
                     key=self.MSG_KEY, desc=des_in_json[:room_for_desc]))
-            result_array.append(self._encode_kvp_item(key, value))
+            result_array.append(value)
             i += 1
             des_in_json = des_in_json[room_for_desc:]
             if len(des_in_json) == 0:
                 break
         return result_array
 
-    def _encode_event(self, event):
-        """
-        encode the event into kvp data bytes.
-        if the event content reaches the maximum length of kvp value.
-        then it would be cut to multiple slices.
-        """
-        key = self._event_key(event)
+    def _break_down(self, key, meta_data, description):
+        return [self._encode_kvp_item(key, value)
+                for value in self._break_down_values(meta_data, description)]
+
+    def _event_meta_data(self, event):
         meta_data = {
                 "name": event.name,
                 "type": event.event_type,
@@ -280,6 +555,16 @@ class HyperVKvpReportingHandler(ReportingHandler):
         if hasattr(event, self.RESULT_KEY):
             meta_data[self.RESULT_KEY] = event.result
         meta_data[self.MSG_KEY] = event.description
+        return meta_data
+
+    def _encode_event(self, event):
+        """
+        encode the event into kvp data bytes.
+        if the event content reaches the maximum length of kvp value.
+        then it would be cut to multiple slices.
+        """
+        key = self._event_key(event)
+        meta_data = self._event_meta_data(event)
         value = json.dumps(meta_data, separators=self.JSON_SEPARATORS)
         # if it reaches the maximum length of kvp value,
         # break it down to slices.
@@ -290,15 +575,85 @@ class HyperVKvpReportingHandler(ReportingHandler):
             data = self._encode_kvp_item(key, value)
             return [data]
 
+    def _batch_key(self, stage):
+        """
+        the batch key format is:
+        CLOUD_INIT|<incarnation number>|batch|<stage>|<uuid>
+        """
+        key_prefix = self._batch_key_prefixes.get(stage)
+        if key_prefix is None:
+            key_prefix = u"{0}|{1}|{2}|".format(
+                self.event_key_prefix, self.BATCH_EVENT_TYPE,
+                stage).encode('utf-8')
+            self._batch_key_prefixes[stage] = key_prefix
+        return key_prefix + str(uuid.uuid4()).encode('utf-8')
+
+    def _encode_events_aggregated(self, events):
+        """
+        encode events into kvp data bytes, coalescing the events of each
+        stage (the first component of the event name) into records holding
+        a json list of events. All records are packed into a single buffer.
+        """
+        stage_events = OrderedDict()
+        for event in events:
+            stage = event.name.split('/', 1)[0]
+            stage_events.setdefault(stage, []).append(event)
+        items = []
+        for stage, batch in stage_events.items():
+            values = []
+            values_len = 0
+            for event in batch:
+                meta_data = self._event_meta_data(event)
+                value = json.dumps(meta_data, separators=self.JSON_SEPARATORS)
+                if len(value) + 2 > self.HV_KVP_EXCHANGE_MAX_VALUE_SIZE:
+                    # too large to share a record, slice it on its own.
+                    key = self._event_key(event).encode('utf-8')
+                    items.extend(
+                        (key, v.encode('utf-8')) for v in
+                        self._break_down_values(meta_data, event.description))
+                    continue
+                # account for the surrounding brackets and separating commas
+                if values_len + len(value) + len(values) + 2 > (
+                        self.HV_KVP_EXCHANGE_MAX_VALUE_SIZE):
+                    items.append((self._batch_key(stage),
+                                  self._join_values(values)))
+                    values = []
+                    values_len = 0
+                values.append(value)
+                values_len += len(value)
+            if values:
+                items.append((self._batch_key(stage),
+                              self._join_values(values)))
+        return [self._pack_kvp_items(items)]
+
+    def _join_values(self, values):
+        return (u"[" + u",".join(values) + u"]").encode('utf-8')
+
+    def _pack_kvp_items(self, items):
+        """pack (key, value) byte strings into one preallocated buffer."""
+        data = bytearray(len(items) * self.HV_KVP_RECORD_SIZE)
+        for idx, (key, value) in enumerate(items):
+            self._record_struct.pack_into(
+                data, idx * self.HV_KVP_RECORD_SIZE, key, value)
+        return data
+
+    def _encode_events(self, events):
+        if self._aggregate_events:
+            return self._encode_events_aggregated(events)
+        encoded_data = []
+        for event in events:
+            encoded_data += self._encode_event(event)
+        return encoded_data
+
     def _publish_event_routine(self):
         while True:
             items_from_queue = 0
             try:
                 event = self.q.get(block=True)
                 items_from_queue += 1
-                encoded_data = []
+                events_to_publish = []
                 while event is not None:
-                    encoded_data += self._encode_event(event)
+                    events_to_publish.append(event)
                     try:
                         # get all the rest of the events in the queue
                         event = self.q.get(block=False)
@@ -306,7 +661,8 @@ class HyperVKvpReportingHandler(ReportingHandler):
                     except QueueEmptyError:
                         event = None
                 try:
-                    self._append_kvp_item(encoded_data)
+                    self._append_kvp_item(
+                        self._encode_events(events_to_publish))
                 except (OSError, IOError) as e:
                     LOG.warning("failed posting events to kvp, %s", e)
                 finally:
@@ -329,10 +685,151 @@ class HyperVKvpReportingHandler(ReportingHandler):
         self.q.join()
 
 
+class HyperVKvpPool(object):
+    """
+    Memory-mapped view of a Hyper-V KVP pool file which indexes the
+    cloud-init records by incarnation number.
+
+    Building the index only scans record keys, and values are decoded on
+    demand. Looking up or pruning cloud-init records therefore decodes
+    only the matching records instead of every record in the pool file.
+
+    The pool file is locked while the pool is open. Use it as a context
+    manager:
+
+        with HyperVKvpPool(kvp_file_path) as pool:
+            for kvp in pool.records(max(pool.incarnations())):
+                ...
+    """
+    RECORD_SIZE = HyperVKvpReportingHandler.HV_KVP_RECORD_SIZE
+    KEY_SIZE = HyperVKvpReportingHandler.HV_KVP_EXCHANGE_MAX_KEY_SIZE
+    KEY_PREFIX = (HyperVKvpReportingHandler.EVENT_PREFIX + '|').encode('utf-8')
+
+    def __init__(self,
+                 kvp_file_path=HyperVKvpReportingHandler.KVP_POOL_FILE_GUEST,
+                 writable=False):
+        self._kvp_file_path = kvp_file_path
+        self._writable = writable
+        self._file = None
+        self._map = None
+        self.record_count = 0
+        self.index = OrderedDict()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        self._file = open(self._kvp_file_path,
+                          'r+b' if self._writable else 'rb')
+        fcntl.flock(self._file,
+                    fcntl.LOCK_EX if self._writable else fcntl.LOCK_SH)
+        self._build_index()
+
+    def close(self):
+        self._unmap()
+        if self._file:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _build_index(self):
+        self._unmap()
+        self.index = OrderedDict()
+        self.record_count = 0
+        size = os.fstat(self._file.fileno()).st_size
+        if not size:
+            return  # an empty file can not be mapped
+        self._map = mmap.mmap(
+            self._file.fileno(), 0,
+            access=mmap.ACCESS_WRITE if self._writable else mmap.ACCESS_READ)
+        self.record_count = size // self.RECORD_SIZE
+        prefix_len = len(self.KEY_PREFIX)
+        for record_no in range(self.record_count):
+            offset = record_no * self.RECORD_SIZE
+            if self._map[offset:offset + prefix_len] != self.KEY_PREFIX:
+                continue
+            end = self._map.find(
+                b'|', offset + prefix_len, offset + self.KEY_SIZE)
+            if end < 0:
+                continue
+            try:
+                incarnation = int(self._map[offset + prefix_len:end])
+            except ValueError:
+                continue
+            self.index.setdefault(incarnation, []).append(record_no)
+
+    def incarnations(self):
+        """Return the incarnation numbers with cloud-init records."""
+        return list(self.index.keys())
+
+    def records(self, incarnation=None):
+        """
+        Yield the cloud-init kvps, as dicts of key and value, of the given
+        incarnation or of all incarnations when it is None.
+        """
+        if incarnation is None:
+            record_nos = sorted(
+                no for nos in self.index.values() for no in nos)
+        else:
+            record_nos = self.index.get(incarnation, [])
+        for record_no in record_nos:
+            offset = record_no * self.RECORD_SIZE
+            key = self._map[offset:offset + self.KEY_SIZE]
+            value = self._map[offset + self.KEY_SIZE:offset + self.RECORD_SIZE]
+            yield {'key': key.decode('utf-8').strip('\x00'),
+                   'value': value.decode('utf-8').strip('\x00')}
+
+    def prune(self, incarnations):
+        """
+        Remove the cloud-init records of the given incarnations from the
+        pool file, keeping the order of all other records.
+
+        @returns: The number of records removed.
+        """
+        if not self._writable:
+            raise ReportException(
+                "kvp pool {0} not opened writable".format(
+                    self._kvp_file_path))
+        drop = set()
+        for incarnation in incarnations:
+            drop.update(self.index.get(incarnation, []))
+        if not drop:
+            return 0
+        size = len(self._map)
+        kept = 0
+        for record_no in range(self.record_count):
+            if record_no in drop:
+                continue
+            if kept != record_no:
+                self._map.move(kept * self.RECORD_SIZE,
+                               record_no * self.RECORD_SIZE, self.RECORD_SIZE)
+            kept += 1
+        # keep any trailing partial record as it was
+        tail = size - self.record_count * self.RECORD_SIZE
+        if tail:
+            self._map.move(kept * self.RECORD_SIZE,
+                           self.record_count * self.RECORD_SIZE, tail)
+        self._map.flush()
+        self._unmap()
+        self._file.truncate(kept * self.RECORD_SIZE + tail)
+        self._build_index()
+        return len(drop)
+
+
 available_handlers = DictRegistry()
 available_handlers.register_item('log', LogHandler)
 available_handlers.register_item('print', PrintHandler)
 available_handlers.register_item('webhook', WebHookHandler)
 available_handlers.register_item('hyperv', HyperVKvpReportingHandler)
+available_handlers.register_item('trace', TraceHandler)
 
 # vi: ts=4 expandtab
@@ -4,20 +4,42 @@
 #
 # This file is part of cloud-init. See LICENSE file for license information.
 
+import six
 import yaml
 
 YAMLError = yaml.YAMLError
 
 
+def _construct_python_unicode(loader, node):
+    return loader.construct_scalar(node)
+
+
 class _CustomSafeLoader(yaml.SafeLoader):
-    def construct_python_unicode(self, node):
-        return self.construct_scalar(node)
+    construct_python_unicode = _construct_python_unicode
 
 
 _CustomSafeLoader.add_constructor(
     u'tag:yaml.org,2002:python/unicode',
     _CustomSafeLoader.construct_python_unicode)
 
+# Loaders by backend name. The libyaml backend parses in C and is used by
+# default when PyYAML was built with libyaml, the python backend is always
+# available. Both load any document to the same objects.
+LOADERS = {'python': _CustomSafeLoader}
+
+if yaml.__with_libyaml__:
+    class _CustomCSafeLoader(yaml.CSafeLoader):
+        construct_python_unicode = _construct_python_unicode
+
+    _CustomCSafeLoader.add_constructor(
+        u'tag:yaml.org,2002:python/unicode',
+        _CustomCSafeLoader.construct_python_unicode)
+
+    LOADERS['libyaml'] = _CustomCSafeLoader
+    DEFAULT_BACKEND = 'libyaml'
+else:
+    DEFAULT_BACKEND = 'python'
+
 
 class NoAliasSafeDumper(yaml.dumper.SafeDumper):
     """A class which avoids constructing anchors/aliases on yaml dump"""
@@ -26,7 +48,17 @@ class NoAliasSafeDumper(yaml.dumper.SafeDumper):
         return True
 
 
-def load(blob):
+def load(blob, backend=None):
+    """Return blob loaded as yaml, with the given or the default backend."""
+    loader = LOADERS[backend or DEFAULT_BACKEND]
+    try:
+        return yaml.load(blob, Loader=loader)
+    except YAMLError:
+        if loader is _CustomSafeLoader or not isinstance(
+                blob, (six.text_type, six.binary_type)):
+            raise
+    # libyaml words errors and marks differently, parse again so that
+    # errors are reported as the python backend reports them.
     return(yaml.load(blob, Loader=_CustomSafeLoader))
 
 
@@ -16,6 +16,9 @@ CLOUD_CONFIG = '/etc/cloud/cloud.cfg'
 
 RUN_CLOUD_CONFIG = '/run/cloud-init/cloud.cfg'
 
+# Snapshot of the merged base config, shared by all stages of a boot
+BASE_CFG_SNAPSHOT = '/run/cloud-init/base-cfg.json'
+
 # What u get if no config is provided
 CFG_BUILTIN = {
     'datasource_list': [
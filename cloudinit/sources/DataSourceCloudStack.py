@@ -122,8 +122,9 @@ class DataSourceCloudStack(sources.DataSource):
             start_time = time.time()
             self.userdata_raw = ec2.get_instance_userdata(
                 self.api_ver, self.metadata_address)
-            self.metadata = ec2.get_instance_metadata(self.api_ver,
-                                                      self.metadata_address)
+            self.metadata = ec2.get_instance_metadata(
+                self.api_ver, self.metadata_address,
+                max_workers=self.get_url_crawl_workers())
             LOG.debug("Crawl of metadata service took %s seconds",
                       int(time.time() - start_time))
             password_client = CloudStackPasswordServerClient(self.vr_addr)
@@ -205,7 +205,8 @@ class DataSourceEc2(sources.DataSource):
         LOG.debug('Fetching Ec2 IMDSv2 API Token')
         url, response = uhelp.wait_for_url(
             urls=urls, max_wait=1, timeout=1, status_cb=self._status_cb,
-            headers_cb=self._get_headers, request_method=request_method)
+            headers_cb=self._get_headers, request_method=request_method,
+            connect_synchronously=False)
 
         if url and response:
             self._api_token = response
@@ -252,7 +253,8 @@ class DataSourceEc2(sources.DataSource):
             url, _ = uhelp.wait_for_url(
                 urls=urls, max_wait=url_params.max_wait_seconds,
                 timeout=url_params.timeout_seconds, status_cb=LOG.warning,
-                headers_cb=self._get_headers, request_method=request_method)
+                headers_cb=self._get_headers, request_method=request_method,
+                connect_synchronously=False)
 
             if url:
                 metadata_address = url2base[url]
@@ -426,17 +428,20 @@ class DataSourceEc2(sources.DataSource):
             exc_cb_ud = self._skip_or_refresh_stale_aws_token_cb
         else:
             exc_cb = exc_cb_ud = None
+        crawl_workers = self.get_url_crawl_workers()
         try:
             crawled_metadata['user-data'] = ec2.get_instance_userdata(
                 api_version, self.metadata_address,
                 headers_cb=self._get_headers, exception_cb=exc_cb_ud)
             crawled_metadata['meta-data'] = ec2.get_instance_metadata(
                 api_version, self.metadata_address,
-                headers_cb=self._get_headers, exception_cb=exc_cb)
+                headers_cb=self._get_headers, exception_cb=exc_cb,
+                max_workers=crawl_workers)
             if self.cloud_name == CloudNames.AWS:
                 identity = ec2.get_instance_identity(
                     api_version, self.metadata_address,
-                    headers_cb=self._get_headers, exception_cb=exc_cb)
+                    headers_cb=self._get_headers, exception_cb=exc_cb,
+                    max_workers=crawl_workers)
                 crawled_metadata['dynamic'] = {'instance-identity': identity}
         except Exception:
             util.logexc(
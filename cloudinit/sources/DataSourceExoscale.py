@@ -85,7 +85,8 @@ class DataSourceExoscale(sources.DataSource):
 
         return read_metadata(self.metadata_url, self.api_version,
                              self.password_server_port, self.url_timeout,
-                             self.url_retries)
+                             self.url_retries,
+                             crawl_workers=self.get_url_crawl_workers())
 
     def _get_data(self):
         """Fetch the user data, the metadata and the VM password
@@ -187,7 +188,8 @@ def read_metadata(metadata_url=METADATA_URL,
                   api_version=API_VERSION,
                   password_server_port=PASSWORD_SERVER_PORT,
                   url_timeout=URL_TIMEOUT,
-                  url_retries=URL_RETRIES):
+                  url_retries=URL_RETRIES,
+                  crawl_workers=None):
     """Query the metadata server and return the retrieved data."""
     crawled_metadata = {}
     crawled_metadata['_metadata_api_version'] = api_version
@@ -201,7 +203,8 @@ def read_metadata(metadata_url=METADATA_URL,
             api_version,
             metadata_url,
             timeout=url_timeout,
-            retries=url_retries)
+            retries=url_retries,
+            max_workers=crawl_workers)
     except Exception as e:
         util.logexc(LOG, "failed reading from metadata url %s (%s)",
                     metadata_url, e)
@@ -9,13 +9,26 @@
 # This file is part of cloud-init. See LICENSE file for license information.
 
 import abc
+import bisect
 from collections import namedtuple
 import copy
+try:
+    from itertools import accumulate
+except ImportError:
+    # python 2
+    def accumulate(iterable):
+        total = 0
+        for item in iterable:
+            total += item
+            yield total
 import json
+from json import encoder as json_encoder
 import os
 import six
+from six.moves import queue
+import threading
 
-from cloudinit.atomic_helper import write_json
+from cloudinit.atomic_helper import write_file
 from cloudinit import importer
 from cloudinit import log as logging
 from cloudinit import net
@@ -49,6 +62,9 @@ INSTANCE_JSON_FILE = 'instance-data.json'
 # security-sensitive key values are present in this root-readable file
 INSTANCE_JSON_SENSITIVE_FILE = 'instance-data-sensitive.json'
 REDACT_SENSITIVE_VALUE = 'redacted for non-root user'
+# Index of the offsets of values within an instance-data file, written next
+# to it. See instance_data_index_path.
+INSTANCE_JSON_INDEX_SUFFIX = '-index'
 
 # Key which can be provide a cloud's official product name to cloud-init
 METADATA_CLOUD_NAME_KEY = 'cloud-name'
@@ -132,6 +148,284 @@ def redact_sensitive_keys(metadata, redact_value=REDACT_SENSITIVE_VALUE):
     return md_copy
 
 
+class _InstanceDataEncoder(object):
+    """Encode instance-data as json in a single walk.
+
+    Values are json encoded as json.dumps(indent=1, sort_keys=True) would
+    encode them. Within nested dicts, values which are not json serializable
+    are encoded as util.json_serialize_default does, ci-b64: prefixes are
+    stripped and the paths of base64 encoded and sensitive keys are recorded,
+    as process_instance_metadata does.
+
+    Encoded json is collected as a flat list of chunks. Each dict value is
+    recorded in spans as a (keys, start, end) slice of the chunks, where keys
+    lead to the value from the top of instance-data. The indexes of the spans
+    of sensitive values are recorded in sensitive_spans.
+    """
+
+    def __init__(self, sensitive_keys=()):
+        self.sensitive_keys = sensitive_keys
+        self.base64_encoded_keys = []
+        self.found_sensitive_keys = []
+        self.chunks = []
+        self.spans = []
+        self.sensitive_spans = []
+        self._markers = set()
+
+    def _enter(self, obj):
+        if id(obj) in self._markers:
+            raise ValueError('Circular reference detected')
+        self._markers.add(id(obj))
+
+    def _leave(self, obj):
+        self._markers.discard(id(obj))
+
+    def encode_item(self, key, value, parent_keys=(), level=0):
+        """Encode a key and value of a dict nested in instance-data."""
+        keys = parent_keys + (key,)
+        key_path = '/'.join(keys)
+        chunks = self.chunks
+        chunks.append(json_encoder.encode_basestring_ascii(key))
+        chunks.append(': ')
+        start = len(chunks)
+        sensitive = (
+            key in self.sensitive_keys or key_path in self.sensitive_keys)
+        if sensitive:
+            self.found_sensitive_keys.append(key_path)
+        if isinstance(value, dict):
+            self.encode_dict(value, keys, level)
+        else:
+            if not isinstance(value, _JSON_TYPES):
+                value = util.json_serialize_default(value)
+            if isinstance(value, six.string_types) and (
+                    value.startswith('ci-b64:')):
+                self.base64_encoded_keys.append(key_path)
+                value = value.replace('ci-b64:', '')
+            self.encode_value(value, level)
+        if sensitive:
+            self.sensitive_spans.append(len(self.spans))
+        self.spans.append((keys, start, len(chunks)))
+
+    def encode_dict(self, obj, parent_keys=(), level=0):
+        """Encode a dict nested in instance-data, processing its values."""
+        if not obj:
+            self.chunks.append('{}')
+            return
+        self._enter(obj)
+        newline_indent = '\n' + ' ' * (level + 1)
+        self.chunks.append('{' + newline_indent)
+        for (idx, (key, value)) in enumerate(_sorted_items(obj)):
+            if idx:
+                self.chunks.append(',' + newline_indent)
+            self.encode_item(key, value, parent_keys, level + 1)
+        self.chunks.append('\n' + ' ' * level + '}')
+        self._leave(obj)
+
+    def encode_value(self, value, level=0):
+        """Encode any value as json.dumps would, without processing it."""
+        chunks = self.chunks
+        if isinstance(value, six.string_types):
+            chunks.append(json_encoder.encode_basestring_ascii(value))
+            return
+        if not isinstance(value, (dict, list, tuple)):
+            if isinstance(value, _JSON_TYPES):
+                chunks.append(json.dumps(value))
+            else:
+                self.encode_value(util.json_serialize_default(value))
+            return
+        if not value:
+            chunks.append('{}' if isinstance(value, dict) else '[]')
+            return
+        self._enter(value)
+        newline_indent = '\n' + ' ' * (level + 1)
+        if isinstance(value, dict):
+            chunks.append('{' + newline_indent)
+            for (idx, (key, item)) in enumerate(_sorted_items(value)):
+                if idx:
+                    chunks.append(',' + newline_indent)
+                chunks.append(json_encoder.encode_basestring_ascii(key))
+                chunks.append(': ')
+                self.encode_value(item, level + 1)
+            chunks.append('\n' + ' ' * level + '}')
+        else:
+            chunks.append('[' + newline_indent)
+            for (idx, item) in enumerate(value):
+                if idx:
+                    chunks.append(',' + newline_indent)
+                self.encode_value(item, level + 1)
+            chunks.append('\n' + ' ' * level + ']')
+        self._leave(value)
+
+    def encode_later(self, key):
+        """Encode a top-level key whose value is encoded with set_value."""
+        self.chunks.append(json_encoder.encode_basestring_ascii(key))
+        self.chunks.append(': ')
+        self.chunks.append(None)
+        index = len(self.chunks) - 1
+        self.spans.append(((key,), index, index + 1))
+        return index
+
+    def set_value(self, index, value, level=0):
+        """Encode the value of a key encoded with encode_later."""
+        start = len(self.chunks)
+        self.encode_value(value, level)
+        self.chunks[index] = ''.join(self.chunks[start:])
+        del self.chunks[start:]
+
+
+# Types json encodes natively
+_JSON_TYPES = (
+    (dict, list, tuple, float, bool, type(None)) + six.string_types +
+    six.integer_types)
+
+
+def _sorted_items(obj):
+    """Return items of a dict with keys converted to strings, sorted."""
+    return sorted(((_json_key(key), value) for (key, value) in obj.items()),
+                  key=lambda item: item[0])
+
+
+def _json_key(key):
+    """Return a dict key converted to a string as json converts it."""
+    if isinstance(key, six.string_types):
+        return key
+    if isinstance(key, (bool, float, type(None)) + six.integer_types):
+        return json.dumps(key)
+    raise TypeError(
+        'keys must be str, int, float, bool or None, not %s' %
+        type(key).__name__)
+
+
+def _join_chunks(chunks, spans):
+    """Join chunks, returning the content and the offsets of the spans."""
+    offsets = [0]
+    offsets.extend(accumulate(map(len, chunks)))
+    return (''.join(chunks), [(keys, offsets[start], offsets[end])
+                              for (keys, start, end) in spans])
+
+
+def _redact_chunks(chunks, spans, offsets, sensitive_spans, redacted_chunk):
+    """Join chunks with the chunks of sensitive spans redacted.
+
+    @param spans: The (keys, start, end) slices of chunks of values.
+    @param offsets: The (keys, start, end) offsets of values once chunks are
+        joined without redaction.
+    @param sensitive_spans: The indexes of spans to redact.
+    @return: Tuple of the redacted content and the offsets of values in it.
+    """
+    redact = []
+    for idx in sorted(sensitive_spans, key=lambda idx: spans[idx][1]):
+        if not redact or spans[idx][1] >= spans[redact[-1]][2]:
+            redact.append(idx)
+    redacted = []
+    prev_end = 0
+    for idx in redact:
+        (_keys, start, end) = spans[idx]
+        redacted.extend(chunks[prev_end:start])
+        redacted.append(redacted_chunk)
+        prev_end = end
+    redacted.extend(chunks[prev_end:])
+
+    # Offsets move by the length the redactions before them removed. Values
+    # within redacted values are gone.
+    starts = [offsets[idx][1] for idx in redact]
+    ends = [offsets[idx][2] for idx in redact]
+    removed = [0]
+    for (start, end) in zip(starts, ends):
+        removed.append(removed[-1] + end - start - len(redacted_chunk))
+    redacted_offsets = []
+    for (keys, start, end) in offsets:
+        idx = bisect.bisect_right(starts, start) - 1
+        if idx >= 0 and starts[idx] < start < ends[idx]:
+            continue
+        redacted_offsets.append((
+            keys, start - removed[bisect.bisect_right(ends, start)],
+            end - removed[bisect.bisect_right(ends, end)]))
+    return (''.join(redacted), redacted_offsets)
+
+
+def _serialize_instance_data(instance_data, sensitive_keys=(),
+                             redact_value=REDACT_SENSITIVE_VALUE):
+    """Serialize instance-data, recording the offsets of its values.
+
+    @return: Tuple of the json content, the offsets of its values, the json
+        content with sensitive keys redacted and the offsets of its values.
+        Offsets are given as a list of (keys, start, end) tuples.
+    """
+    encoder = _InstanceDataEncoder(sensitive_keys)
+    chunks = encoder.chunks
+    processed_keys = {
+        'base64_encoded_keys': encoder.base64_encoded_keys,
+        'sensitive_keys': encoder.found_sensitive_keys}
+    items = [(key, value) for (key, value) in _sorted_items(instance_data)
+             if key not in processed_keys]
+    items.extend((key, None) for key in processed_keys)
+    later = {}
+    chunks.append('{\n ')
+    for (idx, (key, value)) in enumerate(
+            sorted(items, key=lambda item: item[0])):
+        if idx:
+            chunks.append(',\n ')
+        if key in processed_keys:
+            later[key] = encoder.encode_later(key)
+        else:
+            encoder.encode_item(key, value, level=1)
+    for (key, index) in later.items():
+        encoder.set_value(index, processed_keys[key], level=1)
+    chunks.append('\n}\n')
+    (content, offsets) = _join_chunks(chunks, encoder.spans)
+    if not encoder.sensitive_spans:
+        return (content, offsets, content, offsets)
+    return (content, offsets) + _redact_chunks(
+        chunks, encoder.spans, offsets, encoder.sensitive_spans,
+        json_encoder.encode_basestring_ascii(redact_value))
+
+
+def serialize_instance_data(instance_data, sensitive_keys=(),
+                            redact_value=REDACT_SENSITIVE_VALUE):
+    """Serialize instance-data for persisting as json in a single walk.
+
+    Renders the json that dumping process_instance_metadata of instance_data,
+    round-tripped through util.json_dumps, would. The same json with
+    sensitive keys redacted, as by redact_sensitive_keys, is rendered from
+    the same walk, without copying instance_data in between.
+
+    @return: Tuple of the json content and the json content with sensitive
+        keys redacted, each ending in a newline.
+    @raises TypeError: if instance_data can not be serialized.
+    """
+    (content, _spans, redacted_content, _redacted_spans) = (
+        _serialize_instance_data(instance_data, sensitive_keys, redact_value))
+    return (content, redacted_content)
+
+
+def instance_data_index_path(instance_data_file):
+    """Return the path of the index of values of an instance-data file."""
+    (base, ext) = os.path.splitext(instance_data_file)
+    return base + INSTANCE_JSON_INDEX_SUFFIX + ext
+
+
+def write_instance_data_index(instance_data_file, offsets, mode=0o644):
+    """Write an index of values of instance_data_file by query varname.
+
+    The index lets 'cloud-init query' read a single value without loading all
+    of instance_data_file. It records the size and mtime of the file it
+    indexes, so that it is not used once the file changed.
+
+    @param offsets: List of (keys, start, end) offsets of the values of
+        instance_data_file, as recorded when serializing it.
+    """
+    # jinja_template imports this module, so it can not be imported earlier.
+    from cloudinit.handlers.jinja_template import (
+        convert_jinja_instance_data_index)
+    stat = os.stat(instance_data_file)
+    index = {
+        'size': stat.st_size, 'mtime': stat.st_mtime,
+        'keys': convert_jinja_instance_data_index(offsets)}
+    write_file(instance_data_index_path(instance_data_file),
+               json.dumps(index, separators=(',', ':')), mode=mode, omode='w')
+
+
 URLParams = namedtuple(
     'URLParms', ['max_wait_seconds', 'timeout_seconds', 'num_retries'])
 
@@ -174,6 +468,8 @@ class DataSource(object):
     url_max_wait = -1   # max_wait < 0 means do not wait
     url_timeout = 10    # timeout for each metadata url read attempt
     url_retries = 5     # number of times to retry url upon 404
+    url_crawl_workers = 1  # concurrent reads when crawling a metadata tree
+    url_include_workers = 1  # concurrent reads of user-data include urls
 
     # The datasource defines a set of supported EventTypes during which
     # the datasource can react to changes in metadata and regenerate
@@ -194,6 +490,10 @@ class DataSource(object):
 
     _dirty_cache = False
 
+    # Set while find_source searches concurrently, get_data then leaves
+    # persisting instance data to find_source.
+    _defer_persist = False
+
     # N-tuple of keypaths or keynames redact from instance-data.json for
     # non-root users
     sensitive_metadata_keys = ('security-credentials',)
@@ -214,7 +514,8 @@ class DataSource(object):
             self.ds_cfg = {}
 
         if not ud_proc:
-            self.ud_proc = ud.UserDataProcessor(self.paths)
+            self.ud_proc = ud.UserDataProcessor(
+                self.paths, max_workers=self.get_include_workers())
         else:
             self.ud_proc = ud_proc
 
@@ -271,7 +572,7 @@ class DataSource(object):
         """
         self._dirty_cache = True
         return_value = self._get_data()
-        if not return_value:
+        if not return_value or self._defer_persist:
             return return_value
         self.persist_instance_data()
         return return_value
@@ -287,8 +588,7 @@ class DataSource(object):
         if hasattr(self, '_crawled_metadata'):
             # Any datasource with _crawled_metadata will best represent
             # most recent, 'raw' metadata
-            crawled_metadata = copy.deepcopy(
-                getattr(self, '_crawled_metadata'))
+            crawled_metadata = copy.copy(getattr(self, '_crawled_metadata'))
             crawled_metadata.pop('user-data', None)
             crawled_metadata.pop('vendor-data', None)
             instance_data = {'ds': crawled_metadata}
@@ -306,12 +606,12 @@ class DataSource(object):
             self._get_standardized_metadata())
         instance_data['ds']['_doc'] = EXPERIMENTAL_TEXT
         try:
-            # Process content base64encoding unserializable values
-            content = util.json_dumps(instance_data)
-            # Strip base64: prefix and set base64_encoded_keys list.
-            processed_data = process_instance_metadata(
-                json.loads(content),
-                sensitive_keys=self.sensitive_metadata_keys)
+            # Base64encode unserializable values, strip base64: prefixes, set
+            # base64_encoded_keys and redact sensitive keys in a single walk.
+            (content, offsets, redacted_content, redacted_offsets) = (
+                _serialize_instance_data(
+                    instance_data,
+                    sensitive_keys=self.sensitive_metadata_keys))
         except TypeError as e:
             LOG.warning('Error persisting instance-data.json: %s', str(e))
             return False
@@ -319,11 +619,25 @@ class DataSource(object):
             LOG.warning('Error persisting instance-data.json: %s', str(e))
             return False
         json_file = os.path.join(self.paths.run_dir, INSTANCE_JSON_FILE)
-        write_json(json_file, processed_data)  # World readable
+        write_file(json_file, content, omode='w')  # World readable
+        write_instance_data_index(json_file, offsets)
         json_sensitive_file = os.path.join(self.paths.run_dir,
                                            INSTANCE_JSON_SENSITIVE_FILE)
-        write_json(json_sensitive_file,
-                   redact_sensitive_keys(processed_data), mode=0o600)
+        write_file(json_sensitive_file, redacted_content, mode=0o600,
+                   omode='w')
+        write_instance_data_index(
+            json_sensitive_file, redacted_offsets, mode=0o600)
+        return True
+
+    def _is_platform_viable(self):
+        """Cheaply check whether the platform may provide this datasource.
+
+        Subclasses which can positively identify their platform (DMI data,
+        seed files, etc) without network access should override this. Only
+        datasources overriding it are probed concurrently by find_source.
+
+        @return: False when the datasource certainly cannot be used.
+        """
         return True
 
     def _get_data(self):
@@ -368,6 +682,42 @@ class DataSource(object):
 
         return URLParams(max_wait, timeout, retries)
 
+    def get_url_crawl_workers(self):
+        """Return the number of concurrent reads used to crawl metadata.
+
+        Subclasses may override url_crawl_workers. A value of 1 crawls
+        metadata trees serially.
+
+        @return: Integer >= 1 from datasource config crawl_workers.
+        """
+        workers = self.url_crawl_workers
+        try:
+            workers = max(
+                1, int(self.ds_cfg.get("crawl_workers", workers)))
+        except (TypeError, ValueError):
+            util.logexc(
+                LOG, "Config crawl_workers '%s' is not an int, using"
+                " default '%s'", self.ds_cfg.get('crawl_workers'), workers)
+        return workers
+
+    def get_include_workers(self):
+        """Return the number of concurrent reads of user-data include urls.
+
+        Subclasses may override url_include_workers. A value of 1 reads
+        include urls serially.
+
+        @return: Integer >= 1 from datasource config include_workers.
+        """
+        workers = self.url_include_workers
+        try:
+            workers = max(
+                1, int(self.ds_cfg.get("include_workers", workers)))
+        except (TypeError, ValueError):
+            util.logexc(
+                LOG, "Config include_workers '%s' is not an int, using"
+                " default '%s'", self.ds_cfg.get('include_workers'), workers)
+        return workers
+
     def get_userdata(self, apply_filter=False):
         if self.userdata is None:
             self.userdata = self.ud_proc.process(self.get_userdata_raw())
@@ -741,27 +1091,178 @@ def normalize_pubkey_data(pubkey_data):
     return keys
 
 
+def _get_probe_workers(sys_cfg):
+    """Return the configured datasource_probe_workers, 1 meaning serial."""
+    workers = sys_cfg.get('datasource_probe_workers', 1)
+    try:
+        return max(1, int(workers))
+    except (TypeError, ValueError):
+        LOG.warning(
+            "Config datasource_probe_workers '%s' is not an int, probing"
+            " datasources serially", workers)
+        return 1
+
+
+def _search_source(sys_cfg, distro, paths, cls, name, mode, reporter,
+                   ds=None):
+    """Run update_metadata on a datasource under a search-<name> event.
+
+    @param ds: Optional instance of cls to search, otherwise cls is
+        instantiated.
+    @return: The datasource instance if it found data, otherwise None.
+    """
+    myrep = events.ReportEventStack(
+        name="search-%s" % name.replace("DataSource", ""),
+        description="searching for %s data from %s" % (mode, name),
+        message="no %s data found from %s" % (mode, name),
+        parent=reporter)
+    try:
+        with myrep:
+            LOG.debug("Seeing if we can get any data from %s", cls)
+            if ds is None:
+                ds = cls(sys_cfg, distro, paths)
+            if ds.update_metadata([EventType.BOOT_NEW_INSTANCE]):
+                myrep.message = "found %s data from %s" % (mode, name)
+                return ds
+    except Exception:
+        util.logexc(LOG, "Getting data from %s failed", cls)
+    return None
+
+
+def _check_viable_source(sys_cfg, distro, paths, cls, name, mode, reporter):
+    """Instantiate cls and check its platform viability.
+
+    @return: The datasource instance if viable, otherwise None.
+    """
+    myrep = events.ReportEventStack(
+        name="check-%s" % name.replace("DataSource", ""),
+        description="checking %s platform viability of %s" % (mode, name),
+        message="%s platform not viable for %s" % (mode, name),
+        parent=reporter)
+    try:
+        with myrep:
+            ds = cls(sys_cfg, distro, paths)
+            if ds._is_platform_viable():
+                myrep.message = "%s platform viable for %s" % (mode, name)
+                return ds
+    except Exception:
+        util.logexc(LOG, "Checking platform viability of %s failed", cls)
+    return None
+
+
+def _probe_viable_source(sys_cfg, distro, paths, cls, name, mode, reporter):
+    """Search cls for data if its platform is viable.
+
+    Instance data is not persisted, so that a lower priority datasource
+    finishing late cannot overwrite the instance data of the one used.
+
+    @return: The datasource instance if it found data, otherwise None.
+    """
+    ds = _check_viable_source(
+        sys_cfg, distro, paths, cls, name, mode, reporter)
+    if ds is None:
+        return None
+    ds._defer_persist = True
+    return _search_source(
+        sys_cfg, distro, paths, cls, name, mode, reporter, ds=ds)
+
+
+def _has_platform_check(cls):
+    """Return True if cls overrides DataSource._is_platform_viable."""
+    for klass in cls.__mro__:
+        if klass is DataSource:
+            return False
+        if '_is_platform_viable' in vars(klass):
+            return True
+    return False
+
+
+def _find_source_concurrently(sys_cfg, distro, paths, candidates, mode,
+                              reporter, workers):
+    """Probe candidates concurrently, honoring their priority order.
+
+    Only candidates which override _is_platform_viable are probed
+    concurrently, all others are searched serially in their turn. In
+    network mode, viable candidates are also searched concurrently. In
+    local mode, datasources may set up ephemeral networking, so viable
+    candidates are searched in their turn too. Candidates are walked in
+    priority order and the first which finds data is returned without
+    waiting on lower priority candidates.
+
+    @return: Tuple of (datasource, name) or None when nothing was found.
+    """
+    probe = (_probe_viable_source if mode == "network"
+             else _check_viable_source)
+    done = threading.Event()
+    pending = queue.Queue()
+    probes = {}
+    for (name, cls) in candidates:
+        if _has_platform_check(cls):
+            probes[name] = queue.Queue(maxsize=1)
+            pending.put((name, cls))
+
+    def worker():
+        while not done.is_set():
+            try:
+                (name, cls) = pending.get_nowait()
+            except queue.Empty:
+                return
+            ds = None
+            try:
+                ds = probe(sys_cfg, distro, paths, cls, name, mode, reporter)
+            finally:
+                probes[name].put(ds)
+
+    LOG.debug("Checking %s platform viability of: %s", mode,
+              [name for (name, _cls) in candidates if name in probes])
+    # Probes run in daemon threads, so that a lower priority probe still
+    # in flight can never delay the return of a winner or process exit.
+    for _ in range(min(workers, len(probes))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+    try:
+        for (name, cls) in candidates:
+            if name not in probes:
+                ds = _search_source(
+                    sys_cfg, distro, paths, cls, name, mode, reporter)
+            elif mode == "network":
+                ds = probes[name].get()
+                if ds is not None:
+                    ds._defer_persist = False
+                    ds.persist_instance_data()
+            else:
+                ds = probes[name].get()
+                if ds is not None:
+                    ds = _search_source(
+                        sys_cfg, distro, paths, cls, name, mode, reporter,
+                        ds=ds)
+            if ds is not None:
+                return (ds, name)
+        return None
+    finally:
+        done.set()
+
+
 def find_source(sys_cfg, distro, paths, ds_deps, cfg_list, pkg_list, reporter):
     ds_list = list_sources(cfg_list, ds_deps, pkg_list)
     ds_names = [type_utils.obj_name(f) for f in ds_list]
     mode = "network" if DEP_NETWORK in ds_deps else "local"
     LOG.debug("Searching for %s data source in: %s", mode, ds_names)
 
-    for name, cls in zip(ds_names, ds_list):
-        myrep = events.ReportEventStack(
-            name="search-%s" % name.replace("DataSource", ""),
-            description="searching for %s data from %s" % (mode, name),
-            message="no %s data found from %s" % (mode, name),
-            parent=reporter)
-        try:
-            with myrep:
-                LOG.debug("Seeing if we can get any data from %s", cls)
-                s = cls(sys_cfg, distro, paths)
-                if s.update_metadata([EventType.BOOT_NEW_INSTANCE]):
-                    myrep.message = "found %s data from %s" % (mode, name)
-                    return (s, type_utils.obj_name(cls))
-        except Exception:
-            util.logexc(LOG, "Getting data from %s failed", cls)
+    workers = _get_probe_workers(sys_cfg)
+    if workers > 1 and len(ds_list) > 1:
+        found = _find_source_concurrently(
+            sys_cfg, distro, paths, list(zip(ds_names, ds_list)), mode,
+            reporter, workers)
+        if found:
+            return found
+    else:
+        for name, cls in zip(ds_names, ds_list):
+            ds = _search_source(
+                sys_cfg, distro, paths, cls, name, mode, reporter)
+            if ds is not None:
+                return (ds, name)
 
     msg = ("Did not find any data source,"
            " searched classes: (%s)") % (", ".join(ds_names))
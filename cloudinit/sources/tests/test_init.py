@@ -2,17 +2,23 @@
 
 import copy
 import inspect
+import json
 import os
 import six
 import stat
+import sys
+import threading
+import time
 
 from cloudinit.event import EventType
 from cloudinit.helpers import Paths
 from cloudinit import importer
 from cloudinit.sources import (
-    EXPERIMENTAL_TEXT, INSTANCE_JSON_FILE, INSTANCE_JSON_SENSITIVE_FILE,
-    METADATA_UNKNOWN, REDACT_SENSITIVE_VALUE, UNSET, DataSource,
-    canonical_cloud_id, redact_sensitive_keys)
+    DEP_FILESYSTEM, DEP_NETWORK, EXPERIMENTAL_TEXT, INSTANCE_JSON_FILE,
+    INSTANCE_JSON_SENSITIVE_FILE, METADATA_UNKNOWN, REDACT_SENSITIVE_VALUE,
+    UNSET, DataSource, DataSourceNotFoundException, canonical_cloud_id,
+    find_source, instance_data_index_path, process_instance_metadata,
+    redact_sensitive_keys, serialize_instance_data)
 from cloudinit.tests.helpers import CiTestCase, skipIf, mock
 from cloudinit.user_data import UserDataProcessor
 from cloudinit import util
@@ -133,6 +139,39 @@ class TestDataSource(CiTestCase):
         (_max_wait, timeout, _retries) = datasource.get_url_params()
         self.assertEqual(0, timeout)
 
+    def test_datasource_get_url_crawl_workers_default_is_serial(self):
+        """get_url_crawl_workers defaults to a serial metadata crawl."""
+        self.assertEqual(1, self.datasource.get_url_crawl_workers())
+
+    def test_datasource_get_url_crawl_workers_ds_config_override(self):
+        """Datasource config crawl_workers overrides the default."""
+        sys_cfg = {'datasource': {'_undef': {'crawl_workers': '8'}}}
+        datasource = DataSource(sys_cfg, self.distro, self.paths)
+        self.assertEqual(8, datasource.get_url_crawl_workers())
+        sys_cfg = {'datasource': {'_undef': {'crawl_workers': '0'}}}
+        datasource = DataSource(sys_cfg, self.distro, self.paths)
+        self.assertEqual(1, datasource.get_url_crawl_workers())
+
+    def test_datasource_get_url_crawl_workers_default_on_error(self):
+        """Invalid crawl_workers config values are logged and ignored."""
+        sys_cfg = {'datasource': {'_undef': {'crawl_workers': 'many'}}}
+        datasource = DataSource(sys_cfg, self.distro, self.paths)
+        self.assertEqual(1, datasource.get_url_crawl_workers())
+        self.assertIn(
+            "Config crawl_workers 'many' is not an int, using default '1'",
+            self.logs.getvalue())
+
+    def test_datasource_get_include_workers_ds_config_override(self):
+        """Datasource config include_workers sets the user-data workers."""
+        self.assertEqual(1, self.datasource.get_include_workers())
+        sys_cfg = {'datasource': {'_undef': {'include_workers': '4'}}}
+        datasource = DataSource(sys_cfg, self.distro, self.paths)
+        self.assertEqual(4, datasource.get_include_workers())
+        self.assertEqual(4, datasource.ud_proc._max_workers)
+        sys_cfg = {'datasource': {'_undef': {'include_workers': 'many'}}}
+        datasource = DataSource(sys_cfg, self.distro, self.paths)
+        self.assertEqual(1, datasource.get_include_workers())
+
     def test_datasource_get_url_uses_defaults_on_errors(self):
         """On invalid system config values for url_params defaults are used."""
         # All invalid values should be logged
@@ -371,6 +410,41 @@ class TestDataSource(CiTestCase):
         self.assertEqual(0o600, stat.S_IMODE(file_stat.st_mode))
         self.assertEqual(expected, util.load_json(content))
 
+    def test_get_data_writes_instance_data_indexes(self):
+        """get_data indexes the values of both instance-data files by key."""
+        tmp = self.tmp_dir()
+        datasource = DataSourceTestSubclassNet(
+            self.sys_cfg, self.distro, Paths({'run_dir': tmp}),
+            custom_metadata={
+                'local-hostname': 'test-subclass-hostname',
+                'some': {'security-credentials': {'cred1': 'sekret'}}})
+        datasource.get_data()
+        for (fname, mode, creds) in (
+                (INSTANCE_JSON_FILE, 0o644, {'cred1': 'sekret'}),
+                (INSTANCE_JSON_SENSITIVE_FILE, 0o600,
+                 REDACT_SENSITIVE_VALUE)):
+            json_file = self.tmp_path(fname, tmp)
+            index_file = instance_data_index_path(json_file)
+            self.assertEqual(
+                mode, stat.S_IMODE(os.stat(index_file).st_mode))
+            index = util.load_json(util.load_file(index_file))
+            file_stat = os.stat(json_file)
+            self.assertEqual(file_stat.st_size, index['size'])
+            self.assertEqual(file_stat.st_mtime, index['mtime'])
+            content = util.load_file(json_file)
+
+            def value(varname):
+                (start, end) = index['keys'][varname]
+                return json.loads(content[start:end])
+
+            self.assertEqual(
+                'test-subclass-hostname', value('v1.local_hostname'))
+            self.assertEqual('test-subclass-hostname', value('local_hostname'))
+            self.assertEqual(
+                creds, value('ds.meta_data.some.security_credentials'))
+            self.assertEqual(
+                json.loads(content)['v1'], value('v1'))
+
     def test_get_data_handles_redacted_unserializable_content(self):
         """get_data warns unserializable content in INSTANCE_JSON_FILE."""
         tmp = self.tmp_dir()
@@ -574,6 +648,224 @@ class TestDataSource(CiTestCase):
             self.logs.getvalue())
 
 
+def _probe_source(name, viable=True, found=True, platform_check=True,
+                  get_data_event=None, started_event=None):
+    """Return a DataSource class named name recording its probes.
+
+    @param platform_check: Whether the class overrides _is_platform_viable.
+    @param get_data_event: Optional threading.Event _get_data waits on.
+    @param started_event: Optional threading.Event _get_data sets first.
+    """
+    def _is_platform_viable(self):
+        self.probes.append(('viable', name))
+        return viable
+
+    def _get_data(self):
+        self.probes.append(('get_data', name))
+        if started_event:
+            started_event.set()
+        if get_data_event:
+            get_data_event.wait(5)
+            self.probes.append(('got_data', name))
+        self.metadata = {'instance-id': name}
+        return found
+
+    attrs = {'dsname': name, 'probes': [], '_get_data': _get_data}
+    if platform_check:
+        attrs['_is_platform_viable'] = _is_platform_viable
+    return type(name, (DataSource,), attrs)
+
+
+class TestFindSource(CiTestCase):
+
+    with_logs = True
+
+    def setUp(self):
+        super(TestFindSource, self).setUp()
+        self.paths = Paths({'run_dir': self.tmp_dir()})
+        self.probes = []
+
+    def _find_source(self, sources, sys_cfg=None, deps=None):
+        for cls in sources:
+            cls.probes = self.probes
+        if deps is None:
+            deps = [DEP_FILESYSTEM, DEP_NETWORK]
+        with mock.patch('cloudinit.sources.list_sources') as m_list:
+            m_list.return_value = sources
+            return find_source(
+                sys_cfg or {}, 'distro', self.paths, deps, [], [], None)
+
+    def test_serial_find_source_stops_at_first_found(self):
+        """By default datasources are searched in order until one is found."""
+        sources = [_probe_source('DataSourceA', found=False),
+                   _probe_source('DataSourceB'),
+                   _probe_source('DataSourceC')]
+        (ds, name) = self._find_source(sources)
+        self.assertEqual('DataSourceB', name)
+        self.assertIsInstance(ds, sources[1])
+        self.assertEqual(
+            [('get_data', 'DataSourceA'), ('get_data', 'DataSourceB')],
+            self.probes)
+
+    def test_concurrent_find_source_skips_non_viable_platforms(self):
+        """Only viable datasources have get_data called."""
+        sources = [_probe_source('DataSourceA', viable=False),
+                   _probe_source('DataSourceB'),
+                   _probe_source('DataSourceC', viable=False)]
+        (ds, name) = self._find_source(
+            sources, sys_cfg={'datasource_probe_workers': 4})
+        self.assertEqual('DataSourceB', name)
+        self.assertIsInstance(ds, sources[1])
+        self.assertEqual(
+            [('get_data', 'DataSourceB')],
+            [probe for probe in self.probes if probe[0] == 'get_data'])
+        self.assertIn(('viable', 'DataSourceA'), self.probes)
+        self.assertIn(('viable', 'DataSourceB'), self.probes)
+
+    def test_concurrent_find_source_honors_list_priority(self):
+        """The first found datasource in list order wins."""
+        sources = [_probe_source('DataSourceA', found=False),
+                   _probe_source('DataSourceB'),
+                   _probe_source('DataSourceC')]
+        (ds, name) = self._find_source(
+            sources, sys_cfg={'datasource_probe_workers': 4})
+        self.assertEqual('DataSourceB', name)
+        self.assertIsInstance(ds, sources[1])
+        instance_json = util.load_json(util.load_file(
+            os.path.join(self.paths.run_dir, INSTANCE_JSON_FILE)))
+        self.assertEqual(
+            'DataSourceB', instance_json['v1']['instance_id'])
+
+    def test_concurrent_find_source_does_not_wait_on_lower_priority(self):
+        """A found datasource is returned while lower ones still search."""
+        (started, release) = (threading.Event(), threading.Event())
+        self.addCleanup(release.set)
+        sources = [_probe_source('DataSourceA', get_data_event=started),
+                   _probe_source('DataSourceB', get_data_event=release,
+                                 started_event=started)]
+        (ds, name) = self._find_source(
+            sources, sys_cfg={'datasource_probe_workers': 4})
+        self.assertEqual('DataSourceA', name)
+        self.assertIn(('get_data', 'DataSourceB'), self.probes)
+        self.assertNotIn(('got_data', 'DataSourceB'), self.probes)
+
+    def test_concurrent_find_source_late_lower_priority_not_persisted(self):
+        """Lower priority datasources finishing late keep instance data."""
+        (started, release) = (threading.Event(), threading.Event())
+        sources = [_probe_source('DataSourceA', get_data_event=started),
+                   _probe_source('DataSourceB', get_data_event=release,
+                                 started_event=started)]
+        self._find_source(sources, sys_cfg={'datasource_probe_workers': 4})
+        release.set()
+        found_b = 'found network data from DataSourceB'
+        for _ in range(500):
+            if found_b in self.logs.getvalue():
+                break
+            time.sleep(0.01)
+        self.assertIn(found_b, self.logs.getvalue())
+        instance_json = util.load_json(util.load_file(
+            os.path.join(self.paths.run_dir, INSTANCE_JSON_FILE)))
+        self.assertEqual(
+            'DataSourceA', instance_json['v1']['instance_id'])
+
+    def test_concurrent_find_source_does_not_wait_on_hung_probes(self):
+        """A hung lower priority probe runs in a daemon thread."""
+        (hung, release) = (threading.Event(), threading.Event())
+        self.addCleanup(release.set)
+        daemon = []
+
+        def _is_platform_viable(self):
+            daemon.append(threading.current_thread().daemon)
+            hung.set()
+            release.wait()
+            return False
+
+        hung_source = _probe_source('DataSourceB')
+        hung_source._is_platform_viable = _is_platform_viable
+        sources = [_probe_source('DataSourceA', get_data_event=hung),
+                   hung_source]
+        (_ds, name) = self._find_source(
+            sources, sys_cfg={'datasource_probe_workers': 4})
+        self.assertEqual('DataSourceA', name)
+        self.assertEqual([True], daemon)
+
+    def test_concurrent_find_source_skips_queued_probes_once_found(self):
+        """Probes not yet started when a datasource is found never run."""
+        sources = [_probe_source('DataSourceA'),
+                   _probe_source('DataSourceB'),
+                   _probe_source('DataSourceC')]
+        self._find_source(sources, sys_cfg={'datasource_probe_workers': 1})
+        self.assertNotIn(('viable', 'DataSourceB'), self.probes)
+        self.assertNotIn(('viable', 'DataSourceC'), self.probes)
+
+    def test_concurrent_find_source_hung_probe_does_not_delay_exit(self):
+        """The process exits after a find while a probe is still hung."""
+        python_prog = '\n'.join((
+            'import threading',
+            'from cloudinit.helpers import Paths',
+            'from cloudinit import sources',
+            'class DataSourceA(sources.DataSource):',
+            '    def _is_platform_viable(self): return True',
+            '    def _get_data(self): return True',
+            'class DataSourceB(sources.DataSource):',
+            '    def _is_platform_viable(self): threading.Event().wait()',
+            'sources.list_sources = lambda *_: [DataSourceA, DataSourceB]',
+            'print(sources.find_source(',
+            '    {"datasource_probe_workers": 2}, "distro",',
+            '    Paths({"run_dir": "%s"}),' % self.paths.run_dir,
+            '    [sources.DEP_FILESYSTEM, sources.DEP_NETWORK],',
+            '    [], [], None)[1])'))
+        with self.allow_subp(['timeout']):
+            out, _err = util.subp(
+                ['timeout', '10', sys.executable, '-c', python_prog])
+        self.assertEqual('DataSourceA', out.strip())
+
+    def test_concurrent_find_source_searches_unchecked_sources_serially(self):
+        """Datasources without a platform check are searched in turn."""
+        release = threading.Event()
+        self.addCleanup(release.set)
+        sources = [_probe_source('DataSourceA', platform_check=False),
+                   _probe_source('DataSourceB', get_data_event=release),
+                   _probe_source('DataSourceC', platform_check=False)]
+        (ds, name) = self._find_source(
+            sources, sys_cfg={'datasource_probe_workers': 4})
+        self.assertEqual('DataSourceA', name)
+        self.assertNotIn(('get_data', 'DataSourceC'), self.probes)
+        self.assertNotIn(('viable', 'DataSourceA'), self.probes)
+
+    def test_concurrent_find_source_searches_serially_in_local_mode(self):
+        """In local mode viable datasources are searched in order."""
+        sources = [_probe_source('DataSourceA', found=False),
+                   _probe_source('DataSourceB'),
+                   _probe_source('DataSourceC')]
+        (_ds, name) = self._find_source(
+            sources, sys_cfg={'datasource_probe_workers': 4},
+            deps=[DEP_FILESYSTEM])
+        self.assertEqual('DataSourceB', name)
+        self.assertEqual(
+            [('get_data', 'DataSourceA'), ('get_data', 'DataSourceB')],
+            [probe for probe in self.probes if probe[0] == 'get_data'])
+
+    def test_concurrent_find_source_raises_when_none_found(self):
+        """DataSourceNotFoundException is raised when nothing is found."""
+        sources = [_probe_source('DataSourceA', viable=False),
+                   _probe_source('DataSourceB', found=False)]
+        with self.assertRaises(DataSourceNotFoundException):
+            self._find_source(
+                sources, sys_cfg={'datasource_probe_workers': 4})
+
+    def test_invalid_probe_workers_probes_serially(self):
+        """An invalid datasource_probe_workers value is logged and ignored."""
+        sources = [_probe_source('DataSourceA', viable=False),
+                   _probe_source('DataSourceB')]
+        (_ds, name) = self._find_source(
+            sources, sys_cfg={'datasource_probe_workers': 'lots'})
+        self.assertEqual('DataSourceA', name)
+        self.assertIn(
+            "Config datasource_probe_workers 'lots' is not an int",
+            self.logs.getvalue())
+
+
 class TestRedactSensitiveData(CiTestCase):
 
     def test_redact_sensitive_data_noop_when_no_sensitive_keys_present(self):
@@ -606,6 +898,62 @@ class TestRedactSensitiveData(CiTestCase):
             redact_sensitive_keys(md))
 
 
+class TestSerializeInstanceData(CiTestCase):
+
+    def _pipeline(self, instance_data, sensitive_keys):
+        """Return instance-data serialized as by separate passes."""
+        processed = process_instance_metadata(
+            json.loads(util.json_dumps(instance_data)),
+            sensitive_keys=sensitive_keys)
+        return (
+            json.dumps(processed, indent=1, sort_keys=True) + '\n',
+            json.dumps(redact_sensitive_keys(processed),
+                       indent=1, sort_keys=True) + '\n')
+
+    def test_serializes_as_separate_passes(self):
+        """The single walk renders what the separate passes render."""
+        instance_data = {
+            'ds': {'meta_data': {
+                'binary': b'\x00\xff', 'prefixed': 'ci-b64:Zm9v',
+                'list': [b'\x01', {'nested': b'\x02'}, (1, 2)],
+                'empty': {}, 'empty_list': [], 'float': 1.5, 'none': None,
+                'true': True, 'int_keys': {2: 'two', 10: 'ten'},
+                'text': u'\xfcnicode "quoted"\n',
+                'unserializable': Paths({})}},
+            'v1': {'instance-id': 'i-1'}}
+        self.assertEqual(
+            self._pipeline(instance_data, ()),
+            serialize_instance_data(instance_data))
+
+    def test_redacts_sensitive_keys(self):
+        """Sensitive keys are redacted from the second content only."""
+        instance_data = {
+            'ds': {'creds': {'security-credentials': {
+                'key': b'\x03', 'token': 's3kr1t'}},
+                'md': {'secure': 's3kr1t', 'insecure': 'publik'}}}
+        sensitive_keys = ('security-credentials', 'ds/md/secure')
+        (content, redacted_content) = serialize_instance_data(
+            instance_data, sensitive_keys, redact_value='redacted')
+        self.assertEqual(
+            self._pipeline(instance_data, sensitive_keys)[0], content)
+        self.assertEqual(
+            ['ds/creds/security-credentials/key'],
+            json.loads(content)['base64_encoded_keys'])
+        redacted = json.loads(redacted_content)
+        self.assertEqual(
+            ['ds/creds/security-credentials', 'ds/md/secure'],
+            redacted['sensitive_keys'])
+        self.assertEqual(
+            {'creds': {'security-credentials': 'redacted'},
+             'md': {'secure': 'redacted', 'insecure': 'publik'}},
+            redacted['ds'])
+
+    def test_unserializable_keys_raise_type_error(self):
+        """Keys json can not convert to strings raise TypeError."""
+        with self.assertRaises(TypeError):
+            serialize_instance_data({'ds': {('tuple', 'key'): 'value'}})
+
+
 class TestCanonicalCloudID(CiTestCase):
 
     def test_cloud_id_returns_platform_on_unknowns(self):
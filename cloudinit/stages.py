@@ -5,9 +5,12 @@
 # This file is part of cloud-init. See LICENSE file for license information.
 
 import copy
+import json
 import os
+import pkgutil
 import sys
 
+from concurrent import futures
 import six
 from six.moves import cPickle as pickle
 
@@ -28,6 +31,7 @@ from cloudinit.sources import NetworkConfigSource
 
 from cloudinit import cloud
 from cloudinit import config
+from cloudinit import config_view
 from cloudinit import distros
 from cloudinit import helpers
 from cloudinit import importer
@@ -44,13 +48,24 @@ LOG = logging.getLogger(__name__)
 NULL_DATA_SOURCE = None
 NO_PREVIOUS_INSTANCE_ID = "NO_PREVIOUS_INSTANCE_ID"
 
+# Version of the obj.json datasource cache format. Caches with any other
+# version are ignored and the datasource is discovered again.
+DS_CACHE_FORMAT_VERSION = 1
+DS_CACHE_FORMATS = ('pickle', 'json')
+
+# DataSource attributes which are provided fresh on restore and never cached
+DS_CACHE_SKIP_ATTRS = frozenset(
+    ['sys_cfg', 'distro', 'paths', 'ds_cfg', 'ud_proc'])
+
 
 class Init(object):
-    def __init__(self, ds_deps=None, reporter=None):
+    def __init__(self, ds_deps=None, reporter=None, base_cfg_snapshot=None):
         if ds_deps is not None:
             self.ds_deps = ds_deps
         else:
             self.ds_deps = [sources.DEP_FILESYSTEM, sources.DEP_NETWORK]
+        # Where the merged base config is snapshotted, if anywhere
+        self.base_cfg_snapshot = base_cfg_snapshot
         # Created on first use
         self._cfg = None
         self._paths = None
@@ -99,8 +114,8 @@ class Init(object):
     def _extract_cfg(self, restriction):
         # Ensure actually read
         self.read_cfg()
-        # Nobody gets the real config
-        ocfg = copy.deepcopy(self._cfg)
+        # Nobody gets the real config, only a copy-on-write view of it
+        ocfg = config_view.view(self._cfg)
         if restriction == 'restricted':
             ocfg.pop('system_info', None)
         elif restriction == 'system':
@@ -180,13 +195,18 @@ class Init(object):
         merger = helpers.ConfigMerger(paths=no_cfg_paths,
                                       datasource=self.datasource,
                                       additional_fns=extra_fns,
-                                      base_cfg=fetch_base_config())
+                                      base_cfg=fetch_base_config(
+                                          self.base_cfg_snapshot))
         return merger.cfg
 
     def _restore_from_cache(self):
         # We try to restore from a current link and static path
         # by using the instance link, if purge_cache was called
         # the file wont exist.
+        record = _json_load(self.paths.get_ipath_cur('obj_json'))
+        if record:
+            return _CachedDataSource(
+                record, self.cfg, self.distro, self.paths)
         return _pkl_load(self.paths.get_ipath_cur('obj_pkl'))
 
     def _write_to_cache(self):
@@ -198,7 +218,23 @@ class Init(object):
             util.write_file(
                 self.paths.get_ipath_cur("manual_clean_marker"),
                 omode="w", content="")
-        return _pkl_store(self.datasource, self.paths.get_ipath_cur("obj_pkl"))
+        ds = self.datasource
+        if isinstance(ds, _CachedDataSource):
+            ds = ds.resolve()
+            if ds is None:
+                return False
+        obj_json = self.paths.get_ipath_cur("obj_json")
+        obj_pkl = self.paths.get_ipath_cur("obj_pkl")
+        cache_format = self.cfg.get('datasource_cache_format', 'pickle')
+        if cache_format not in DS_CACHE_FORMATS:
+            LOG.warning("Unknown datasource_cache_format '%s', using pickle",
+                        cache_format)
+        elif cache_format == 'json':
+            if _json_store(ds, obj_json):
+                util.del_file(obj_pkl)
+                return True
+        util.del_file(obj_json)
+        return _pkl_store(ds, obj_pkl)
 
     def _get_datasources(self):
         # Any config provided???
@@ -224,6 +260,18 @@ class Init(object):
         else:
             run_iid = None
 
+        if isinstance(ds, _CachedDataSource):
+            # A json cached datasource of this instance is only rebuilt once
+            # it is used, so describe it by its cached class name. Any other
+            # is rebuilt now, a cache which no longer imports is a miss.
+            if run_iid == ds.get_instance_id() and ds.module_found():
+                return (ds, "restored from cache with run check: %s" %
+                        ds.cached_class)
+            cached_class = ds.cached_class
+            ds = ds.resolve()
+            if ds is None:
+                return (None, "cache invalid, failed restoring: %s" %
+                        cached_class)
         if run_iid == ds.get_instance_id():
             return (ds, "restored from cache with run check: %s" % ds)
         elif existing == "trust":
@@ -390,9 +438,7 @@ class Init(object):
         util.write_file(self._get_ipath('userdata_raw'), raw_ud, 0o600)
         # processed userdata is a Mime message, so write it as string.
         processed_ud = self.datasource.get_userdata()
-        if processed_ud is None:
-            raw_ud = ''
-        util.write_file(self._get_ipath('userdata'), str(processed_ud), 0o600)
+        util.write_message(self._get_ipath('userdata'), processed_ud, 0o600)
 
     def _store_vendordata(self):
         raw_vd = self.datasource.get_vendordata_raw()
@@ -400,11 +446,8 @@ class Init(object):
             raw_vd = b''
         util.write_file(self._get_ipath('vendordata_raw'), raw_vd, 0o600)
         # processed vendor data is a Mime message, so write it as string.
-        processed_vd = str(self.datasource.get_vendordata())
-        if processed_vd is None:
-            processed_vd = ''
-        util.write_file(self._get_ipath('vendordata'), str(processed_vd),
-                        0o600)
+        processed_vd = self.datasource.get_vendordata()
+        util.write_message(self._get_ipath('vendordata'), processed_vd, 0o600)
 
     def _default_handlers(self, opts=None):
         if opts is None:
@@ -639,7 +682,8 @@ class Init(object):
             NetworkConfigSource.cmdline: cmdline.read_kernel_cmdline_config(),
             NetworkConfigSource.initramfs: cmdline.read_initramfs_config(),
             NetworkConfigSource.ds: None,
-            NetworkConfigSource.system_cfg: self.cfg.get('network'),
+            NetworkConfigSource.system_cfg: config_view.thaw(
+                self.cfg.get('network')),
         }
 
         if self.datasource and hasattr(self.datasource, 'network_config'):
@@ -676,6 +720,12 @@ class Init(object):
             LOG.warning("Failed to rename devices: %s", e)
 
     def apply_network_config(self, bring_up):
+        # Datasource network config, device waits and renames all discover
+        # net devices; share a single snapshot of them.
+        with net.net_device_snapshot():
+            return self._apply_network_config(bring_up)
+
+    def _apply_network_config(self, bring_up):
         # get a network config
         netcfg, src = self._find_networking_config()
         if netcfg is None:
@@ -741,8 +791,8 @@ class Modules(object):
                                           base_cfg=self.init.cfg)
             self._cached_cfg = merger.cfg
             # LOG.debug("Loading 'module' config %s", self._cached_cfg)
-        # Only give out a copy so that others can't modify this...
-        return copy.deepcopy(self._cached_cfg)
+        # Only give out a copy-on-write view so others can't modify this...
+        return config_view.view(self._cached_cfg)
 
     def _read_modules(self, name):
         module_list = []
@@ -815,48 +865,116 @@ class Modules(object):
             mostly_mods.append([mod, raw_name, freq, run_args])
         return mostly_mods
 
+    def _run_module(self, cc, mod, name, freq, args):
+        """Run a single config module under its semaphore and event.
+
+        @return: Tuple of (ran, failure), ran being True once the module was
+            started and failure the exception it failed with or None.
+        """
+        ran = False
+        try:
+            # Try the modules frequency, otherwise fallback to a known one
+            if not freq:
+                freq = mod.frequency
+            if freq not in FREQUENCIES:
+                freq = PER_INSTANCE
+            LOG.debug("Running module %s (%s) with frequency %s",
+                      name, mod, freq)
+
+            # Use the configs logger and not our own
+            # TODO(harlowja): possibly check the module
+            # for having a LOG attr and just give it back
+            # its own logger?
+            mod_cfg = self.cfg
+            if mod.deepcopy_cfg:
+                # Legacy modules which need plain dicts and lists
+                mod_cfg = config_view.thaw(mod_cfg)
+            # Mark it as having started running
+            ran = True
+            # This name will affect the semaphore name created
+            run_name = "config-%s" % (name)
+
+            desc = "running %s with frequency %s" % (run_name, freq)
+            myrep = events.ReportEventStack(
+                name=run_name, description=desc, parent=self.reporter)
+            # Events the module reports are sub-events of its own
+            mod_cc = copy.copy(cc)
+            mod_cc.reporter = myrep
+            func_args = [name, mod_cfg,
+                         mod_cc, config.LOG, args]
+
+            with myrep:
+                did_run, _r = mod_cc.run(run_name, mod.handle, func_args,
+                                         freq=freq)
+                if did_run:
+                    myrep.message = "%s ran successfully" % run_name
+                else:
+                    myrep.message = "%s previously ran" % run_name
+
+        except Exception as e:
+            util.logexc(LOG, "Running module %s (%s) failed", name, mod)
+            return (ran, e)
+        return (ran, None)
+
+    def _get_module_workers(self):
+        """Return the configured module_workers, 1 meaning serial."""
+        workers = self.cfg.get('module_workers', 1)
+        try:
+            return max(1, int(workers))
+        except (TypeError, ValueError):
+            LOG.warning(
+                "Config module_workers '%s' is not an int, running modules"
+                " serially", workers)
+            return 1
+
+    def _run_modules_concurrently(self, cc, mostly_mods, workers):
+        """Run modules in a pool of workers, honoring their resources.
+
+        A module starts once every earlier module in the list which shares
+        a resource with it has finished. Modules which declare no resources
+        run alone, after all earlier modules and before all later ones.
+
+        @return: List of _run_module results, in the order of mostly_mods.
+        """
+        waits_for = config.module_dependencies(
+            [mod for (mod, _name, _freq, _args) in mostly_mods])
+        results = [None] * len(mostly_mods)
+        pending = list(range(len(mostly_mods)))
+        running = {}
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                for index in list(pending):
+                    if any(results[dep] is None for dep in waits_for[index]):
+                        continue
+                    pending.remove(index)
+                    future = executor.submit(
+                        self._run_module, cc, *mostly_mods[index])
+                    running[future] = index
+                (finished, _running) = futures.wait(
+                    running, return_when=futures.FIRST_COMPLETED)
+                for future in finished:
+                    results[running.pop(future)] = future.result()
+        return results
+
     def _run_modules(self, mostly_mods):
         cc = self.init.cloudify()
+        workers = self._get_module_workers()
+        if workers > 1 and len(mostly_mods) > 1:
+            results = self._run_modules_concurrently(
+                cc, mostly_mods, workers)
+        else:
+            results = [self._run_module(cc, *mostly_mod)
+                       for mostly_mod in mostly_mods]
         # Return which ones ran
         # and which ones failed + the exception of why it failed
         failures = []
         which_ran = []
-        for (mod, name, freq, args) in mostly_mods:
-            try:
-                # Try the modules frequency, otherwise fallback to a known one
-                if not freq:
-                    freq = mod.frequency
-                if freq not in FREQUENCIES:
-                    freq = PER_INSTANCE
-                LOG.debug("Running module %s (%s) with frequency %s",
-                          name, mod, freq)
-
-                # Use the configs logger and not our own
-                # TODO(harlowja): possibly check the module
-                # for having a LOG attr and just give it back
-                # its own logger?
-                func_args = [name, self.cfg,
-                             cc, config.LOG, args]
-                # Mark it as having started running
+        for ((_mod, name, _freq, _args), (ran, failure)) in zip(
+                mostly_mods, results):
+            if ran:
                 which_ran.append(name)
-                # This name will affect the semaphore name created
-                run_name = "config-%s" % (name)
-
-                desc = "running %s with frequency %s" % (run_name, freq)
-                myrep = events.ReportEventStack(
-                    name=run_name, description=desc, parent=self.reporter)
-
-                with myrep:
-                    ran, _r = cc.run(run_name, mod.handle, func_args,
-                                     freq=freq)
-                    if ran:
-                        myrep.message = "%s ran successfully" % run_name
-                    else:
-                        myrep.message = "%s previously ran" % run_name
-
-            except Exception as e:
-                util.logexc(LOG, "Running module %s (%s) failed", name, mod)
-                failures.append((name, e))
+            if failure is not None:
+                failures.append((name, failure))
         return (which_ran, failures)
 
     def run_single(self, mod_name, args=None, freq=None):
@@ -914,7 +1032,15 @@ def read_runtime_config():
     return util.read_conf(RUN_CLOUD_CONFIG)
 
 
-def fetch_base_config():
+def fetch_base_config(snapshot_file=None):
+    """Return the merged builtin, system, runtime and cmdline config.
+
+    @param snapshot_file: Optional path of a snapshot of the merged config.
+        A valid snapshot is returned instead of parsing and merging the
+        config files again. A missing or stale snapshot is rewritten.
+    """
+    if snapshot_file:
+        return _fetch_base_config_snapshot(snapshot_file)
     return util.mergemanydict(
         [
             # builtin config
@@ -928,6 +1054,32 @@ def fetch_base_config():
         ], reverse=True)
 
 
+def _fetch_base_config_snapshot(snapshot_file):
+    """Return base config from a valid snapshot_file or rewrite it."""
+    cfg = helpers.read_base_config_snapshot(snapshot_file)
+    if cfg is not None:
+        return cfg
+
+    # The key is taken before reading config, so that files changing while
+    # they are read invalidate the snapshot instead of going unnoticed.
+    key = helpers.base_config_key(
+        util.get_confd(CLOUD_CONFIG, util.read_conf(CLOUD_CONFIG)))
+    cfg = fetch_base_config()
+    try:
+        contents = json.dumps(
+            {'format': helpers.BASE_CFG_SNAPSHOT_FORMAT_VERSION, 'key': key,
+             'config': helpers.json_cache_encode(cfg)}, sort_keys=True)
+    except (TypeError, ValueError) as e:
+        LOG.debug("Unable to snapshot base config as json: %s", e)
+        return cfg
+    try:
+        util.write_file(snapshot_file, contents, omode="w", mode=0o600)
+    except (IOError, OSError) as e:
+        LOG.debug("Failed writing base config snapshot %s: %s",
+                  snapshot_file, e)
+    return cfg
+
+
 def _pkl_store(obj, fname):
     try:
         pk_contents = pickle.dumps(obj)
@@ -960,4 +1112,159 @@ def _pkl_load(fname):
         util.logexc(LOG, "Failed loading pickled blob from %s", fname)
         return None
 
+
+def _json_store(ds, fname):
+    """Write a versioned json cache record of datasource ds to fname.
+
+    The record holds the datasource class, its instance id and every
+    instance attribute except those in DS_CACHE_SKIP_ATTRS.
+
+    @return: False if ds has state which can not be represented in json.
+    """
+    state = dict((attr, value) for (attr, value) in vars(ds).items()
+                 if attr not in DS_CACHE_SKIP_ATTRS)
+    try:
+        record = {
+            'version': DS_CACHE_FORMAT_VERSION,
+            'module': type(ds).__module__,
+            'class': type(ds).__name__,
+            'instance_id': ds.get_instance_id(),
+            'state': helpers.json_cache_encode(state),
+        }
+        contents = json.dumps(record, sort_keys=True)
+    except (TypeError, ValueError) as e:
+        LOG.debug("Unable to cache datasource %s as json: %s", ds, e)
+        return False
+    try:
+        util.write_file(fname, contents, omode="w", mode=0o400)
+    except Exception:
+        util.logexc(LOG, "Failed writing datasource cache to %s", fname)
+        return False
+    return True
+
+
+def _json_load(fname):
+    """Load a json datasource cache record from fname.
+
+    Only the record is read, the datasource module is not imported.
+
+    @return: The record dict, or None if absent, invalid, incomplete or of
+        an unknown format version.
+    """
+    try:
+        contents = util.load_file(fname, quiet=True)
+    except Exception as e:
+        LOG.warning("failed loading datasource cache in %s: %s", fname, e)
+        return None
+    if not contents:
+        return None
+    try:
+        record = util.load_json(contents)
+    except (TypeError, ValueError):
+        util.logexc(LOG, "Failed loading datasource cache from %s", fname)
+        return None
+    if record.get('version') != DS_CACHE_FORMAT_VERSION:
+        LOG.debug("Ignoring datasource cache %s with version %s", fname,
+                  record.get('version'))
+        return None
+    missing = [key for key in ('module', 'class', 'instance_id', 'state')
+               if key not in record]
+    if missing:
+        LOG.warning("Ignoring datasource cache %s missing %s", fname,
+                    ', '.join(missing))
+        return None
+    return record
+
+
+class _CachedDataSource(object):
+    """Stand in for a datasource restored from a json cache record.
+
+    The instance id is answered from the record, so Init can decide whether
+    the cached datasource belongs to this instance without importing its
+    module. The datasource is rebuilt on first use of anything else, and
+    the proxy then delegates to it. Init only hands out a proxy whose
+    module is found. __class__ reports the rebuilt class, so
+    isinstance and type_utils.obj_name see the real datasource.
+    """
+
+    def __init__(self, record, sys_cfg, distro, paths):
+        self.__dict__.update(
+            _record=record, _sys_cfg=sys_cfg, _distro=distro, _paths=paths,
+            _ds=None)
+
+    @property
+    def __class__(self):
+        return type(self._resolved())
+
+    @property
+    def cached_class(self):
+        return self._record['class']
+
+    def get_instance_id(self):
+        if self._ds is None:
+            return self._record['instance_id']
+        return self._ds.get_instance_id()
+
+    def module_found(self):
+        """Return whether the datasource module can be found.
+
+        The module is located without being imported.
+        """
+        try:
+            return pkgutil.find_loader(self._record['module']) is not None
+        except (ImportError, ValueError):
+            return False
+
+    def resolve(self):
+        """Return the datasource, rebuilding it from the record once.
+
+        @return: The datasource, or None if it could not be rebuilt.
+        """
+        if self._ds is None:
+            self.__dict__['_ds'] = _ds_from_cache_record(
+                self._record, self._sys_cfg, self._distro, self._paths)
+        return self._ds
+
+    def _resolved(self):
+        ds = self.resolve()
+        if ds is None:
+            raise RuntimeError(
+                "Failed restoring datasource %s.%s from cache" % (
+                    self._record['module'], self.cached_class))
+        return ds
+
+    def __getattr__(self, name):
+        return getattr(self._resolved(), name)
+
+    def __setattr__(self, name, value):
+        if self._ds is None and name in ('sys_cfg', 'distro', 'paths'):
+            # Rebuild with the new value instead of rebuilding now
+            self.__dict__['_' + name] = value
+        else:
+            setattr(self._resolved(), name, value)
+
+    def __str__(self):
+        return str(self._resolved())
+
+
+def _ds_from_cache_record(record, sys_cfg, distro, paths):
+    """Rebuild the datasource described by a json cache record.
+
+    The datasource class is instantiated with the current sys_cfg, distro
+    and paths, so attributes added to the class since the record was written
+    get their defaults, and the cached state is then restored on top.
+
+    @return: The datasource, or None if it could not be rebuilt.
+    """
+    try:
+        mod = importer.import_module(record['module'])
+        cls = getattr(mod, record['class'])
+        ds = cls(sys_cfg, distro, paths)
+        ds.__dict__.update(helpers.json_cache_decode(record['state']))
+    except Exception:
+        util.logexc(LOG, "Failed restoring datasource %s.%s from cache",
+                    record.get('module'), record.get('class'))
+        return None
+    return ds
+
 # vi: ts=4 expandtab
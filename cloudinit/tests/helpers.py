@@ -11,10 +11,13 @@ import shutil
 import string
 import sys
 import tempfile
+import threading
 import time
 
 import mock
 import six
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
 import unittest2
 from unittest2.util import strclass
 
@@ -35,6 +38,7 @@ from cloudinit import distros
 from cloudinit import helpers as ch
 from cloudinit.sources import DataSourceNone
 from cloudinit.templater import JINJA_AVAILABLE
+from cloudinit import url_helper
 from cloudinit import util
 
 _real_subp = util.subp
@@ -96,6 +100,9 @@ class TestCase(unittest2.TestCase):
         util.PROC_CMDLINE = None
         util._DNS_REDIRECT_IP = None
         util._LSB_RELEASE = {}
+        util.clear_platform_facts()
+        util.clear_block_devices()
+        url_helper.close_pooled_sessions()
 
     def setUp(self):
         super(TestCase, self).setUp()
@@ -292,6 +299,7 @@ class FilesystemMockingTestCase(ResourceUsingTestCase):
     def patchUtils(self, new_root):
         patch_funcs = {
             util: [('write_file', 1),
+                   ('write_message', 1),
                    ('append_file', 1),
                    ('load_file', 1),
                    ('ensure_dir', 1),
@@ -395,6 +403,84 @@ class HttprettyTestCase(CiTestCase):
         super(HttprettyTestCase, self).tearDown()
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class LocalHTTPServer(object):
+    """A local http server standing in for a remote endpoint in tests.
+
+    Each request is recorded in requests as a (method, path, body) tuple and
+    answered with the next (status, delay) tuple of responses, or with 200
+    once responses are exhausted. Use it as a context manager:
+
+        with LocalHTTPServer(responses=[(500, 0)]) as server:
+            readurl(server.url, data='event', retries=1)
+    """
+
+    def __init__(self, responses=None):
+        self.responses = list(responses or [])
+        self.requests = []
+        self._cond = threading.Condition()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                self._respond(b'')
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self._respond(self.rfile.read(length))
+
+            def _respond(self, body):
+                (status, delay) = stand_in._record(
+                    (self.command, self.path, body))
+                if delay:
+                    time.sleep(delay)
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/' % self._server.server_address[1]
+        self._thread = None
+
+    def _record(self, request):
+        with self._cond:
+            self.requests.append(request)
+            self._cond.notify_all()
+            if self.responses:
+                return self.responses.pop(0)
+        return (200, 0)
+
+    def wait_for_requests(self, count, timeout=10):
+        """Return True once count requests were received within timeout."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while len(self.requests) < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
 class SchemaTestCaseMixin(unittest2.TestCase):
 
     def assertSchemaValid(self, cfg, msg="Valid Schema failed validation."):
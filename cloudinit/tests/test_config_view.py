@@ -0,0 +1,90 @@
+# This file is part of cloud-init. See LICENSE file for license information.
+
+"""Tests for cloudinit.config_view"""
+
+import copy
+import json
+import pickle
+
+from cloudinit import config_view
+from cloudinit import safeyaml
+from cloudinit.tests.helpers import CiTestCase
+
+
+def sample_cfg():
+    return {
+        'write_files': [{'path': '/etc/a', 'content': 'a' * 1024}],
+        'apt': {'sources': {'ppa': {'source': 'ppa:x/y'}}},
+        'runcmd': [['ls', '-l'], 'echo hi'],
+        'timezone': 'UTC',
+    }
+
+
+class TestConfigView(CiTestCase):
+
+    def setUp(self):
+        super(TestConfigView, self).setUp()
+        self.cfg = sample_cfg()
+        self.view = config_view.view(self.cfg)
+
+    def test_view_equals_and_is_instance_of_plain_types(self):
+        """Views compare equal to, and are instances of, dict and list."""
+        self.assertEqual(sample_cfg(), self.view)
+        self.assertIsInstance(self.view, dict)
+        self.assertIsInstance(self.view['write_files'], list)
+        self.assertIsInstance(self.view['write_files'][0], dict)
+
+    def test_changes_through_views_stay_private(self):
+        """Nested changes through a view never reach the shared config."""
+        self.view['write_files'][0]['path'] = '/etc/b'
+        self.view['apt']['sources'].pop('ppa')
+        self.view['runcmd'][0].append('/')
+        self.view.setdefault('runcmd', []).append('reboot')
+        for item in self.view['write_files']:
+            item['owner'] = 'root'
+        self.assertEqual(sample_cfg(), self.cfg)
+        self.assertEqual('/etc/b', self.view['write_files'][0]['path'])
+        self.assertEqual({}, self.view['apt']['sources'])
+        self.assertEqual(['ls', '-l', '/'], self.view['runcmd'][0])
+
+    def test_each_view_is_independent(self):
+        """Changes in one view are not seen by another view."""
+        self.view['apt']['sources']['other'] = {}
+        self.assertNotIn(
+            'other', config_view.view(self.cfg)['apt']['sources'])
+
+    def test_shallow_copies_do_not_alias_shared_config(self):
+        """dict(), copy(), slices and list concatenation hand out views."""
+        dict(self.view)['apt']['sources']['new'] = {}
+        self.view.copy()['write_files'][0]['path'] = '/x'
+        self.view['write_files'][:][0]['path'] = '/y'
+        (self.view['write_files'] + [])[0]['path'] = '/z'
+        list(self.view['write_files'])[0]['path'] = '/w'
+        dict(**self.view)['apt']['new'] = 1
+        self.assertEqual(sample_cfg(), self.cfg)
+
+    def test_thaw_and_deepcopy_return_plain_types(self):
+        """thaw and copy.deepcopy return plain independent copies."""
+        self.view['apt']['sources']['ppa']['keyid'] = 'F00'
+        for thawed in (config_view.thaw(self.view),
+                       copy.deepcopy(self.view)):
+            self.assertIs(dict, type(thawed))
+            self.assertIs(dict, type(thawed['apt']['sources']))
+            self.assertIs(list, type(thawed['write_files']))
+            self.assertEqual('F00', thawed['apt']['sources']['ppa']['keyid'])
+
+    def test_serialization(self):
+        """Views serialize like plain dicts and lists."""
+        self.view['apt']['sources'] = {}
+        expected = sample_cfg()
+        expected['apt']['sources'] = {}
+        self.assertEqual(expected, json.loads(json.dumps(self.view)))
+        self.assertEqual(expected, safeyaml.load(safeyaml.dumps(self.view)))
+        self.assertEqual(
+            expected,
+            safeyaml.load(safeyaml.dumps(self.view, noalias=True)))
+        unpickled = pickle.loads(pickle.dumps(self.view))
+        self.assertIs(dict, type(unpickled))
+        self.assertEqual(expected, unpickled)
+
+# vi: ts=4 expandtab
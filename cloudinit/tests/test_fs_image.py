@@ -0,0 +1,568 @@
+# This file is part of cloud-init. See LICENSE file for license information.
+
+"""Tests for cloudinit.fs_image"""
+
+import os
+import struct
+
+from cloudinit import fs_image
+from cloudinit import util
+from cloudinit.tests.helpers import CiTestCase, mock
+
+ISO_SECTOR = 2048
+FAT_SECTOR = 512
+
+SEED_FILES = {
+    'openstack/latest/meta_data.json': b'{"uuid": "1234"}',
+    'openstack/latest/user_data': b'#cloud-config\n' + b'x' * 5000,
+    'openstack/content/0000': b'',
+    'ec2/latest/meta-data.json': b'{}',
+}
+
+
+def _tree(files):
+    """Return nested dicts of directory names to dicts or file content."""
+    tree = {}
+    for (path, content) in files.items():
+        parts = path.split('/')
+        node = tree
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = content
+    return tree
+
+
+def _both16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def _both32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def _iso_record(name, extent, size, is_dir, system_use=b''):
+    pad = b'\x00' if len(name) % 2 == 0 else b''
+    if (len(name) + len(pad) + len(system_use)) % 2 == 0:
+        system_use += b'\x00'
+    length = 33 + len(name) + len(pad) + len(system_use)
+    return (struct.pack('<BB', length, 0) + _both32(extent) +
+            _both32(size) + b'\x00' * 7 +
+            struct.pack('<BBB', 0x02 if is_dir else 0, 0, 0) +
+            _both16(1) + struct.pack('<B', len(name)) + name + pad +
+            system_use)
+
+
+def _nm(name, flags=0):
+    return b'NM' + struct.pack('<BBB', 5 + len(name), 1, flags) + name
+
+
+def build_iso9660(path, files, joliet=False, rock_ridge=False,
+                  continuation=False, symlinks=()):
+    """Write an ISO9660 image holding files, a dict of path to bytes.
+
+    Plain ISO9660 names are upper cased, Joliet and Rock Ridge names are
+    kept as is. With continuation, Rock Ridge names are stored in CE areas.
+    Paths in symlinks get a Rock Ridge SL entry.
+    """
+    tree = _tree(files)
+    sectors = {}
+    next_sector = [18 + (1 if joliet else 0)]
+
+    def allocate(count):
+        start = next_sector[0]
+        next_sector[0] += max(count, 1)
+        return start
+
+    def name_of(variant, name, is_dir):
+        if variant == 'joliet':
+            name = name if is_dir else name + ';1'
+            return name.encode('utf-16-be')
+        return (name.upper() if is_dir else name.upper() + ';1').encode()
+
+    def children_of(node):
+        return sorted(node.items())
+
+    def dir_records(variant, node, dirpath, extents):
+        """Return list of (record bytes) for a directory."""
+        dot_su = b''
+        dotdot_su = b''
+        if variant == 'rr':
+            dotdot_su = _nm(b'', flags=0x04)
+            if dirpath == '':
+                dot_su = b'SP\x07\x01\xbe\xef\x00'
+        own = extents.get((variant, dirpath), (0, 0))
+        parent = extents.get(
+            (variant, os.path.dirname(dirpath)) if dirpath else
+            (variant, ''), (0, 0))
+        records = [_iso_record(b'\x00', own[0], own[1], True, dot_su),
+                   _iso_record(b'\x01', parent[0], parent[1], True,
+                               dotdot_su)]
+        for (name, child) in children_of(node):
+            child_path = os.path.join(dirpath, name)
+            is_dir = isinstance(child, dict)
+            if is_dir:
+                (extent, size) = extents.get((variant, child_path), (0, 0))
+            else:
+                (extent, size) = (sectors.get(child_path, 0), len(child))
+            system_use = b''
+            if variant == 'rr':
+                system_use = _nm(name.encode())
+                if continuation:
+                    block = sectors.get(('ce', child_path), 0)
+                    half = len(name) // 2
+                    ce_area = (_nm(name[:half].encode(), flags=0x01) +
+                               _nm(name[half:].encode()))
+                    sectors[('ce_area', child_path)] = ce_area
+                    system_use = (b'CE' + struct.pack('<BB', 28, 1) +
+                                  _both32(block) + _both32(0) +
+                                  _both32(len(ce_area)))
+                if child_path in symlinks:
+                    system_use += b'SL' + struct.pack('<BBB', 10, 1, 0) + (
+                        struct.pack('<BB', 0, 3) + b'etc')
+            records.append(_iso_record(
+                name_of(variant, name, is_dir), extent, size, is_dir,
+                system_use))
+        return records
+
+    def pack_dir(records):
+        data = b''
+        for record in records:
+            used = len(data) % ISO_SECTOR
+            if used + len(record) > ISO_SECTOR:
+                data += b'\x00' * (ISO_SECTOR - used)
+            data += record
+        if len(data) % ISO_SECTOR:
+            data += b'\x00' * (ISO_SECTOR - len(data) % ISO_SECTOR)
+        return data
+
+    def walk_dirs(node, dirpath=''):
+        yield (dirpath, node)
+        for (name, child) in children_of(node):
+            if isinstance(child, dict):
+                for item in walk_dirs(child, os.path.join(dirpath, name)):
+                    yield item
+
+    variants = ['rr' if rock_ridge else 'plain']
+    if joliet:
+        variants.append('joliet')
+    extents = {}
+    for variant in variants:
+        for (dirpath, node) in walk_dirs(tree):
+            size = len(pack_dir(dir_records(variant, node, dirpath, {})))
+            extents[(variant, dirpath)] = (
+                allocate(size // ISO_SECTOR), size)
+    for (file_path, content) in sorted(files.items()):
+        sectors[file_path] = allocate(
+            (len(content) + ISO_SECTOR - 1) // ISO_SECTOR)
+        if continuation:
+            sectors[('ce', file_path)] = allocate(1)
+    if continuation:
+        for (dirpath, _node) in walk_dirs(tree):
+            if dirpath:
+                sectors[('ce', dirpath)] = allocate(1)
+
+    with open(path, 'wb') as stream:
+        def write_at(sector, data):
+            stream.seek(sector * ISO_SECTOR)
+            stream.write(data)
+
+        for (index, variant) in enumerate(variants):
+            (root_extent, root_size) = extents[(variant, '')]
+            descriptor = bytearray(ISO_SECTOR)
+            descriptor[0:7] = struct.pack(
+                '<B5sB', 2 if variant == 'joliet' else 1, b'CD001', 1)
+            descriptor[80:88] = _both32(next_sector[0])
+            if variant == 'joliet':
+                descriptor[88:91] = b'%/E'
+            descriptor[128:132] = _both16(ISO_SECTOR)
+            descriptor[156:190] = _iso_record(
+                b'\x00', root_extent, root_size, True)
+            write_at(16 + index, bytes(descriptor))
+        write_at(16 + len(variants), b'\xffCD001\x01' + b'\x00' * 2041)
+        for variant in variants:
+            for (dirpath, node) in walk_dirs(tree):
+                write_at(extents[(variant, dirpath)][0], pack_dir(
+                    dir_records(variant, node, dirpath, extents)))
+        for (file_path, content) in files.items():
+            write_at(sectors[file_path], content)
+        for (key, value) in list(sectors.items()):
+            if isinstance(key, tuple) and key[0] == 'ce_area':
+                write_at(sectors[('ce', key[1])], value)
+        stream.truncate(next_sector[0] * ISO_SECTOR)
+
+
+def _lfn_checksum(short_name):
+    checksum = 0
+    for char in bytearray(short_name):
+        checksum = ((checksum >> 1) | ((checksum & 1) << 7)) + char
+        checksum &= 0xFF
+    return checksum
+
+
+def _fat_short_name(name):
+    """Return (8.3 name, NT case flags) if name needs no long name."""
+    base, dot, ext = name.partition('.')
+    if (not 0 < len(base) <= 8 or len(ext) > 3 or (dot and not ext) or
+            not (base + ext).replace('-', '').replace('_', '').isalnum()):
+        return None
+    nt_flags = 0
+    for (part, flag) in ((base, 0x08), (ext, 0x10)):
+        if part != part.upper():
+            if part != part.lower():
+                return None
+            nt_flags |= flag
+    return (base.upper().ljust(8) + ext.upper().ljust(3), nt_flags)
+
+
+def _fat_dir_entries(name, index, attr, cluster, size):
+    """Return directory entries for name, with long name entries if needed.
+    """
+    entries = []
+    if name in ('.', '..'):
+        (short, nt_flags) = (name.ljust(11), 0)
+    else:
+        (short, nt_flags) = _fat_short_name(name) or (None, 0)
+    if short is None:
+        short = ('F%06d' % index).ljust(8) + '   '
+        chars = name.encode('utf-16-le')
+        if len(chars) % 26:
+            chars += b'\x00\x00'
+            chars += b'\xff' * (-len(chars) % 26)
+        count = len(chars) // 26
+        checksum = _lfn_checksum(short.encode())
+        for sequence in range(count, 0, -1):
+            part = chars[(sequence - 1) * 26:sequence * 26]
+            flags = 0x40 if sequence == count else 0
+            entries.append(
+                struct.pack('<B', sequence | flags) + part[0:10] +
+                struct.pack('<BBB', 0x0F, 0, checksum) + part[10:22] +
+                b'\x00\x00' + part[22:26])
+    entries.append(
+        short.encode() + struct.pack('<BBB', attr, nt_flags, 0) +
+        b'\x00' * 6 + struct.pack('<H', cluster >> 16) + b'\x00' * 4 +
+        struct.pack('<HI', cluster & 0xFFFF, size))
+    return entries
+
+
+def build_vfat(path, files, fat32=False, sectors_per_cluster=1):
+    """Write a FAT12, or FAT32 with fat32, image holding files."""
+    tree = _tree(files)
+    if fat32:
+        (reserved, root_entries, total) = (32, 0, 70000)
+    else:
+        (reserved, root_entries, total) = (1, 224, 2880)
+    fats = 2
+    clusters = total // sectors_per_cluster
+    if fat32:
+        fat_size = (clusters * 4 + FAT_SECTOR - 1) // FAT_SECTOR
+    else:
+        fat_size = (clusters * 3 // 2 + FAT_SECTOR) // FAT_SECTOR
+    root_sectors = root_entries * 32 // FAT_SECTOR
+    data_start = reserved + fats * fat_size + root_sectors
+    cluster_size = FAT_SECTOR * sectors_per_cluster
+    fat = {0: 0x0FFFFFF8, 1: 0x0FFFFFFF}
+    next_cluster = [2]
+    blobs = {}
+    label = b'CIDATA     \x08' + b'\x00' * 20
+
+    def allocate(size):
+        count = max(1, (size + cluster_size - 1) // cluster_size)
+        start = next_cluster[0]
+        for cluster in range(start, start + count):
+            fat[cluster] = cluster + 1
+        fat[start + count - 1] = 0x0FFFFFFF
+        next_cluster[0] += count
+        return start
+
+    def dir_size(node):
+        return 64 + 32 * sum(
+            len(_fat_dir_entries(name, 0, 0, 0, 0)) for name in node)
+
+    def dir_data(node, own, parent):
+        entries = []
+        if own is not None:
+            entries += _fat_dir_entries('.', 0, 0x10, own, 0)
+            entries += _fat_dir_entries('..', 0, 0x10, parent, 0)
+        for (index, (name, child)) in enumerate(sorted(node.items())):
+            if isinstance(child, dict):
+                cluster = allocate(dir_size(child))
+                blobs[cluster] = dir_data(child, cluster, own or 0)
+                entries += _fat_dir_entries(name, index, 0x10, cluster, 0)
+            else:
+                cluster = 0
+                if child:
+                    cluster = allocate(len(child))
+                    blobs[cluster] = child
+                entries += _fat_dir_entries(
+                    name, index, 0x20, cluster, len(child))
+        return b''.join(entries)
+
+    root_cluster = 0
+    if fat32:
+        root_cluster = allocate(dir_size(tree))
+        blobs[root_cluster] = label + dir_data(tree, None, 0)
+    else:
+        root_data = label + dir_data(tree, None, 0)
+
+    boot = bytearray(FAT_SECTOR)
+    boot[0:11] = b'\xeb\x3c\x90MSWIN4.1'
+    struct.pack_into(
+        '<HBHBHHBHHHII', boot, 11, FAT_SECTOR, sectors_per_cluster,
+        reserved, fats, root_entries, 0 if fat32 else total, 0xF8,
+        0 if fat32 else fat_size, 32, 2, 0, total if fat32 else 0)
+    if fat32:
+        struct.pack_into('<IHHI', boot, 36, fat_size, 0, 0, root_cluster)
+    boot[510:512] = b'\x55\xaa'
+
+    fat_data = bytearray(fat_size * FAT_SECTOR)
+    for (cluster, value) in fat.items():
+        if fat32:
+            struct.pack_into('<I', fat_data, cluster * 4, value)
+            continue
+        value &= 0xFFF
+        offset = cluster + cluster // 2
+        (current, ) = struct.unpack_from('<H', fat_data, offset)
+        if cluster & 1:
+            current = (current & 0x000F) | (value << 4)
+        else:
+            current = (current & 0xF000) | value
+        struct.pack_into('<H', fat_data, offset, current)
+
+    with open(path, 'wb') as stream:
+        stream.write(bytes(boot))
+        for index in range(fats):
+            stream.seek((reserved + index * fat_size) * FAT_SECTOR)
+            stream.write(bytes(fat_data))
+        if not fat32:
+            stream.seek((reserved + fats * fat_size) * FAT_SECTOR)
+            stream.write(root_data)
+        for (cluster, data) in blobs.items():
+            stream.seek((data_start + (cluster - 2) * sectors_per_cluster) *
+                        FAT_SECTOR)
+            stream.write(data)
+        stream.truncate(total * FAT_SECTOR)
+
+
+class TestIso9660Image(CiTestCase):
+
+    def _image(self, files=None, **kwargs):
+        path = self.tmp_path('seed.iso')
+        build_iso9660(path, SEED_FILES if files is None else files, **kwargs)
+        return path
+
+    def test_plain_names_are_lower_cased(self):
+        """Plain ISO9660 names are read like the kernel maps them."""
+        path = self._image({'CONTEXT.SH': b'ctx', 'DATA/A.TXT': b'a'})
+        with fs_image.open_image(path) as image:
+            self.assertEqual('iso9660', image.fstype)
+            self.assertEqual(['context.sh', 'data'], image.listdir())
+            self.assertEqual(b'a', image.read_file('data/a.txt'))
+
+    def test_joliet_names(self):
+        """Joliet names are used over plain names."""
+        path = self._image(joliet=True)
+        with fs_image.open_image(path) as image:
+            self.assertTrue(image.joliet)
+            self.assertEqual(
+                ['content', 'latest'], image.listdir('/openstack'))
+            for (name, content) in SEED_FILES.items():
+                self.assertEqual(content, image.read_file(name))
+
+    def test_rock_ridge_names_preferred_over_joliet(self):
+        """Rock Ridge names are used when present, as the kernel does."""
+        path = self._image(joliet=True, rock_ridge=True)
+        with fs_image.open_image(path) as image:
+            self.assertTrue(image.rock_ridge)
+            self.assertFalse(image.joliet)
+            self.assertEqual(
+                sorted(SEED_FILES),
+                sorted(p for (p, is_dir, _s) in image.walk() if not is_dir))
+
+    def test_rock_ridge_names_in_continuation_areas(self):
+        """Rock Ridge names split over NM and CE entries are joined."""
+        path = self._image(rock_ridge=True, continuation=True)
+        with fs_image.open_image(path) as image:
+            self.assertEqual(
+                SEED_FILES['openstack/latest/user_data'],
+                image.read_file('openstack/latest/user_data'))
+
+    def test_rock_ridge_symlinks_unsupported(self):
+        """Images with symlinks raise ImageError, to be mounted instead."""
+        path = self._image(
+            rock_ridge=True, symlinks=('openstack/latest/user_data',))
+        with fs_image.open_image(path) as image:
+            with self.assertRaises(fs_image.ImageError):
+                list(image.walk())
+
+    def test_directories_spanning_sectors(self):
+        """Directory records continue in the next sector."""
+        files = dict(('dir/file-with-long-name-%03d' % i, b'%d' % i)
+                     for i in range(120))
+        path = self._image(files, joliet=True)
+        with fs_image.open_image(path) as image:
+            self.assertEqual(sorted(name.split('/')[1] for name in files),
+                             sorted(image.listdir('dir')))
+            self.assertEqual(b'119',
+                             image.read_file('dir/file-with-long-name-119'))
+
+    def test_missing_file_raises_ioerror(self):
+        """Reading an absent file raises IOError like open does."""
+        path = self._image()
+        with fs_image.open_image(path) as image:
+            with self.assertRaises(IOError):
+                image.read_file('openstack/latest/vendor_data.json')
+
+
+class TestVfatImage(CiTestCase):
+
+    files = {
+        'user-data': b'#cloud-config\n' + b'y' * 3000,
+        'meta-data': b'instance-id: iid-1\n',
+        'README.TXT': b'readme',
+        'vendor.dat': b'vendor',
+        'empty': b'',
+        'scripts/Per-Boot Script.sh': b'#!/bin/sh\n',
+    }
+
+    def test_fat12_long_and_short_names(self):
+        """Long names, short names and case flags are read on FAT12."""
+        path = self.tmp_path('cidata.img')
+        build_vfat(path, self.files, sectors_per_cluster=2)
+        with fs_image.open_image(path) as image:
+            self.assertEqual('vfat', image.fstype)
+            self.assertEqual(12, image.fat_bits)
+            self.assertEqual(sorted(self.files), sorted(
+                p for (p, is_dir, _s) in image.walk() if not is_dir))
+            for (name, content) in self.files.items():
+                self.assertEqual(content, image.read_file(name))
+
+    def test_lookups_ignore_case(self):
+        """Lookups ignore case like the vfat kernel driver."""
+        path = self.tmp_path('cidata.img')
+        build_vfat(path, self.files)
+        with fs_image.open_image(path) as image:
+            self.assertEqual(b'readme', image.read_file('readme.txt'))
+            self.assertEqual(
+                b'#!/bin/sh\n', image.read_file('SCRIPTS/per-boot script.sh'))
+
+    def test_fat32(self):
+        """FAT32 images with the root directory in clusters are read."""
+        path = self.tmp_path('cidata.img')
+        build_vfat(path, self.files, fat32=True)
+        with fs_image.open_image(path) as image:
+            self.assertEqual(32, image.fat_bits)
+            self.assertEqual(self.files['user-data'],
+                             image.read_file('user-data'))
+
+
+class TestOpenImage(CiTestCase):
+
+    def test_unknown_content_raises_image_error(self):
+        """Files which are not ISO9660 or VFAT raise ImageError."""
+        path = self.tmp_path('disk.img')
+        util.write_file(path, b'\x00' * 64 * 1024, omode='wb')
+        with self.assertRaises(fs_image.ImageError):
+            fs_image.open_image(path)
+
+    def test_missing_device_raises_image_error(self):
+        """Unreadable devices raise ImageError."""
+        with self.assertRaises(fs_image.ImageError):
+            fs_image.open_image(self.tmp_path('missing'))
+
+    def test_fstypes_limit_accepted_images(self):
+        """Images not of the requested fstypes raise ImageError."""
+        path = self.tmp_path('seed.iso')
+        build_iso9660(path, SEED_FILES)
+        with self.assertRaises(fs_image.ImageError):
+            fs_image.open_image(path, fstypes=['vfat'])
+
+    def test_extract_image_copies_all_files(self):
+        """extract_image copies the whole tree into target."""
+        path = self.tmp_path('seed.iso')
+        build_iso9660(path, SEED_FILES, joliet=True)
+        target = self.tmp_dir()
+        self.assertEqual('iso9660', fs_image.extract_image(path, target))
+        for (name, content) in SEED_FILES.items():
+            self.assertEqual(
+                content, util.load_file(os.path.join(target, name),
+                                        decode=False))
+
+    def test_extract_vfat_image_aliases_lower_case_names(self):
+        """Upper case vfat names are also found by their lower case name."""
+        path = self.tmp_path('cidata.img')
+        build_vfat(path, {'USER-DATA': b'#cloud-config\n',
+                          'META-DATA': b'instance-id: iid-1\n',
+                          'Scripts/Per-Boot.sh': b'#!/bin/sh\n'})
+        target = self.tmp_dir()
+        self.assertEqual('vfat', fs_image.extract_image(path, target))
+        self.assertEqual(
+            ['META-DATA', 'Scripts', 'USER-DATA', 'meta-data', 'scripts',
+             'user-data'], sorted(os.listdir(target)))
+        self.assertEqual(
+            b'#cloud-config\n',
+            util.load_file(os.path.join(target, 'user-data'), decode=False))
+        self.assertEqual(
+            b'#!/bin/sh\n', util.load_file(
+                os.path.join(target, 'scripts/per-boot.sh'), decode=False))
+
+    def test_extract_image_max_bytes_leaves_target_empty(self):
+        """Images holding more than max_bytes raise and leave no files."""
+        path = self.tmp_path('seed.iso')
+        build_iso9660(path, SEED_FILES, joliet=True)
+        target = self.tmp_dir()
+        with self.assertRaises(fs_image.ImageError):
+            fs_image.extract_image(path, target, max_bytes=1024)
+        self.assertEqual([], os.listdir(target))
+
+
+class TestMountCbReadsImages(CiTestCase):
+
+    with_logs = True
+
+    def setUp(self):
+        super(TestMountCbReadsImages, self).setUp()
+        self.add_patch('cloudinit.util.mounts', 'm_mounts', return_value={})
+
+    def test_seed_image_read_without_mounting(self):
+        """mount_cb passes a copy of image files without running mount."""
+        path = self.tmp_path('cidata.img')
+        build_vfat(path, TestVfatImage.files)
+
+        def callback(mountpoint):
+            return util.load_file(os.path.join(mountpoint, 'meta-data'))
+
+        self.assertEqual(
+            'instance-id: iid-1\n', util.mount_cb(path, callback))
+        self.assertIn('without mounting', self.logs.getvalue())
+
+    def test_upper_case_seed_image_read_by_lower_case_names(self):
+        """mount_cb finds user-data on a vfat image holding USER-DATA."""
+        path = self.tmp_path('cidata.img')
+        build_vfat(path, {'USER-DATA': b'#cloud-config\n',
+                          'META-DATA': b'instance-id: iid-1\n'})
+
+        def callback(mountpoint):
+            return util.load_file(os.path.join(mountpoint, 'user-data'))
+
+        self.assertEqual('#cloud-config\n', util.mount_cb(path, callback))
+        self.assertIn('without mounting', self.logs.getvalue())
+
+    @mock.patch('cloudinit.util.subp')
+    def test_mount_when_type_not_readable(self, m_subp):
+        """mount_cb mounts when the image does not match mtype."""
+        path = self.tmp_path('seed.iso')
+        build_iso9660(path, SEED_FILES)
+        util.mount_cb(path, lambda mountpoint: None, mtype='vfat')
+        self.assertEqual('mount', m_subp.call_args_list[0][0][0][0])
+
+    @mock.patch('cloudinit.util.subp')
+    def test_mount_when_not_an_image(self, m_subp):
+        """mount_cb mounts devices which are not ISO9660 or VFAT."""
+        path = self.tmp_path('disk.img')
+        util.write_file(path, b'\x00' * 64 * 1024, omode='wb')
+        util.mount_cb(path, lambda mountpoint: None)
+        self.assertEqual('mount', m_subp.call_args_list[0][0][0][0])
+        self.assertIn(
+            'Unable to read %s without mounting' % path, self.logs.getvalue())
+
+# vi: ts=4 expandtab
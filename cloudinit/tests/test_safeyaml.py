@@ -0,0 +1,83 @@
+# This file is part of cloud-init. See LICENSE file for license information.
+
+"""Tests for cloudinit.safeyaml"""
+
+import glob
+import os
+
+from cloudinit import safeyaml
+from cloudinit import templater
+from cloudinit.tests.helpers import (
+    CiTestCase, resourceLocation, skipIf, skipUnlessJinja)
+
+# Variants config/cloud.cfg.tmpl is rendered for, see tools/render-cloudcfg
+CLOUD_CFG_VARIANTS = ('centos', 'debian', 'freebsd', 'suse', 'ubuntu')
+
+
+def yaml_corpus():
+    """Return a dict of real world yaml documents keyed by their path."""
+    patterns = [
+        os.path.join('config', 'cloud.cfg.d', '*.cfg'),
+        os.path.join('doc', 'examples', 'cloud-config*.txt'),
+        os.path.join('doc', 'examples', 'seed', '*-data'),
+        resourceLocation(os.path.join('merge_sources', '*.yaml')),
+        resourceLocation(os.path.join('safeyaml', '*.yaml')),
+    ]
+    corpus = {}
+    for pattern in patterns:
+        for fname in sorted(glob.glob(pattern)):
+            with open(fname) as stream:
+                corpus[fname] = stream.read()
+    return corpus
+
+
+@skipIf('libyaml' not in safeyaml.LOADERS, 'PyYAML built without libyaml')
+class TestBackendParity(CiTestCase):
+    """The libyaml backend gives the same results as the python backend."""
+
+    def assertParity(self, blob, msg=None):
+        self.assertEqual(
+            safeyaml.load(blob, backend='python'),
+            safeyaml.load(blob, backend='libyaml'), msg)
+
+    def test_corpus_parity(self):
+        """Cloud config, user-data and network config load alike."""
+        corpus = yaml_corpus()
+        self.assertGreater(len(corpus), 40)
+        for (fname, blob) in corpus.items():
+            self.assertParity(blob, fname)
+
+    @skipUnlessJinja()
+    def test_cloud_cfg_parity(self):
+        """Rendered config/cloud.cfg.tmpl loads alike."""
+        with open(os.path.join('config', 'cloud.cfg.tmpl')) as stream:
+            tmpl = stream.read()
+        for variant in CLOUD_CFG_VARIANTS:
+            self.assertParity(
+                templater.render_string(tmpl, {'variant': variant}), variant)
+
+    def test_python_unicode_tag(self):
+        """Both backends load !!python/unicode as a plain string."""
+        blob = 'key: !!python/unicode "value"\n'
+        for backend in ('python', 'libyaml'):
+            self.assertEqual(
+                {'key': 'value'}, safeyaml.load(blob, backend=backend))
+
+    def test_errors_are_reported_as_by_python_backend(self):
+        """Yaml errors carry the python backend's message and marks."""
+        blob = 'a: b\n c: d: e\n'
+        errors = []
+        for backend in ('python', 'libyaml'):
+            with self.assertRaises(safeyaml.YAMLError) as context_manager:
+                safeyaml.load(blob, backend=backend)
+            errors.append(str(context_manager.exception))
+        self.assertEqual(errors[0], errors[1])
+
+    def test_unsafe_tags_are_rejected(self):
+        """Neither backend constructs arbitrary python objects."""
+        blob = '!!python/object/apply:os.system ["true"]\n'
+        for backend in ('python', 'libyaml'):
+            with self.assertRaises(safeyaml.YAMLError):
+                safeyaml.load(blob, backend=backend)
+
+# vi: ts=4 expandtab
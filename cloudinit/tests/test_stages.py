@@ -2,14 +2,22 @@
 
 """Tests related to cloudinit.stages module."""
 
+import json
 import os
+import sys
+import threading
+import types
 
+from cloudinit import config
 from cloudinit import stages
 from cloudinit import sources
 from cloudinit.sources import NetworkConfigSource
 
 from cloudinit.event import EventType
-from cloudinit.util import write_file
+from cloudinit import helpers
+from cloudinit.reporting import events
+from cloudinit import type_utils
+from cloudinit.util import load_file, write_file
 
 from cloudinit.tests.helpers import CiTestCase, mock
 
@@ -36,6 +44,24 @@ class FakeDataSource(sources.DataSource):
         return True
 
 
+class CacheableDataSource(sources.DataSource):
+
+    dsname = 'Cacheable'
+
+    def __init__(self, sys_cfg, distro, paths):
+        super(CacheableDataSource, self).__init__(sys_cfg, distro, paths)
+        self.added_in_new_release = 'default'
+
+    def _get_data(self):
+        self.metadata = {'instance-id': TEST_INSTANCE_ID,
+                         'public-keys': ['key1'], 'blob': b'\x00\xff'}
+        self.userdata_raw = b'#cloud-config\n{}'
+        self.vendordata_raw = None
+        self._network_config = {'version': 1, 'config': []}
+        self.seen = ('a', 1)
+        return True
+
+
 class TestInit(CiTestCase):
     with_logs = True
     allowed_subp = False
@@ -341,4 +367,343 @@ class TestInit(CiTestCase):
         self.init.distro.apply_network_config.assert_called_with(
             net_cfg, bring_up=True)
 
+
+class TestDataSourceJsonCache(CiTestCase):
+
+    with_logs = True
+
+    def setUp(self):
+        super(TestDataSourceJsonCache, self).setUp()
+        self.tmpdir = self.tmp_dir()
+        self.paths = helpers.Paths(
+            {'cloud_dir': self.tmpdir, 'run_dir': self.tmpdir})
+        self.ds = CacheableDataSource({}, None, self.paths)
+        self.ds.get_data()
+        self.fname = self.tmp_path('obj.json', self.tmpdir)
+
+    def test_json_cache_round_trips_datasource_state(self):
+        """A json cached datasource is restored with identical state."""
+        self.assertTrue(stages._json_store(self.ds, self.fname))
+        record = stages._json_load(self.fname)
+        self.assertEqual(TEST_INSTANCE_ID, record['instance_id'])
+        self.assertEqual('CacheableDataSource', record['class'])
+        sys_cfg = {'datasource': {'Cacheable': {'key': 'value'}}}
+        ds = stages._ds_from_cache_record(record, sys_cfg, 'distro',
+                                          self.paths)
+        self.assertIsInstance(ds, CacheableDataSource)
+        self.assertEqual(self.ds.metadata, ds.metadata)
+        self.assertEqual(b'#cloud-config\n{}', ds.userdata_raw)
+        self.assertEqual(('a', 1), ds.seen)
+        self.assertEqual({'version': 1, 'config': []}, ds._network_config)
+        self.assertEqual({'key': 'value'}, ds.ds_cfg)
+        self.assertEqual('distro', ds.distro)
+
+    def test_json_cache_restores_processed_userdata(self):
+        """Processed userdata messages survive the json cache."""
+        self.ds.get_userdata()
+        self.assertTrue(stages._json_store(self.ds, self.fname))
+        ds = stages._ds_from_cache_record(
+            stages._json_load(self.fname), {}, None, self.paths)
+        self.assertEqual(
+            self.ds.userdata.as_string(), ds.userdata.as_string())
+
+    def test_json_cache_restore_gives_new_attributes_defaults(self):
+        """Attributes missing from an older cache get their defaults."""
+        del self.ds.added_in_new_release
+        self.assertTrue(stages._json_store(self.ds, self.fname))
+        ds = stages._ds_from_cache_record(
+            stages._json_load(self.fname), {}, None, self.paths)
+        self.assertEqual('default', ds.added_in_new_release)
+
+    def test_json_store_refuses_unserializable_state(self):
+        """Datasources with state json can not represent are not cached."""
+        self.ds.client = object()
+        self.assertFalse(stages._json_store(self.ds, self.fname))
+        self.assertFalse(os.path.exists(self.fname))
+
+    def test_json_load_ignores_other_format_versions(self):
+        """Cache records of another format version are ignored."""
+        write_file(self.fname, '{"version": 0, "instance_id": "i-old"}')
+        self.assertIsNone(stages._json_load(self.fname))
+        self.assertIsNone(stages._json_load(self.fname + '.missing'))
+
+    def test_ds_from_cache_record_unknown_class_returns_none(self):
+        """A cache naming a class which no longer exists is not used."""
+        self.assertTrue(stages._json_store(self.ds, self.fname))
+        record = stages._json_load(self.fname)
+        record['class'] = 'RemovedDataSource'
+        self.assertIsNone(
+            stages._ds_from_cache_record(record, {}, None, self.paths))
+        self.assertIn('Failed restoring datasource', self.logs.getvalue())
+
+    def _init(self, cache_format):
+        init = stages.Init()
+        cfg = {
+            'datasource_cache_format': cache_format,
+            'system_info': {
+                'distro': 'ubuntu', 'paths': {'cloud_dir': self.tmpdir,
+                                              'run_dir': self.tmpdir}}}
+        init._cfg = cfg
+        init.datasource = CacheableDataSource({}, None, init.paths)
+        init.datasource.get_data()
+        init._paths = None  # Recreate paths referencing the datasource
+        init._reflect_cur_instance()
+        init._cfg = cfg  # Restore config reset by _reflect_cur_instance
+        return init
+
+    def test_write_to_cache_json_format(self):
+        """datasource_cache_format json writes obj.json and drops obj.pkl."""
+        init = self._init('pickle')
+        self.assertTrue(init._write_to_cache())
+        obj_pkl = init.paths.get_ipath_cur('obj_pkl')
+        obj_json = init.paths.get_ipath_cur('obj_json')
+        self.assertTrue(os.path.exists(obj_pkl))
+        init = self._init('json')
+        self.assertTrue(init._write_to_cache())
+        self.assertFalse(os.path.exists(obj_pkl))
+        self.assertEqual(
+            TEST_INSTANCE_ID, json.loads(load_file(obj_json))['instance_id'])
+        ds = init._restore_from_cache()
+        self.assertIsInstance(ds, CacheableDataSource)
+        self.assertEqual(init.datasource.metadata, ds.metadata)
+
+    def test_same_instance_restore_does_not_import_datasource(self):
+        """A json cache of this instance is restored without importing."""
+        init = self._init('json')
+        self.assertTrue(init._write_to_cache())
+        obj_json = init.paths.get_ipath_cur('obj_json')
+        record = json.loads(load_file(obj_json))
+        moddir = self.tmp_dir()
+        write_file(
+            os.path.join(moddir, 'lazycachedds.py'),
+            'from cloudinit.tests.test_stages import CacheableDataSource\n'
+            'class LazyDataSource(CacheableDataSource):\n'
+            '    pass\n')
+        sys.path.insert(0, moddir)
+        self.addCleanup(sys.path.remove, moddir)
+        self.addCleanup(sys.modules.pop, 'lazycachedds', None)
+        record.update(module='lazycachedds', **{'class': 'LazyDataSource'})
+        write_file(obj_json, json.dumps(record))
+        write_file(init.paths.get_runpath('instance_id'), TEST_INSTANCE_ID)
+        init.datasource = stages.NULL_DATA_SOURCE
+        ds = init.fetch()
+        self.assertTrue(init.ds_restored)
+        self.assertEqual(TEST_INSTANCE_ID, ds.get_instance_id())
+        self.assertNotIn('lazycachedds', sys.modules)
+        self.assertIn(
+            'restored from cache with run check: LazyDataSource',
+            self.logs.getvalue())
+        self.assertEqual(self.ds.metadata, ds.metadata)
+        self.assertIn('lazycachedds', sys.modules)
+        self.assertEqual('LazyDataSource', type_utils.obj_name(ds))
+        self.assertIsInstance(ds, CacheableDataSource)
+
+    def test_changed_instance_restore_checks_instance_id(self):
+        """A json cache of another instance asks the datasource to check."""
+        init = self._init('json')
+        self.assertTrue(init._write_to_cache())
+        write_file(init.paths.get_runpath('instance_id'), 'i-other')
+        init.datasource = stages.NULL_DATA_SOURCE
+        with mock.patch.object(
+                CacheableDataSource, 'check_instance_id',
+                return_value=True) as m_check:
+            (ds, desc) = init._restore_from_checked_cache('check')
+        m_check.assert_called_once_with(init.cfg)
+        self.assertEqual('restored from checked cache: %s' % ds, desc)
+        self.assertEqual(self.ds.metadata, ds.metadata)
+
+    def test_json_load_ignores_incomplete_records(self):
+        """Cache records missing required keys are ignored."""
+        write_file(self.fname, json.dumps(
+            {'version': stages.DS_CACHE_FORMAT_VERSION, 'module': 'm'}))
+        self.assertIsNone(stages._json_load(self.fname))
+        self.assertIn('missing class, instance_id, state',
+                      self.logs.getvalue())
+
+    def test_json_load_ignores_non_record_payloads(self):
+        """Valid json which is not a cache record is ignored."""
+        for payload in ('[1, 2]', '"text"', '{"version": "1"}'):
+            write_file(self.fname, payload)
+            self.assertIsNone(stages._json_load(self.fname))
+
+    def test_unimportable_cached_datasource_is_a_cache_miss(self):
+        """A cache naming a module which no longer imports is not used."""
+        init = self._init('json')
+        self.assertTrue(init._write_to_cache())
+        obj_json = init.paths.get_ipath_cur('obj_json')
+        record = json.loads(load_file(obj_json))
+        record['module'] = 'cloudinit.sources.DataSourceRemoved'
+        write_file(obj_json, json.dumps(record))
+        for (run_iid, existing) in ((TEST_INSTANCE_ID, 'check'),
+                                    ('i-other', 'check'),
+                                    ('i-other', 'trust')):
+            write_file(init.paths.get_runpath('instance_id'), run_iid)
+            self.assertEqual(
+                (None, 'cache invalid, failed restoring: '
+                       'CacheableDataSource'),
+                init._restore_from_checked_cache(existing))
+        self.assertIn('Failed restoring datasource', self.logs.getvalue())
+        init.datasource = stages.NULL_DATA_SOURCE
+        with mock.patch.object(stages.sources, 'find_source',
+                               return_value=(self.ds, 'Cacheable')):
+            self.assertIs(self.ds, init.fetch())
+        self.assertFalse(init.ds_restored)
+
+    def test_write_to_cache_json_falls_back_to_pickle(self):
+        """Datasources which can not be cached as json are pickled."""
+        init = self._init('json')
+        init.datasource.unserializable = set([1])
+        self.assertTrue(init._write_to_cache())
+        self.assertTrue(os.path.exists(init.paths.get_ipath_cur('obj_pkl')))
+        self.assertFalse(
+            os.path.exists(init.paths.get_ipath_cur('obj_json')))
+        self.assertEqual(
+            set([1]), init._restore_from_cache().unserializable)
+
+
+class FakeCloud(object):
+    """Run module handlers like Cloud.run, without semaphores."""
+
+    def run(self, name, functor, args, freq=None):
+        return (True, functor(*args))
+
+
+def fake_module(name, handle, resources=None):
+    mod = types.ModuleType('cc_%s' % name)
+    mod.handle = handle
+    mod.frequency = 'always'
+    if resources is not None:
+        mod.resources = resources
+    return [config.fixup_module(mod), name, None, []]
+
+
+class TestModules(CiTestCase):
+
+    def setUp(self):
+        super(TestModules, self).setUp()
+        self.init = mock.MagicMock()
+        self.init.cloudify.return_value = FakeCloud()
+        self.modules = stages.Modules(self.init)
+        self.modules._cached_cfg = {'module_workers': 4}
+        self.events = []
+        self.lock = threading.Lock()
+
+    def _recording_handle(self, fail=False, barrier=None):
+        def handle(name, cfg, cloud, log, args):
+            with self.lock:
+                self.events.append(('start', name))
+            if barrier:
+                barrier.wait()
+            with self.lock:
+                self.events.append(('end', name))
+            if fail:
+                raise RuntimeError('%s failed' % name)
+        return handle
+
+    def test_module_dependencies(self):
+        """Modules wait for earlier ones sharing resources or undeclared."""
+        mods = [mod for (mod, _n, _f, _a) in [
+            fake_module('a', None, ['ssh']),
+            fake_module('b', None, ['ntp']),
+            fake_module('c', None, ['ssh', 'ntp']),
+            fake_module('d', None),
+            fake_module('e', None, [])]]
+        self.assertEqual(
+            [[], [], [0, 1], [0, 1, 2], [3]],
+            config.module_dependencies(mods))
+
+    def test_independent_modules_run_concurrently(self):
+        """Modules with disjoint resources run at the same time."""
+        barrier = threading.Barrier(2, timeout=5)
+        mostly_mods = [
+            fake_module('ntp', self._recording_handle(barrier=barrier),
+                        ['ntp']),
+            fake_module('ssh', self._recording_handle(barrier=barrier),
+                        ['ssh'])]
+        self.assertEqual(
+            (['ntp', 'ssh'], []), self.modules._run_modules(mostly_mods))
+
+    def test_conflicting_and_undeclared_modules_run_in_order(self):
+        """Modules sharing resources, or without any, run in list order."""
+        mostly_mods = [
+            fake_module('first', self._recording_handle(), ['ssh']),
+            fake_module('second', self._recording_handle(), ['ssh']),
+            fake_module('anything', self._recording_handle()),
+            fake_module('last', self._recording_handle(), ['ntp'])]
+        self.modules._run_modules(mostly_mods)
+        self.assertEqual(
+            [('start', 'first'), ('end', 'first'),
+             ('start', 'second'), ('end', 'second'),
+             ('start', 'anything'), ('end', 'anything'),
+             ('start', 'last'), ('end', 'last')], self.events)
+
+    def test_failures_reported_in_module_order(self):
+        """which_ran and failures keep module order when run concurrently."""
+        mostly_mods = [
+            fake_module('a', self._recording_handle(fail=True), ['a']),
+            fake_module('b', self._recording_handle(), ['b']),
+            fake_module('c', self._recording_handle(fail=True), ['c'])]
+        (which_ran, failures) = self.modules._run_modules(mostly_mods)
+        self.assertEqual(['a', 'b', 'c'], which_ran)
+        self.assertEqual(
+            ['a', 'c'], [name for (name, _exc) in failures])
+        self.assertEqual('c failed', str(failures[1][1]))
+
+    def test_serial_without_module_workers(self):
+        """Without module_workers modules run serially in list order."""
+        self.modules._cached_cfg = {}
+        mostly_mods = [
+            fake_module(name, self._recording_handle(), [name])
+            for name in ('a', 'b')]
+        self.assertEqual(
+            (['a', 'b'], []), self.modules._run_modules(mostly_mods))
+        self.assertEqual(
+            [('start', 'a'), ('end', 'a'), ('start', 'b'), ('end', 'b')],
+            self.events)
+
+    def test_modules_get_private_config_views(self):
+        """Config changes made by one module are not seen by the next."""
+        self.modules._cached_cfg = {'ntp': {'servers': ['a']}}
+        seen = []
+
+        def change(name, cfg, cloud, log, args):
+            seen.append(list(cfg['ntp']['servers']))
+            cfg['ntp']['servers'].append(name)
+
+        mostly_mods = [fake_module(name, change) for name in ('a', 'b')]
+        self.modules._run_modules(mostly_mods)
+        self.assertEqual([['a'], ['a']], seen)
+        self.assertEqual({'ntp': {'servers': ['a']}}, self.modules._cached_cfg)
+
+    def test_modules_get_cloud_reporting_under_their_event(self):
+        """Each module's cloud.reporter is its own config-<name> event."""
+        self.modules.reporter = events.ReportEventStack(
+            name='modules-config', description='config modules',
+            reporting_enabled=False)
+        reporters = {}
+
+        def handle(name, cfg, cloud, log, args):
+            reporters[name] = cloud.reporter.fullname
+
+        mostly_mods = [fake_module(name, handle, [name])
+                       for name in ('a', 'b')]
+        self.modules._run_modules(mostly_mods)
+        self.assertEqual(
+            {'a': 'modules-config/config-a', 'b': 'modules-config/config-b'},
+            reporters)
+        self.assertFalse(hasattr(self.init.cloudify(), 'reporter'))
+
+    def test_deepcopy_cfg_modules_get_plain_config(self):
+        """Modules setting deepcopy_cfg get a plain deep copy of config."""
+        self.modules._cached_cfg = {'ntp': {'servers': ['a']}}
+        types_seen = []
+
+        def handle(name, cfg, cloud, log, args):
+            types_seen.append((type(cfg), type(cfg['ntp'])))
+
+        (mod, name, freq, args) = fake_module('plain', handle)
+        mod.deepcopy_cfg = True
+        self.modules._run_modules([(mod, name, freq, args)])
+        self.assertEqual([(dict, dict)], types_seen)
+
 # vi: ts=4 expandtab
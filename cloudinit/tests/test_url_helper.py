@@ -1,13 +1,16 @@
 # This file is part of cloud-init. See LICENSE file for license information.
 
 from cloudinit.url_helper import (
-    NOT_FOUND, UrlError, oauth_headers, read_file_or_url, retry_on_url_exc)
+    NOT_FOUND, UrlError, close_pooled_sessions, get_pooled_session,
+    oauth_headers, read_file_or_url, readurl, retry_on_url_exc, wait_for_url)
 from cloudinit.tests.helpers import CiTestCase, mock, skipIf
 from cloudinit import util
 from cloudinit import version
 
 import httpretty
 import requests
+import threading
+import time
 
 
 try:
@@ -121,6 +124,220 @@ class TestReadFileOrUrl(CiTestCase):
         self.assertEqual(m_response, response._response)
 
 
+class TestPooledSessions(CiTestCase):
+
+    def test_get_pooled_session_is_shared_per_host(self):
+        """Urls on the same scheme and host share one pooled session."""
+        session = get_pooled_session('http://169.254.169.254/latest/')
+        self.assertIs(
+            session, get_pooled_session('http://169.254.169.254/other'))
+        self.assertIsNot(
+            session, get_pooled_session('https://169.254.169.254/latest/'))
+        self.assertIsNot(
+            session, get_pooled_session('http://metadata.google.internal/'))
+
+    @httpretty.activate
+    def test_pooled_session_does_not_store_cookies(self):
+        """Pooled sessions carry no cookie state between requests."""
+        url = 'http://hostname/path'
+        httpretty.register_uri(
+            httpretty.GET, url, body=b'content',
+            adding_headers={'Set-Cookie': 'key=value; Path=/'})
+        readurl(url)
+        self.assertEqual(0, len(get_pooled_session(url).cookies))
+
+    def test_close_pooled_sessions_forgets_sessions(self):
+        """close_pooled_sessions closes sessions so new ones are created."""
+        session = get_pooled_session('http://hostname/path')
+        with mock.patch.object(session, 'close') as m_close:
+            close_pooled_sessions()
+        self.assertEqual(1, m_close.call_count)
+        self.assertIsNot(session, get_pooled_session('http://hostname/path'))
+
+    @httpretty.activate
+    def test_readurl_without_session_reuses_pooled_session(self):
+        """readurl uses and keeps open the pooled session for the host."""
+        url = 'http://hostname/path'
+        httpretty.register_uri(httpretty.GET, url, body=b'content')
+        session = get_pooled_session(url)
+        with mock.patch.object(session, 'close') as m_close:
+            self.assertEqual(b'content', readurl(url).contents)
+            self.assertEqual(b'content', readurl(url).contents)
+        self.assertEqual(0, m_close.call_count)
+        self.assertIs(session, get_pooled_session(url))
+
+    def test_readurl_with_session_does_not_use_pool(self):
+        """An explicit session is used instead of the pooled session."""
+        url = 'http://hostname/path'
+        m_session = mock.MagicMock()
+        m_session.__enter__.return_value = m_session
+        m_session.request.return_value.content = b'content'
+        with mock.patch(M_PATH + 'get_pooled_session') as m_pooled:
+            response = readurl(url, session=m_session)
+        self.assertEqual(b'content', response.contents)
+        self.assertEqual(0, m_pooled.call_count)
+
+    def test_readurl_discards_pooled_session_on_connection_error(self):
+        """A connection error drops the pooled session before retrying."""
+        url = 'http://hostname/path'
+        session = get_pooled_session(url)
+        with mock.patch.object(session, 'request') as m_request:
+            m_request.side_effect = requests.exceptions.ConnectionError('no')
+            with self.assertRaises(UrlError):
+                readurl(url, sec_between=None)
+        self.assertIsNot(session, get_pooled_session(url))
+
+
+class FakeUrlResponse(object):
+    def __init__(self, contents, code=200):
+        self.contents = contents
+        self.code = code
+        self.headers = {}
+
+    def ok(self):
+        return self.code == 200
+
+
+class TestWaitForUrl(CiTestCase):
+
+    def _fake_readurl(self, responses, blocked=None):
+        """Return a readurl replacement answering from responses by url.
+
+        Urls in blocked wait for the event before failing.
+        """
+        def readurl(url, **kwargs):
+            if blocked and url in blocked:
+                blocked[url].wait(5)
+            response = responses[url]
+            if isinstance(response, Exception):
+                raise response
+            return response
+        return readurl
+
+    def test_synchronous_tries_urls_in_order(self):
+        """By default urls are tried one after another."""
+        responses = {
+            'http://a/': UrlError(ValueError('down'), url='http://a/'),
+            'http://b/': FakeUrlResponse(b'b-content')}
+        status = []
+        with mock.patch(M_PATH + 'readurl') as m_readurl:
+            m_readurl.side_effect = self._fake_readurl(responses)
+            self.assertEqual(
+                ('http://b/', b'b-content'),
+                wait_for_url(['http://a/', 'http://b/'], max_wait=0,
+                             status_cb=status.append))
+        self.assertEqual(
+            ['http://a/', 'http://b/'],
+            [c[0][0] for c in m_readurl.call_args_list])
+        self.assertEqual(1, len(status))
+        self.assertIn("Calling 'http://a/' failed", status[0])
+
+    def test_async_returns_first_good_response(self):
+        """A slow first url does not delay a responsive later url."""
+        release = threading.Event()
+        self.addCleanup(release.set)
+        responses = {
+            'http://slow/': UrlError(ValueError('timeout')),
+            'http://fast/': FakeUrlResponse(b'fast-content')}
+        with mock.patch(M_PATH + 'readurl') as m_readurl:
+            m_readurl.side_effect = self._fake_readurl(
+                responses, blocked={'http://slow/': release})
+            self.assertEqual(
+                ('http://fast/', b'fast-content'),
+                wait_for_url(['http://slow/', 'http://fast/'], max_wait=0,
+                             timeout=5, connect_synchronously=False,
+                             async_delay=0.01))
+
+    def test_async_reports_each_failure(self):
+        """Every failed url is reported to status_cb and exception_cb."""
+        responses = {
+            'http://a/': UrlError(ValueError('down'), url='http://a/'),
+            'http://b/': FakeUrlResponse(b'', code=404)}
+        status = []
+        exceptions = []
+
+        def exception_cb(msg, exception):
+            exceptions.append(exception)
+
+        with mock.patch(M_PATH + 'readurl') as m_readurl:
+            m_readurl.side_effect = self._fake_readurl(responses)
+            self.assertEqual(
+                (False, None),
+                wait_for_url(['http://a/', 'http://b/'], max_wait=0,
+                             status_cb=status.append,
+                             exception_cb=exception_cb,
+                             connect_synchronously=False, async_delay=0))
+        self.assertEqual(2, len(status))
+        self.assertItemsEqual(
+            ['http://a/', 'http://b/'], [e.url for e in exceptions])
+
+    def test_async_skips_unstarted_urls_after_success(self):
+        """Urls not yet started when one succeeds are never requested."""
+        responses = {
+            'http://a/': FakeUrlResponse(b'a-content'),
+            'http://b/': FakeUrlResponse(b'b-content')}
+        with mock.patch(M_PATH + 'readurl') as m_readurl:
+            m_readurl.side_effect = self._fake_readurl(responses)
+            self.assertEqual(
+                ('http://a/', b'a-content'),
+                wait_for_url(['http://a/', 'http://b/'], max_wait=0,
+                             connect_synchronously=False, async_delay=5))
+        self.assertEqual(
+            ['http://a/'], [c[0][0] for c in m_readurl.call_args_list])
+
+    def test_async_reports_failures_as_they_happen(self):
+        """Failures are reported while slower urls are still in flight."""
+        release = threading.Event()
+        self.addCleanup(release.set)
+        responses = {
+            'http://slow/': FakeUrlResponse(b'slow-content'),
+            'http://down/': UrlError(ValueError('down'), url='http://down/')}
+
+        def exception_cb(msg, exception):
+            release.set()
+
+        start = time.time()
+        with mock.patch(M_PATH + 'readurl') as m_readurl:
+            m_readurl.side_effect = self._fake_readurl(
+                responses, blocked={'http://slow/': release})
+            self.assertEqual(
+                ('http://slow/', b'slow-content'),
+                wait_for_url(['http://slow/', 'http://down/'], max_wait=0,
+                             exception_cb=exception_cb,
+                             connect_synchronously=False, async_delay=0))
+        self.assertLess(time.time() - start, 4)
+
+    def test_async_attempts_use_own_daemon_sessions(self):
+        """Attempts run in daemon threads over sessions closed on return."""
+        release = threading.Event()
+        self.addCleanup(release.set)
+        responses = {
+            'http://slow/': UrlError(ValueError('timeout')),
+            'http://fast/': FakeUrlResponse(b'fast-content')}
+        fake_readurl = self._fake_readurl(
+            responses, blocked={'http://slow/': release})
+        daemons = []
+
+        def readurl(url, **kwargs):
+            daemons.append(threading.current_thread().daemon)
+            return fake_readurl(url, **kwargs)
+
+        with mock.patch(M_PATH + 'readurl') as m_readurl:
+            with mock.patch(M_PATH + 'requests.Session') as m_session:
+                m_session.side_effect = lambda: mock.Mock()
+                m_readurl.side_effect = readurl
+                self.assertEqual(
+                    ('http://fast/', b'fast-content'),
+                    wait_for_url(['http://slow/', 'http://fast/'],
+                                 max_wait=0, connect_synchronously=False,
+                                 async_delay=0))
+        self.assertEqual([True, True], daemons)
+        sessions = [c[1]['session'] for c in m_readurl.call_args_list]
+        self.assertEqual(2, len(set(id(sess) for sess in sessions)))
+        for session in sessions:
+            session.close.assert_called_once_with()
+
+
 class TestRetryOnUrlExc(CiTestCase):
 
     def test_do_not_retry_non_urlerror(self):
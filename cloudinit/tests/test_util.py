@@ -7,6 +7,8 @@ import logging
 import json
 import platform
 
+from errno import ENOENT
+
 import cloudinit.util as util
 
 from cloudinit.tests.helpers import CiTestCase, mock
@@ -335,6 +337,111 @@ class TestBlkid(CiTestCase):
                                   capture=True, decode="replace")
 
 
+@mock.patch("cloudinit.util.subp")
+class TestBlockDeviceInventory(CiTestCase):
+
+    blkid_export = dedent("""\
+        DEVNAME=/dev/sda1
+        UUID=1111-1111
+        TYPE=vfat
+        PARTUUID=22222222-2222
+
+        DEVNAME=/dev/sr0
+        LABEL=cidata
+        TYPE=iso9660
+
+        DEVNAME=/dev/sdb1
+        LABEL='my disk'
+        TYPE=ext4
+        """)
+
+    def setUp(self):
+        super(TestBlockDeviceInventory, self).setUp()
+        util.cache_block_devices()
+
+    def test_find_devs_with_answers_from_one_probe(self, m_subp):
+        """find_devs_with queries share a single blkid probe."""
+        m_subp.return_value = (self.blkid_export, "")
+        self.assertEqual(['/dev/sr0'], util.find_devs_with('LABEL=cidata'))
+        self.assertEqual(['/dev/sda1'], util.find_devs_with('TYPE=vfat'))
+        self.assertEqual(
+            ['/dev/sdb1'], util.find_devs_with('TYPE=ext4', path='/dev/sdb1'))
+        self.assertEqual([], util.find_devs_with('TYPE=ext4', path='/dev/sr0'))
+        self.assertEqual(
+            ['/dev/sda1', '/dev/sr0', '/dev/sdb1'], util.find_devs_with())
+        m_subp.assert_called_once_with(
+            ['blkid', '-c', '/dev/null', '-o', 'export'], rcs=[0, 2],
+            decode="replace")
+
+    def test_find_devs_with_falls_back_to_blkid(self, m_subp):
+        """Queries the inventory can not answer run blkid as before."""
+        m_subp.return_value = (self.blkid_export, "")
+        util.find_devs_with('LABEL="cidata"')
+        util.find_devs_with(path='/dev/disk/by-label/cidata')
+        util.find_devs_with(tag='LABEL')
+        self.assertEqual(4, m_subp.call_count)
+
+    def test_blkid_answers_from_inventory(self, m_subp):
+        """blkid returns a copy of inventory tags for known devices."""
+        m_subp.return_value = (self.blkid_export, "")
+        result = util.blkid(['/dev/sr0'])
+        self.assertEqual(
+            {'/dev/sr0': {'DEVNAME': '/dev/sr0', 'LABEL': 'cidata',
+                          'TYPE': 'iso9660'}}, result)
+        result['/dev/sr0']['LABEL'] = 'changed'
+        self.assertEqual('cidata', util.blkid()['/dev/sr0']['LABEL'])
+        self.assertEqual(1, m_subp.call_count)
+
+    def test_invalidate_block_devices_probes_again(self, m_subp):
+        """After invalidate_block_devices the next query runs blkid again."""
+        m_subp.return_value = (self.blkid_export, "")
+        self.assertEqual([], util.find_devs_with('LABEL=new'))
+        m_subp.return_value = ("DEVNAME=/dev/vdb\nLABEL=new\n", "")
+        util.invalidate_block_devices()
+        self.assertEqual(['/dev/vdb'], util.find_devs_with('LABEL=new'))
+        self.assertEqual(2, m_subp.call_count)
+
+    def test_find_devs_with_no_cache_probes_again(self, m_subp):
+        """find_devs_with with no_cache does not answer from a stale probe."""
+        m_subp.return_value = (self.blkid_export, "")
+        self.assertEqual([], util.find_devs_with('TYPE=ntfs'))
+        m_subp.return_value = ("DEVNAME=/dev/sdb1\nTYPE=ntfs\n", "")
+        self.assertEqual(
+            ['/dev/sdb1'], util.find_devs_with('TYPE=ntfs', no_cache=True))
+        self.assertEqual(2, m_subp.call_count)
+        m_subp.assert_called_with(
+            ['blkid', '-c', '/dev/null', '-o', 'export'], rcs=[0, 2],
+            decode="replace")
+
+    def test_blkid_disable_cache_probes_again(self, m_subp):
+        """blkid with disable_cache does not answer from a stale probe."""
+        m_subp.return_value = (self.blkid_export, "")
+        self.assertEqual(
+            'iso9660', util.blkid(['/dev/sr0'])['/dev/sr0']['TYPE'])
+        m_subp.return_value = ("DEVNAME=/dev/sr0\nTYPE=udf\n", "")
+        self.assertEqual(
+            'udf',
+            util.blkid(['/dev/sr0'], disable_cache=True)['/dev/sr0']['TYPE'])
+        self.assertEqual(2, m_subp.call_count)
+
+    def test_missing_blkid_is_an_empty_inventory(self, m_subp):
+        """When blkid is not installed no devices are found."""
+        not_found = util.ProcessExecutionError()
+        not_found.errno = ENOENT
+        m_subp.side_effect = not_found
+        self.assertEqual([], util.find_devs_with('LABEL=cidata'))
+        self.assertEqual([], util.find_devs_with('TYPE=vfat'))
+        self.assertEqual(1, m_subp.call_count)
+
+    def test_not_cached_unless_enabled(self, m_subp):
+        """Without cache_block_devices every query runs blkid."""
+        util.clear_block_devices()
+        m_subp.return_value = ("/dev/sr0\n", "")
+        self.assertEqual(['/dev/sr0'], util.find_devs_with('LABEL=cidata'))
+        self.assertEqual(['/dev/sr0'], util.find_devs_with('LABEL=cidata'))
+        self.assertEqual(2, m_subp.call_count)
+
+
 @mock.patch('cloudinit.util.subp')
 class TestUdevadmSettle(CiTestCase):
     def test_with_no_params(self, m_subp):
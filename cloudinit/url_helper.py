@@ -10,8 +10,10 @@
 
 import json
 import os
+import re
 import requests
 import six
+import threading
 import time
 
 from email.utils import parsedate
@@ -20,6 +22,8 @@ from functools import partial
 from itertools import count
 from requests import exceptions
 
+from six.moves import http_cookiejar
+from six.moves import queue
 from six.moves.urllib.parse import (
     urlparse, urlunparse,
     quote as urlquote)
@@ -40,18 +44,70 @@ else:
 # Check if requests has ssl support (added in requests >= 0.8.8)
 SSL_ENABLED = False
 CONFIG_ENABLED = False  # This was added in 0.7 (but taken out in >=1.0)
-_REQ_VER = None
-try:
-    from distutils.version import LooseVersion
-    import pkg_resources
-    _REQ = pkg_resources.get_distribution('requests')
-    _REQ_VER = LooseVersion(_REQ.version)  # pylint: disable=no-member
-    if _REQ_VER >= LooseVersion('0.8.8'):
+# Use the version requests reports about itself; asking pkg_resources scans
+# every installed distribution and dominates the import time of this module.
+_REQ_VER = getattr(requests, '__version__', None)
+if _REQ_VER:
+    _REQ_VER_INFO = tuple(int(part) for part in re.findall(r'\d+', _REQ_VER))
+    if _REQ_VER_INFO >= (0, 8, 8):
         SSL_ENABLED = True
-    if LooseVersion('0.7.0') <= _REQ_VER < LooseVersion('1.0.0'):
+    if (0, 7, 0) <= _REQ_VER_INFO < (1, 0, 0):
         CONFIG_ENABLED = True
-except ImportError:
-    pass
+
+# Connection pool limits for the process-wide sessions used by readurl when
+# the caller provides no session. Keep-alive connections are reused across
+# calls to the same scheme://host:port, up to POOL_MAXSIZE of them at once.
+POOL_MAXSIZE = 16
+
+_POOLED_SESSIONS = {}
+_POOLED_SESSIONS_LOCK = threading.Lock()
+
+
+def _pool_key(url):
+    parsed_url = urlparse(url)
+    return (parsed_url.scheme, parsed_url.netloc)
+
+
+def get_pooled_session(url):
+    """Return the process-wide requests.Session shared for url's host.
+
+    Sessions are keyed by scheme and netloc so each metadata service gets its
+    own keep-alive connection pool. Cookies are never stored, so no state
+    other than open connections is carried between requests.
+    """
+    key = _pool_key(url)
+    with _POOLED_SESSIONS_LOCK:
+        session = _POOLED_SESSIONS.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+            session.mount('%s://' % key[0], adapter)
+            session.cookies.set_policy(
+                http_cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            _POOLED_SESSIONS[key] = session
+        return session
+
+
+def _discard_pooled_session(url):
+    """Close and forget the pooled session for url's host, if any."""
+    with _POOLED_SESSIONS_LOCK:
+        session = _POOLED_SESSIONS.pop(_pool_key(url), None)
+    if session is not None:
+        session.close()
+
+
+def close_pooled_sessions():
+    """Close all pooled sessions, dropping their keep-alive connections.
+
+    Call this when the network the connections were made over goes away,
+    such as when tearing down an ephemeral network.
+    """
+    with _POOLED_SESSIONS_LOCK:
+        sessions = list(_POOLED_SESSIONS.values())
+        _POOLED_SESSIONS.clear()
+    for session in sessions:
+        session.close()
 
 
 def _cleanurl(url):
@@ -226,6 +282,8 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
     :param exception_cb: Optional callable which accepts the params
         msg and exception and returns a boolean True if retries are permitted.
     :param session: Optional exiting requests.Session instance to reuse.
+        When None, the pooled session for the url's host is used so that
+        keep-alive connections are shared across calls.
     :param infinite: Bool, set True to retry indefinitely. Default: False.
     :param log_req_resp: Set False to turn off verbose debug messages.
     :param request_method: String passed as 'method' to Session.request.
@@ -295,10 +353,10 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
                           filtered_req_args)
 
             if session is None:
-                session = requests.Session()
-
-            with session as sess:
-                r = sess.request(**req_args)
+                r = get_pooled_session(url).request(**req_args)
+            else:
+                with session as sess:
+                    r = sess.request(**req_args)
 
             if check_status:
                 r.raise_for_status()
@@ -317,6 +375,9 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
                                       url=url))
             else:
                 excps.append(UrlError(e, url=url))
+                if session is None:
+                    # Don't retry over a pooled connection that may be stale
+                    _discard_pooled_session(url)
                 if SSL_ENABLED and isinstance(e, exceptions.SSLError):
                     # ssl exceptions are not going to get fixed by waiting a
                     # few seconds
@@ -339,14 +400,108 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
     return None  # Should throw before this...
 
 
+def _read_url_attempt(url, timeout, headers_cb, request_method,
+                      session=None):
+    """Make a single wait_for_url attempt to read url.
+
+    @param session: Optional requests.Session to read url with instead of
+        the pooled session for url's host.
+
+    @return: tuple of (response, reason, url_exc). On success reason and
+        url_exc are None. On failure reason is a string describing it and
+        url_exc the exception; response is the bad response, if any.
+    """
+    response = None
+    try:
+        if headers_cb is not None:
+            headers = headers_cb(url)
+        else:
+            headers = {}
+
+        response = readurl(
+            url, headers=headers, timeout=timeout,
+            check_status=False, request_method=request_method,
+            session=session)
+        if not response.contents:
+            reason = "empty response [%s]" % (response.code)
+            url_exc = UrlError(ValueError(reason), code=response.code,
+                               headers=response.headers, url=url)
+        elif not response.ok():
+            reason = "bad status code [%s]" % (response.code)
+            url_exc = UrlError(ValueError(reason), code=response.code,
+                               headers=response.headers, url=url)
+        else:
+            return response, None, None
+    except UrlError as e:
+        reason = "request error [%s]" % e
+        url_exc = e
+    except Exception as e:
+        reason = "unexpected error [%s]" % e
+        url_exc = e
+    return response, reason, url_exc
+
+
+def _race_urls(urls, timeout, headers_cb, request_method, async_delay,
+               failure_cb=None):
+    """Attempt to read all urls concurrently, returning the first success.
+
+    Attempts are started async_delay seconds apart in list order, so that a
+    url which responds quickly wins before later ones are even tried.
+    failure_cb is called with (url, response, reason, url_exc) as each
+    attempt fails. Once a url succeeds, attempts not yet started are
+    abandoned and the sessions of all attempts are closed.
+
+    Each attempt reads over its own session, so the pooled sessions are
+    neither used nor closed by a race. Attempts run in daemon threads, so
+    that one still in flight can never delay the exit of the process.
+
+    @return: tuple of (url, response), both None if no url succeeded.
+    """
+    if not urls:
+        return None, None
+    done = threading.Event()
+    results = queue.Queue()
+
+    def attempt(delay, url, session):
+        result = None
+        if not done.wait(delay):
+            result = _read_url_attempt(
+                url, timeout, headers_cb, request_method, session=session)
+        results.put((url, result))
+
+    sessions = []
+    for (idx, url) in enumerate(urls):
+        session = requests.Session()
+        sessions.append(session)
+        thread = threading.Thread(
+            target=attempt, args=(idx * async_delay, url, session))
+        thread.daemon = True
+        thread.start()
+    try:
+        for _ in urls:
+            (url, (response, reason, url_exc)) = results.get()
+            if url_exc is None:
+                return url, response
+            if failure_cb:
+                failure_cb(url, response, reason, url_exc)
+    finally:
+        done.set()
+        for session in sessions:
+            session.close()
+    return None, None
+
+
 def wait_for_url(urls, max_wait=None, timeout=None,
                  status_cb=None, headers_cb=None, sleep_time=1,
-                 exception_cb=None, sleep_time_cb=None, request_method=None):
+                 exception_cb=None, sleep_time_cb=None, request_method=None,
+                 connect_synchronously=True, async_delay=0.150):
     """
     urls:      a list of urls to try
     max_wait:  roughly the maximum time to wait before giving up
                The max time is *actually* len(urls)*timeout as each url will
-               be tried once and given the timeout provided.
+               be tried once and given the timeout provided. When
+               connect_synchronously is False it is closer to timeout plus
+               len(urls)*async_delay.
                a number <= 0 will always result in only one try
     timeout:   the timeout provided to urlopen
     status_cb: call method with string message when a url is not available
@@ -357,6 +512,11 @@ def wait_for_url(urls, max_wait=None, timeout=None,
     sleep_time_cb: call method with 2 arguments (response, loop_n) that
                    generates the next sleep time.
     request_method: indicate the type of HTTP request, GET, PUT, or POST
+    connect_synchronously: when False, all urls are raced against each
+                   other in each attempt (happy eyeballs style) instead of
+                   being tried one after another.
+    async_delay:   delay in seconds between starting each url's attempt
+                   when connect_synchronously is False.
     returns: tuple of (url, response contents), on failure, (False, None)
 
     the idea of this routine is to wait for the EC2 metadata service to
@@ -389,6 +549,28 @@ def wait_for_url(urls, max_wait=None, timeout=None,
             return False
         return ((max_wait <= 0) or (time.time() - start_time > max_wait))
 
+    def shortened_timeout(timeout):
+        now = time.time()
+        if (max_wait is not None and
+                timeout and (now + timeout > (start_time + max_wait))):
+            # shorten timeout to not run way over max_time
+            timeout = int((start_time + max_wait) - now)
+        return timeout
+
+    def report_failure(url, reason, url_exc):
+        time_taken = int(time.time() - start_time)
+        max_wait_str = "%ss" % max_wait if max_wait else "unlimited"
+        status_msg = "Calling '%s' failed [%s/%s]: %s" % (url,
+                                                          time_taken,
+                                                          max_wait_str,
+                                                          reason)
+        status_cb(status_msg)
+        if exception_cb:
+            # This can be used to alter the headers that will be sent
+            # in the future, for example this is what the MAAS datasource
+            # does.
+            exception_cb(msg=status_msg, exception=url_exc)
+
     loop_n = 0
     response = None
     while True:
@@ -396,56 +578,38 @@ def wait_for_url(urls, max_wait=None, timeout=None,
             sleep_time = sleep_time_cb(response, loop_n)
         else:
             sleep_time = int(loop_n / 5) + 1
-        for url in urls:
-            now = time.time()
-            if loop_n != 0:
-                if timeup(max_wait, start_time):
-                    break
-                if (max_wait is not None and
-                        timeout and (now + timeout > (start_time + max_wait))):
-                    # shorten timeout to not run way over max_time
-                    timeout = int((start_time + max_wait) - now)
-
-            reason = ""
-            url_exc = None
-            try:
-                if headers_cb is not None:
-                    headers = headers_cb(url)
-                else:
-                    headers = {}
-
-                response = readurl(
-                    url, headers=headers, timeout=timeout,
-                    check_status=False, request_method=request_method)
-                if not response.contents:
-                    reason = "empty response [%s]" % (response.code)
-                    url_exc = UrlError(ValueError(reason), code=response.code,
-                                       headers=response.headers, url=url)
-                elif not response.ok():
-                    reason = "bad status code [%s]" % (response.code)
-                    url_exc = UrlError(ValueError(reason), code=response.code,
-                                       headers=response.headers, url=url)
-                else:
+        if connect_synchronously:
+            for url in urls:
+                if loop_n != 0:
+                    if timeup(max_wait, start_time):
+                        break
+                    timeout = shortened_timeout(timeout)
+
+                (url_response, reason, url_exc) = _read_url_attempt(
+                    url, timeout, headers_cb, request_method)
+                if url_response is not None:
+                    response = url_response
+                if url_exc is None:
                     return url, response.contents
-            except UrlError as e:
-                reason = "request error [%s]" % e
-                url_exc = e
-            except Exception as e:
-                reason = "unexpected error [%s]" % e
-                url_exc = e
-
-            time_taken = int(time.time() - start_time)
-            max_wait_str = "%ss" % max_wait if max_wait else "unlimited"
-            status_msg = "Calling '%s' failed [%s/%s]: %s" % (url,
-                                                              time_taken,
-                                                              max_wait_str,
-                                                              reason)
-            status_cb(status_msg)
-            if exception_cb:
-                # This can be used to alter the headers that will be sent
-                # in the future, for example this is what the MAAS datasource
-                # does.
-                exception_cb(msg=status_msg, exception=url_exc)
+                report_failure(url, reason, url_exc)
+        elif loop_n == 0 or not timeup(max_wait, start_time):
+            if loop_n != 0:
+                timeout = shortened_timeout(timeout)
+            failed_responses = []
+
+            def race_failure_cb(failed_url, failed_response, reason,
+                                url_exc):
+                if failed_response is not None:
+                    failed_responses.append(failed_response)
+                report_failure(failed_url, reason, url_exc)
+
+            (url, url_response) = _race_urls(
+                urls, timeout, headers_cb, request_method, async_delay,
+                failure_cb=race_failure_cb)
+            if url:
+                return url, url_response.contents
+            if failed_responses:
+                response = failed_responses[-1]
 
         if timeup(max_wait, start_time):
             break
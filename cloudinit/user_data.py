@@ -8,7 +8,11 @@
 #
 # This file is part of cloud-init. See LICENSE file for license information.
 
+import binascii
+from concurrent import futures
 import os
+import quopri
+import threading
 
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
@@ -52,6 +56,9 @@ DECOMP_TYPES = [
     'application/x-gzip-compressed',
 ]
 
+# Characters of a payload examined to find include parts ahead of time
+INCLUDE_PEEK_SIZE = 256
+
 # Msg header used to track attachments
 ATTACHMENT_FIELD = 'Number-Attachments'
 
@@ -72,56 +79,111 @@ def _set_filename(msg, filename):
 
 
 class UserDataProcessor(object):
-    def __init__(self, paths):
+    """Process user-data into a single MIME multipart message.
+
+    When max_workers is greater than 1, the urls of include parts, and of
+    include parts in the content they return, are fetched ahead of time by
+    a pool of at most max_workers threads. Parts are still attached in the
+    order of a serial run.
+    """
+
+    def __init__(self, paths, max_workers=None):
         self.paths = paths
         self.ssl_details = util.fetch_ssl_details(paths)
+        self._max_workers = max_workers
+        self._reset_fetches()
+
+    def _reset_fetches(self):
+        # Include url fetches started ahead of time, while processing
+        self._executor = None
+        self._fetches = {}
+        self._fetches_lock = threading.Lock()
+
+    def __getstate__(self):
+        # Processors are pickled with their datasource, locks can't be
+        state = dict(self.__dict__)
+        for attr in ('_executor', '_fetches', '_fetches_lock'):
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Processors pickled by older versions have no _max_workers
+        self.__dict__.setdefault('_max_workers', None)
+        self._reset_fetches()
 
     def process(self, blob):
-        accumulating_msg = MIMEMultipart()
         if isinstance(blob, list):
-            for b in blob:
-                self._process_msg(convert_string(b), accumulating_msg)
+            msgs = [convert_string(b) for b in blob]
         else:
-            self._process_msg(convert_string(blob), accumulating_msg)
+            msgs = [convert_string(blob)]
+        if not self._max_workers or self._max_workers <= 1:
+            return self._process_msgs(msgs)
+        with futures.ThreadPoolExecutor(
+                max_workers=self._max_workers) as executor:
+            self._executor = executor
+            try:
+                for msg in msgs:
+                    self._prefetch_msg(msg)
+                return self._process_msgs(msgs)
+            finally:
+                with self._fetches_lock:
+                    self._executor = None
+                    for future in self._fetches.values():
+                        future.cancel()
+                    self._fetches = {}
+
+    def _process_msgs(self, msgs):
+        accumulating_msg = MIMEMultipart()
+        for msg in msgs:
+            self._process_msg(msg, accumulating_msg)
         return accumulating_msg
 
-    def _process_msg(self, base_msg, append_msg):
+    def _decode_part(self, part):
+        """Return the payload and content types of a message part.
 
-        def find_ctype(payload):
-            return handlers.type_from_starts_with(payload)
+        @return: Tuple of payload, original content type, content type and
+            whether the payload was decompressed.
+        @raises DecompressionError: if a gzipped payload is invalid.
+        """
+        ctype = None
+        ctype_orig = part.get_content_type()
+        payload = util.fully_decoded_payload(part)
+        was_compressed = False
+
+        # When the message states it is of a gzipped content type ensure
+        # that we attempt to decode said payload so that the decompressed
+        # data can be examined (instead of the compressed data).
+        if ctype_orig in DECOMP_TYPES:
+            payload = util.decomp_gzip(payload, quiet=False)
+            # At this point we don't know what the content-type is
+            # since we just decompressed it.
+            ctype_orig = None
+            was_compressed = True
+
+        # Attempt to figure out the payloads content-type
+        if not ctype_orig:
+            ctype_orig = UNDEF_TYPE
+        if ctype_orig in TYPE_NEEDED:
+            ctype = handlers.type_from_starts_with(payload)
+        if ctype is None:
+            ctype = ctype_orig
+        return (payload, ctype_orig, ctype, was_compressed)
 
+    def _process_msg(self, base_msg, append_msg):
         for part in base_msg.walk():
             if is_skippable(part):
                 continue
 
-            ctype = None
-            ctype_orig = part.get_content_type()
-            payload = util.fully_decoded_payload(part)
-            was_compressed = False
-
-            # When the message states it is of a gzipped content type ensure
-            # that we attempt to decode said payload so that the decompressed
-            # data can be examined (instead of the compressed data).
-            if ctype_orig in DECOMP_TYPES:
-                try:
-                    payload = util.decomp_gzip(payload, quiet=False)
-                    # At this point we don't know what the content-type is
-                    # since we just decompressed it.
-                    ctype_orig = None
-                    was_compressed = True
-                except util.DecompressionError as e:
-                    LOG.warning("Failed decompressing payload from %s of"
-                                " length %s due to: %s",
-                                ctype_orig, len(payload), e)
-                    continue
-
-            # Attempt to figure out the payloads content-type
-            if not ctype_orig:
-                ctype_orig = UNDEF_TYPE
-            if ctype_orig in TYPE_NEEDED:
-                ctype = find_ctype(payload)
-            if ctype is None:
-                ctype = ctype_orig
+            try:
+                (payload, ctype_orig, ctype,
+                 was_compressed) = self._decode_part(part)
+            except util.DecompressionError as e:
+                LOG.warning("Failed decompressing payload from %s of"
+                            " length %s due to: %s",
+                            part.get_content_type(),
+                            len(util.fully_decoded_payload(part)), e)
+                continue
 
             # In the case where the data was compressed, we want to make sure
             # that we create a new message that contains the found content
@@ -165,7 +227,12 @@ class UserDataProcessor(object):
             try:
                 # See if it has a launch-index field
                 # that might affect the final header
-                payload = util.load_yaml(msg.get_payload(decode=True))
+                payload = util.transfer_decoded_payload(msg)
+                if b'launch-index' in payload:
+                    payload = util.load_yaml(payload)
+                else:
+                    # No need to parse all of a large payload
+                    payload = None
                 if payload:
                     payload_idx = payload.get('launch-index')
             except Exception:
@@ -192,30 +259,62 @@ class UserDataProcessor(object):
             _set_filename(msg, PART_FN_TPL % (attached_id))
         self._attach_launch_index(msg)
 
-    def _do_include(self, content, append_msg):
-        # Include a list of urls, one per line
-        # also support '#include <url here>'
-        # or #include-once '<url here>'
-        include_once_on = False
-        for line in content.splitlines():
-            lc_line = line.lower()
-            if lc_line.startswith("#include-once"):
-                line = line[len("#include-once"):].lstrip()
-                # Every following include will now
-                # not be refetched.... but will be
-                # re-read from a local urlcache (if it worked)
-                include_once_on = True
-            elif lc_line.startswith("#include"):
-                line = line[len("#include"):].lstrip()
-                # Disable the include once if it was on
-                # if it wasn't, then this has no effect.
-                include_once_on = False
-            if line.startswith("#"):
+    def _prefetch_msg(self, msg):
+        """Start fetching the urls of all include parts of msg.
+
+        Only parts which may be include parts are decoded, so that large
+        parts are not decoded both here and when processed. Gzipped parts
+        are not examined, their includes are fetched once processed.
+        """
+        for part in msg.walk():
+            if is_skippable(part) or not _may_include(part):
+                continue
+            try:
+                (payload, _ctype_orig, ctype, _compressed) = self._decode_part(
+                    part)
+            except util.DecompressionError:
                 continue
-            include_url = line.strip()
-            if not include_url:
+            if ctype in INCLUDE_TYPES:
+                self._prefetch(_include_entries(payload))
+
+    def _prefetch(self, entries):
+        for (include_url, include_once_on) in entries:
+            if include_once_on and os.path.isfile(
+                    self._get_include_once_filename(include_url)):
                 continue
+            with self._fetches_lock:
+                if self._executor is None or include_url in self._fetches:
+                    continue
+                self._fetches[include_url] = self._executor.submit(
+                    self._prefetch_url, include_url)
+
+    def _prefetch_url(self, include_url):
+        resp = self._read_url(include_url)
+        if resp.ok():
+            # Includes in the content are fetched before it is processed
+            try:
+                self._prefetch_msg(convert_string(resp.contents))
+            except Exception as e:
+                LOG.debug("Not prefetching includes of %s: %s",
+                          include_url, e)
+        return resp
+
+    def _read_url(self, include_url):
+        return read_file_or_url(include_url, timeout=5, retries=10,
+                                ssl_details=self.ssl_details)
+
+    def _read_include(self, include_url):
+        """Return the response for include_url, fetched ahead if it was."""
+        with self._fetches_lock:
+            future = self._fetches.get(include_url)
+        if future is None:
+            return self._read_url(include_url)
+        return future.result()
 
+    def _do_include(self, content, append_msg):
+        entries = _include_entries(content)
+        self._prefetch(entries)
+        for (include_url, include_once_on) in entries:
             include_once_fn = None
             content = None
             if include_once_on:
@@ -224,8 +323,7 @@ class UserDataProcessor(object):
                 content = util.load_file(include_once_fn)
             else:
                 try:
-                    resp = read_file_or_url(include_url, timeout=5, retries=10,
-                                            ssl_details=self.ssl_details)
+                    resp = self._read_include(include_url)
                     if include_once_on and resp.ok():
                         util.write_file(include_once_fn, resp.contents,
                                         mode=0o600)
@@ -327,6 +425,74 @@ class UserDataProcessor(object):
         self._multi_part_count(outer_msg, part_count + 1)
 
 
+def _payload_start(part):
+    """Return the start of the transfer decoded payload of part as text.
+
+    Only INCLUDE_PEEK_SIZE characters of the payload are decoded. None is
+    returned when the start can not be decoded on its own.
+    """
+    payload = part.get_payload()
+    if not isinstance(payload, six.string_types):
+        return None
+    start = payload[:INCLUDE_PEEK_SIZE]
+    cte = str(part.get('content-transfer-encoding', '')).lower()
+    try:
+        if cte == 'base64':
+            start = ''.join(start.split())
+            start = binascii.a2b_base64(start[:len(start) // 4 * 4])
+        elif cte == 'quoted-printable':
+            start = quopri.decodestring(util.encode_text(start))
+        elif cte not in ('', '7bit', '8bit', 'binary'):
+            return None
+    except (binascii.Error, ValueError, TypeError):
+        return None
+    if isinstance(start, six.binary_type):
+        start = start.decode('utf-8', 'replace')
+    return start
+
+
+def _may_include(part):
+    """Return whether part may be an include part, from its start only."""
+    ctype = part.get_content_type()
+    if ctype in INCLUDE_TYPES:
+        return True
+    if ctype not in TYPE_NEEDED:
+        return False
+    start = _payload_start(part)
+    if start is None:
+        return True
+    return handlers.type_from_starts_with(start) in INCLUDE_TYPES
+
+
+def _include_entries(content):
+    """Return (url, include_once) for each url listed in an include part."""
+    # Include a list of urls, one per line
+    # also support '#include <url here>'
+    # or #include-once '<url here>'
+    entries = []
+    include_once_on = False
+    for line in content.splitlines():
+        lc_line = line.lower()
+        if lc_line.startswith("#include-once"):
+            line = line[len("#include-once"):].lstrip()
+            # Every following include will now
+            # not be refetched.... but will be
+            # re-read from a local urlcache (if it worked)
+            include_once_on = True
+        elif lc_line.startswith("#include"):
+            line = line[len("#include"):].lstrip()
+            # Disable the include once if it was on
+            # if it wasn't, then this has no effect.
+            include_once_on = False
+        if line.startswith("#"):
+            continue
+        include_url = line.strip()
+        if not include_url:
+            continue
+        entries.append((include_url, include_once_on))
+    return entries
+
+
 def is_skippable(part):
     # multipart/* are just containers
     part_maintype = part.get_content_maintype() or ''
@@ -349,10 +515,13 @@ def convert_string(raw_data, content_type=NOT_MULTIPART_TYPE):
         return msg
 
     if isinstance(raw_data, six.text_type):
-        bdata = raw_data.encode('utf-8')
-    else:
-        bdata = raw_data
-    bdata = util.decomp_gzip(bdata, decode=False)
+        # Text can not be gzipped, and the email package parses text, so
+        # avoid encoding it only to decode it again.
+        if "mime-version:" in raw_data[0:4096].lower():
+            return util.message_from_string(raw_data)
+        return create_binmsg(raw_data.encode('utf-8'), content_type)
+
+    bdata = util.decomp_gzip(raw_data, decode=False)
     if b"mime-version:" in bdata[0:4096].lower():
         msg = util.message_from_string(bdata.decode('utf-8'))
     else:
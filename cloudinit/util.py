@@ -8,13 +8,16 @@
 #
 # This file is part of cloud-init. See LICENSE file for license information.
 
+import binascii
 import contextlib
 import copy as obj_copy
 import ctypes
 import email
+import email.feedparser
+import email.generator
+import email.message
 import glob
 import grp
-import gzip
 import hashlib
 import json
 import os
@@ -31,7 +34,9 @@ import string
 import subprocess
 import sys
 import time
+import zlib
 
+from collections import OrderedDict
 from errno import ENOENT, ENOEXEC
 
 from base64 import b64decode, b64encode
@@ -39,13 +44,13 @@ from six.moves.urllib import parse as urlparse
 
 import six
 
+from cloudinit import fs_image
 from cloudinit import importer
 from cloudinit import log as logging
 from cloudinit import mergers
 from cloudinit import safeyaml
 from cloudinit import temp_utils
 from cloudinit import type_utils
-from cloudinit import url_helper
 from cloudinit import version
 
 from cloudinit.settings import (CFG_BUILTIN)
@@ -69,6 +74,10 @@ FN_REPLACEMENTS = {
 }
 FN_ALLOWED = ('_-.()' + string.digits + string.ascii_letters)
 
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_CHUNK_SIZE = 64 * 1024
+MESSAGE_CHUNK_SIZE = 64 * 1024
+
 TRUE_STRINGS = ('true', '1', 'on', 'yes')
 FALSE_STRINGS = ('off', '0', 'no', 'false')
 
@@ -78,6 +87,34 @@ CONTAINER_TESTS = (['systemd-detect-virt', '--quiet', '--container'],
                    ['running-in-container'],
                    ['lxc-is-container'])
 
+# Platform facts (container detection, DMI data and uname) do not change
+# during a boot. Once cache_platform_facts() is called they are looked up
+# only once per process instead of on every call.
+_PLATFORM_FACTS = None
+
+# Filesystem types of mount which mount_cb reads without mounting
+MOUNT_IMAGE_TYPES = {
+    '': fs_image.FSTYPES,
+    'auto': fs_image.FSTYPES,
+    'cd9660': (fs_image.ISO9660,),
+    'iso9660': (fs_image.ISO9660,),
+    'vfat': (fs_image.VFAT,),
+}
+
+# Once enabled by cache_block_devices(), find_devs_with and blkid answer
+# from a single blkid probe of all block devices, taken on first use.
+_BLKID_CACHE_ENABLED = False
+_BLKID_INVENTORY = None
+
+# ds-identify reports these DMI fields, map them to read_dmi_data keys
+DS_IDENTIFY_DMI_KEYS = {
+    'DMI_CHASSIS_ASSET_TAG': 'chassis-asset-tag',
+    'DMI_PRODUCT_NAME': 'system-product-name',
+    'DMI_PRODUCT_SERIAL': 'system-serial-number',
+    'DMI_PRODUCT_UUID': 'system-uuid',
+    'DMI_SYS_VENDOR': 'system-manufacturer',
+}
+
 
 @lru_cache()
 def get_architecture(target=None):
@@ -172,13 +209,41 @@ def b64e(source):
     return b64encode(source).decode('utf-8')
 
 
+def _b64_payload(part):
+    """Return the base64 decoded payload of part, or None.
+
+    binascii skips line breaks itself, so unlike get_payload(decode=True)
+    the payload is not copied, split into lines and joined first. None is
+    returned for payloads that need the email package's lenient decoding.
+    """
+    if (part.is_multipart() or
+            str(part.get('content-transfer-encoding', '')).lower() !=
+            'base64'):
+        return None
+    try:
+        return binascii.a2b_base64(part.get_payload())
+    except (binascii.Error, ValueError, TypeError):
+        return None
+
+
+def transfer_decoded_payload(part):
+    """Return the payload of part decoded per its Content-Transfer-Encoding.
+
+    This is part.get_payload(decode=True), only cheaper for base64 parts.
+    """
+    cte_payload = _b64_payload(part)
+    if cte_payload is None:
+        cte_payload = part.get_payload(decode=True)
+    return cte_payload
+
+
 def fully_decoded_payload(part):
     # In Python 3, decoding the payload will ironically hand us a bytes object.
     # 'decode' means to decode according to Content-Transfer-Encoding, not
     # according to any charset in the Content-Type.  So, if we end up with
     # bytes, first try to decode to str via CT charset, and failing that, try
     # utf-8 using surrogate escapes.
-    cte_payload = part.get_payload(decode=True)
+    cte_payload = transfer_decoded_payload(part)
     if (six.PY3 and
             part.get_content_maintype() == 'text' and
             isinstance(cte_payload, bytes)):
@@ -465,15 +530,47 @@ def clean_filename(fn):
     return fn
 
 
+def _gunzip(data, chunk_size=GZIP_CHUNK_SIZE):
+    """Return gzipped data decompressed, keeping a single output copy.
+
+    Data is decompressed chunk_size bytes at a time into one growing
+    buffer. Concatenated gzip members and trailing zero padding are
+    handled like gzip.GzipFile does.
+    """
+    view = memoryview(data)
+    out = six.BytesIO()
+    if not view:
+        # An empty file holds no members, as for gzip.GzipFile
+        return b''
+    while True:
+        if bytes(view[:2]) != GZIP_MAGIC:
+            raise IOError('Not a gzipped file (%r)' % bytes(view[:2]))
+        dec = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        pos = 0
+        while not dec.eof and pos < len(view):
+            out.write(dec.decompress(view[pos:pos + chunk_size]))
+            pos += chunk_size
+        if not dec.eof:
+            raise EOFError("Compressed file ended before the "
+                           "end-of-stream marker was reached")
+        rest = dec.unused_data + bytes(view[pos:])
+        rest = rest.lstrip(b'\x00')
+        if not rest:
+            # getvalue hands out the buffer written to, without copying it
+            return out.getvalue()
+        view = memoryview(rest)
+
+
 def decomp_gzip(data, quiet=True, decode=True):
     try:
-        buf = six.BytesIO(encode_text(data))
-        with contextlib.closing(gzip.GzipFile(None, "rb", 1, buf)) as gh:
-            # E1101 is https://github.com/PyCQA/pylint/issues/1444
-            if decode:
-                return decode_binary(gh.read())  # pylint: disable=E1101
-            else:
-                return gh.read()  # pylint: disable=E1101
+        blob = encode_text(data)
+        if quiet and blob and blob[:2] != GZIP_MAGIC:
+            # Not gzipped, don't bother trying
+            return data
+        if decode:
+            return decode_binary(_gunzip(blob))
+        else:
+            return _gunzip(blob)
     except Exception as e:
         if quiet:
             return data
@@ -908,6 +1005,7 @@ def runparts(dirp, skip_no_exist=True, exe_prefix=None):
 # if files are present, populates 'fill' dictionary with 'user-data' and
 # 'meta-data' entries
 def read_optional_seed(fill, base="", ext="", timeout=5):
+    from cloudinit import url_helper
     try:
         (md, ud) = read_seeded(base, ext, timeout)
         fill['user-data'] = ud
@@ -993,6 +1091,8 @@ def read_seeded(base="", ext="", timeout=5, retries=10, file_retries=0):
         ud_url = "%s%s%s" % (base, "user-data", ext)
         md_url = "%s%s%s" % (base, "meta-data", ext)
 
+    # Imported here so that importing util does not load requests
+    from cloudinit import url_helper
     md_resp = url_helper.read_file_or_url(md_url, timeout=timeout,
                                           retries=retries)
     md = None
@@ -1027,10 +1127,12 @@ def read_conf_d(confd):
     return mergemanydict(cfgs)
 
 
-def read_conf_with_confd(cfgfile):
-    cfg = read_conf(cfgfile)
+def get_confd(cfgfile, cfg):
+    """Return the conf.d directory used along with cfgfile, or None.
 
-    confd = False
+    @param cfg: The config read from cfgfile.
+    """
+    confd = None
     if "conf_d" in cfg:
         confd = cfg['conf_d']
         if confd:
@@ -1042,7 +1144,13 @@ def read_conf_with_confd(cfgfile):
                 confd = str(confd).strip()
     elif os.path.isdir("%s.d" % cfgfile):
         confd = "%s.d" % cfgfile
+    return confd or None
+
 
+def read_conf_with_confd(cfgfile):
+    cfg = read_conf(cfgfile)
+
+    confd = get_confd(cfgfile, cfg)
     if not confd or not os.path.isdir(confd):
         return cfg
 
@@ -1257,6 +1365,74 @@ def close_stdin():
         os.dup2(fp.fileno(), sys.stdin.fileno())
 
 
+def cache_block_devices():
+    """Answer find_devs_with and blkid from one probe of all block devices.
+
+    The probe runs on first use. Call invalidate_block_devices() once block
+    devices, their partitions or filesystems have changed.
+    """
+    global _BLKID_CACHE_ENABLED
+    _BLKID_CACHE_ENABLED = True
+
+
+def invalidate_block_devices():
+    """Probe block devices again on next use of the cache."""
+    global _BLKID_INVENTORY
+    _BLKID_INVENTORY = None
+
+
+def clear_block_devices():
+    """Drop the block device inventory and stop caching it."""
+    global _BLKID_CACHE_ENABLED
+    _BLKID_CACHE_ENABLED = False
+    invalidate_block_devices()
+
+
+def _block_device_inventory():
+    """Return OrderedDict of blkid tags by device, or None when not cached.
+    """
+    global _BLKID_INVENTORY
+    if not _BLKID_CACHE_ENABLED:
+        return None
+    if _BLKID_INVENTORY is None:
+        try:
+            # See man blkid for why 2 is added
+            (out, _err) = subp(['blkid', '-c', '/dev/null', '-o', 'export'],
+                               rcs=[0, 2], decode="replace")
+        except ProcessExecutionError as e:
+            if e.errno != ENOENT:
+                LOG.debug("Unable to probe block devices: %s", e)
+                return None
+            # blkid not found...
+            out = ""
+        inventory = OrderedDict()
+        # Devices are separated by blank lines, each starting with DEVNAME
+        for block in re.split(r'\n\s*\n', out):
+            tags = load_shell_content(block)
+            if tags.get('DEVNAME'):
+                inventory[tags['DEVNAME']] = tags
+        _BLKID_INVENTORY = inventory
+    return _BLKID_INVENTORY
+
+
+def _find_devs_in_inventory(inventory, criteria, path):
+    """Return devices in inventory matching criteria, or None if unknown."""
+    if criteria:
+        name, _, value = criteria.partition('=')
+        if not value or '"' in value or "'" in value:
+            return None
+    if path:
+        if path not in inventory:
+            # possibly a symlink or a device without tags, ask blkid
+            return None
+        devices = [path]
+    else:
+        devices = list(inventory.keys())
+    if criteria:
+        devices = [dev for dev in devices if inventory[dev].get(name) == value]
+    return devices
+
+
 def find_devs_with(criteria=None, oformat='device',
                    tag=None, no_cache=False, path=None):
     """
@@ -1265,7 +1441,18 @@ def find_devs_with(criteria=None, oformat='device',
       TYPE=<filesystem>
       LABEL=<label>
       UUID=<uuid>
+
+    no_cache probes block devices again, including the block device
+    inventory.
     """
+    if no_cache:
+        invalidate_block_devices()
+    if oformat == 'device' and not tag:
+        inventory = _block_device_inventory()
+        if inventory is not None:
+            devices = _find_devs_in_inventory(inventory, criteria, path)
+            if devices is not None:
+                return devices
     blk_id_cmd = ['blkid']
     options = []
     if criteria:
@@ -1313,7 +1500,8 @@ def blkid(devs=None, disable_cache=False):
     """Get all device tags details from blkid.
 
     @param devs: Optional list of device paths you wish to query.
-    @param disable_cache: Bool, set True to start with clean cache.
+    @param disable_cache: Bool, set True to start with clean cache. The
+        block device inventory is probed again too.
 
     @return: Dict of key value pairs of info for the device.
     """
@@ -1322,6 +1510,13 @@ def blkid(devs=None, disable_cache=False):
     else:
         devs = list(devs)
 
+    if disable_cache:
+        invalidate_block_devices()
+    inventory = _block_device_inventory()
+    if inventory is not None and all(dev in inventory for dev in devs):
+        return dict((dev, dict(tags)) for dev, tags in inventory.items()
+                    if not devs or dev in devs)
+
     cmd = ['blkid', '-o', 'full']
     if disable_cache:
         cmd.extend(['-c', '/dev/null'])
@@ -1693,6 +1888,26 @@ def mounts():
     return mounted
 
 
+def _extract_seed_image(device, target, mtypes):
+    """Copy the files of an ISO9660 or VFAT device into target.
+
+    Returns False if the device is of another type or unreadable, and needs
+    to be mounted instead.
+    """
+    fstypes = set()
+    for mtype in mtypes:
+        fstypes.update(MOUNT_IMAGE_TYPES.get(mtype, ()))
+    if not fstypes:
+        return False
+    try:
+        fstype = fs_image.extract_image(device, target, fstypes)
+    except fs_image.ImageError as e:
+        LOG.debug("Unable to read %s without mounting: %s", device, e)
+        return False
+    LOG.debug("Read %s filesystem on %s without mounting", fstype, device)
+    return True
+
+
 def mount_cb(device, callback, data=None, mtype=None,
              update_env_for_mount=None):
     """
@@ -1702,6 +1917,9 @@ def mount_cb(device, callback, data=None, mtype=None,
 
     mtype is a filesystem type.  it may be a list, string (a single fsname)
     or a list of fsnames.
+
+    ISO9660 and VFAT devices are read without mounting where possible, the
+    callback is then passed a directory holding a copy of their files.
     """
 
     if isinstance(mtype, str):
@@ -1735,6 +1953,8 @@ def mount_cb(device, callback, data=None, mtype=None,
         umount = False
         if os.path.realpath(device) in mounted:
             mountpoint = mounted[os.path.realpath(device)]['mountpoint']
+        elif _extract_seed_image(device, tmpd, mtypes):
+            mountpoint = tmpd
         else:
             failure_reason = None
             for mtype in mtypes:
@@ -1893,6 +2113,43 @@ def write_file(filename, content, mode=0o644, omode="wb", copy_mode=False):
     chmod(filename, mode)
 
 
+class _EncodingWriter(object):
+    """File-like wrapper encoding text written to it into a binary file."""
+
+    def __init__(self, fh, encoding='utf-8'):
+        self._fh = fh
+        self._encoding = encoding
+
+    def write(self, text):
+        self._fh.write(encode_text(text, self._encoding))
+
+
+def write_message(filename, msg, mode=0o644):
+    """
+    Writes a mime message to a file as str(msg) would render it.
+
+    The message is flattened straight into the file, so the rendered message
+    is never held in memory as a whole. Objects other than messages are
+    written as their str().
+
+    @param filename: The full path of the file to write.
+    @param msg: The email.message.Message to write.
+    @param mode: The filesystem mode to set on the file.
+    """
+    if not isinstance(msg, email.message.Message):
+        write_file(filename, str(msg), mode)
+        return
+    ensure_dir(os.path.dirname(filename))
+    LOG.debug("Writing to %s - wb: [%o] mime message", filename, mode)
+    with SeLinuxGuard(path=filename):
+        with open(filename, 'wb') as fh:
+            generator = email.generator.Generator(
+                _EncodingWriter(fh), mangle_from_=False, maxheaderlen=0)
+            generator.flatten(msg)
+            fh.flush()
+    chmod(filename, mode)
+
+
 def delete_dir_contents(dirname):
     """
     Deletes all contents of a directory without deleting the directory itself.
@@ -2142,11 +2399,74 @@ def strip_prefix_suffix(line, prefix=None, suffix=None):
     return line
 
 
+def cache_platform_facts(seed_file=None):
+    """Cache platform facts for the remainder of this process.
+
+    @param seed_file: Optional path to the ds-identify log. Facts reported
+        by the last ds-identify run logged there seed the cache.
+    """
+    global _PLATFORM_FACTS
+    if _PLATFORM_FACTS is not None:
+        return
+    _PLATFORM_FACTS = {}
+    if seed_file:
+        _PLATFORM_FACTS.update(_read_ds_identify_facts(seed_file))
+
+
+def clear_platform_facts():
+    """Drop cached platform facts and stop caching them."""
+    global _PLATFORM_FACTS
+    _PLATFORM_FACTS = None
+
+
+def _read_ds_identify_facts(log_file):
+    """Return platform facts reported in the ds-identify log_file."""
+    try:
+        content = load_file(log_file)
+    except (IOError, OSError):
+        return {}
+    reported = {}
+    for line in content.splitlines():
+        key, sep, value = line.partition('=')
+        if sep and (key in DS_IDENTIFY_DMI_KEYS or key == 'is_container'):
+            reported[key] = value
+    facts = {}
+    if reported.get('is_container') not in ('true', 'false'):
+        return facts
+    facts['container'] = reported['is_container'] == 'true'
+    if facts['container']:
+        # read_dmi_data does not report DMI data in containers
+        return facts
+    for key, dmi_key in DS_IDENTIFY_DMI_KEYS.items():
+        value = reported.get(key)
+        # Skip values ds-identify could not read or which were not printable
+        # as they are reported differently by read_dmi_data.
+        if (not value or value in ('unavailable', 'error') or
+                not re.match(r'^[\x20-\x7e]+$', value)):
+            continue
+        facts[('dmi', dmi_key)] = value
+    return facts
+
+
+def _platform_fact(fact, func, *args):
+    """Return fact from the platform facts cache, or the result of func."""
+    if _PLATFORM_FACTS is None:
+        return func(*args)
+    try:
+        return _PLATFORM_FACTS[fact]
+    except KeyError:
+        value = _PLATFORM_FACTS[fact] = func(*args)
+        return value
+
+
 def is_container():
     """
     Checks to see if this code running in a container of some sort
     """
+    return _platform_fact('container', _is_container)
+
 
+def _is_container():
     for helper in CONTAINER_TESTS:
         try:
             # try to run a helper program. if it returns true/zero
@@ -2192,6 +2512,15 @@ def is_lxd():
     return os.path.exists('/dev/lxd/sock')
 
 
+def uses_systemd():
+    """Return whether the system was booted with systemd."""
+    try:
+        res = os.lstat('/run/systemd/system')
+        return stat.S_ISDIR(res.st_mode)
+    except Exception:
+        return False
+
+
 def get_proc_env(pid, encoding='utf-8', errors='replace'):
     """
     Return the environment in a dict that a given process id was started with.
@@ -2705,6 +3034,15 @@ def is_x86(uname_arch=None):
 
 
 def read_dmi_data(key):
+    """
+    Wrapper for reading DMI data, see _read_dmi_data.
+
+    Values are remembered when platform facts are cached.
+    """
+    return _platform_fact(('dmi', key), _read_dmi_data, key)
+
+
+def _read_dmi_data(key):
     """
     Wrapper for reading DMI data.
 
@@ -2730,7 +3068,7 @@ def read_dmi_data(key):
         return syspath_value
 
     # running dmidecode can be problematic on some arches (LP: #1243287)
-    uname_arch = os.uname()[4]
+    uname_arch = _platform_fact('uname', os.uname)[4]
     if not (is_x86(uname_arch) or
             uname_arch == 'aarch64' or
             uname_arch == 'amd64'):
@@ -2746,10 +3084,15 @@ def read_dmi_data(key):
     return None
 
 
-def message_from_string(string):
+def message_from_string(string, chunk_size=MESSAGE_CHUNK_SIZE):
     if sys.version_info[:2] < (2, 7):
         return email.message_from_file(six.StringIO(string))
-    return email.message_from_string(string)
+    # email.message_from_string copies the whole string into a StringIO
+    # first, feeding the parser slices of it avoids that copy.
+    parser = email.feedparser.FeedParser()
+    for start in range(0, len(string), chunk_size):
+        parser.feed(string[start:start + chunk_size])
+    return parser.close()
 
 
 def get_installed_packages(target=None):
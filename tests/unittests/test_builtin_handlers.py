@@ -20,7 +20,7 @@ from cloudinit import util
 from cloudinit.handlers.cloud_config import CloudConfigPartHandler
 from cloudinit.handlers.jinja_template import (
     JinjaTemplatePartHandler, convert_jinja_instance_data,
-    render_jinja_payload)
+    convert_jinja_instance_data_index, render_jinja_payload)
 from cloudinit.handlers.shell_script import ShellScriptPartHandler
 from cloudinit.handlers.upstart_job import UpstartJobPartHandler
 
@@ -335,6 +335,21 @@ class TestConvertJinjaInstanceData(CiTestCase):
             expected_data,
             converted_data)
 
+    def test_convert_instance_data_index_matches_converted_data(self):
+        """Index varnames resolve as they do in converted instance-data."""
+        offsets = [
+            (('ds',), 0, 10), (('ds', 'meta-data'), 1, 9),
+            (('ds', 'meta-data', 'dotted.key'), 2, 3),
+            (('v1',), 10, 20), (('v1', 'key1'), 11, 12),
+            (('v1', 'key2'), 13, 14), (('v2',), 20, 30),
+            (('v2', 'key1'), 21, 22)]
+        self.assertEqual(
+            {'ds': [0, 10], 'ds.meta_data': [1, 9],
+             'v1': [10, 20], 'v1.key1': [11, 12], 'v1.key2': [13, 14],
+             'v2': [20, 30], 'v2.key1': [21, 22],
+             'key1': [21, 22], 'key2': [13, 14]},
+            convert_jinja_instance_data_index(offsets))
+
 
 class TestRenderJinjaPayload(CiTestCase):
 
@@ -1,11 +1,14 @@
 # This file is part of cloud-init. See LICENSE file for license information.
 
 from collections import namedtuple
+import json
 import os
 import six
+import sys
 
 from cloudinit.cmd import main as cli
 from cloudinit.tests import helpers as test_helpers
+from cloudinit import util
 from cloudinit.util import load_file, load_json
 
 
@@ -166,6 +169,38 @@ class TestCLI(test_helpers.FilesystemMockingTestCase):
         for error_message in expected_errors:
             self.assertIn(error_message, stdout.getvalue())
 
+    def _loaded_modules(self, *python_lines):
+        """Return the modules loaded by python_lines in a new interpreter."""
+        python_prog = '\n'.join(
+            ('import json, sys',) + python_lines +
+            ('print(json.dumps(sorted(sys.modules)))',))
+        with self.allow_subp([sys.executable]):
+            out, _err = util.subp([sys.executable, '-c', python_prog])
+        return set(json.loads(out.splitlines()[-1]))
+
+    def test_entry_point_import_does_not_load_boot_stages(self):
+        """Importing the cli entry point leaves boot stage modules unloaded."""
+        unexpected = [
+            'cloudinit.dhclient_hook', 'cloudinit.net', 'cloudinit.netinfo',
+            'cloudinit.reporting', 'cloudinit.sources', 'cloudinit.stages',
+            'cloudinit.url_helper', 'cloudinit.util', 'jinja2',
+            'pkg_resources', 'requests', 'yaml']
+        loaded = self._loaded_modules('import cloudinit.cmd.main')
+        self.assertEqual(set(), loaded.intersection(unexpected))
+
+    def test_status_subcommand_does_not_load_boot_stages(self):
+        """cloud-init status imports neither boot stages nor requests."""
+        unexpected = [
+            'cloudinit.distros', 'cloudinit.net', 'cloudinit.reporting',
+            'cloudinit.sources', 'cloudinit.stages', 'cloudinit.url_helper',
+            'jinja2', 'requests']
+        loaded = self._loaded_modules(
+            'from cloudinit.cmd import main, status',
+            'status.handle_status_args = lambda name, args: 0',
+            "main.main(['cloud-init', 'status'])")
+        self.assertIn('cloudinit.cmd.status', loaded)
+        self.assertEqual(set(), loaded.intersection(unexpected))
+
     def test_analyze_subcommand_parser(self):
         """The subcommand cloud-init analyze calls the correct subparser."""
         self._call_main(['cloud-init', 'analyze'])
@@ -246,7 +281,7 @@ class TestCLI(test_helpers.FilesystemMockingTestCase):
         self.assertEqual('cc_ntp', parseargs.name)
         self.assertFalse(parseargs.report)
 
-    @mock.patch('cloudinit.cmd.main.dhclient_hook.handle_args')
+    @mock.patch('cloudinit.dhclient_hook.handle_args')
     def test_dhclient_hook_subcommand(self, m_handle_args):
         """The subcommand 'dhclient-hook' calls dhclient_hook with args."""
         self._call_main(['cloud-init', 'dhclient-hook', 'up', 'eth0'])
@@ -259,6 +294,30 @@ class TestCLI(test_helpers.FilesystemMockingTestCase):
         self.assertEqual('up', parseargs.event)
         self.assertEqual('eth0', parseargs.interface)
 
+    @mock.patch('cloudinit.dhclient_hook.handle_args')
+    def test_dhclient_hook_subcommand_after_top_level_options(
+            self, m_handle_args):
+        """Subcommands are found after top level options and their values."""
+        cfg_file = self.tmp_path('extra.cfg')
+        util.write_file(cfg_file, '')
+        self._call_main(['cloud-init', '--debug', '-f', cfg_file,
+                         'dhclient-hook', 'up', 'eth0'])
+        (name, parseargs) = m_handle_args.call_args_list[0][0]
+        self.assertEqual('dhclient-hook', name)
+        self.assertTrue(parseargs.debug)
+        self.assertEqual('up', parseargs.event)
+        self.assertEqual('eth0', parseargs.interface)
+
+    def test_find_subcommand_skips_top_level_options(self):
+        """_find_subcommand returns the first non-option argument."""
+        self.assertEqual(
+            'status', cli._find_subcommand(['--debug', 'status', '--wait']))
+        self.assertEqual(
+            'query', cli._find_subcommand(['--file', 'query', 'query']))
+        self.assertEqual(
+            'clean', cli._find_subcommand(['--file=a.cfg', '-d', 'clean']))
+        self.assertIsNone(cli._find_subcommand(['--debug']))
+
     @mock.patch('cloudinit.cmd.main.main_features')
     def test_features_hook_subcommand(self, m_features):
         """The subcommand 'features' calls main_features with args."""
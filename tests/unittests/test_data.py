@@ -5,6 +5,8 @@
 import gzip
 import logging
 import os
+import pickle
+import threading
 
 try:
     from unittest import mock
@@ -20,12 +22,14 @@ from email.mime.multipart import MIMEMultipart
 
 import httpretty
 
+from cloudinit.cmd import devel
 from cloudinit import handlers
 from cloudinit import helpers as c_helpers
 from cloudinit import log
 from cloudinit.settings import (PER_INSTANCE)
 from cloudinit import sources
 from cloudinit import stages
+from cloudinit import url_helper
 from cloudinit import user_data as ud
 from cloudinit import safeyaml
 from cloudinit import util
@@ -645,6 +649,150 @@ class TestUDProcess(helpers.ResourceUsingTestCase):
         message = ud_proc.process(msg)
         self.assertTrue(count_messages(message) == 1)
 
+    def test_launch_index_from_base64_payload(self):
+        """A launch-index in a base64 encoded cloud-config is attached."""
+        message = MIMEMultipart()
+        part = MIMEBase('text', 'cloud-config')
+        part.set_payload(b'#cloud-config\nlaunch-index: 3\n')
+        encoders.encode_base64(part)
+        message.attach(part)
+        ud_proc = ud.UserDataProcessor(self.getCloudPaths())
+        parts = list(ud_proc.process(message.as_string()).walk())
+        self.assertEqual('3', parts[1]['Launch-Index'])
+
+    def test_no_launch_index_in_payload(self):
+        """Cloud-config without a launch-index gets no header."""
+        ud_proc = ud.UserDataProcessor(self.getCloudPaths())
+        message = ud_proc.process(b'#cloud-config\nruncmd: [ls]\n')
+        self.assertIsNone(list(message.walk())[1]['Launch-Index'])
+
+
+class TestUDProcessConcurrentIncludes(helpers.ResourceUsingTestCase):
+
+    def setUp(self):
+        super(TestUDProcessConcurrentIncludes, self).setUp()
+        self.contents = {}
+        self.fetched = []
+        self.fetch_lock = threading.Lock()
+        self.paths = self.getCloudPaths()
+        patcher = mock.patch.object(
+            ud, 'read_file_or_url', side_effect=self.read_file_or_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def read_file_or_url(self, url, **kwargs):
+        with self.fetch_lock:
+            self.fetched.append(url)
+        contents = self.contents[url]
+        if isinstance(contents, threading.Event):
+            # Blocks until another fetch sets it, so this proves concurrency
+            self.assertTrue(contents.wait(5), 'fetches were not concurrent')
+            contents = b'#cloud-config\nwaited: true\n'
+        elif isinstance(contents, Exception):
+            raise contents
+        return url_helper.StringResponse(contents)
+
+    def process(self, blob, max_workers=4):
+        ud_proc = ud.UserDataProcessor(self.paths, max_workers=max_workers)
+        message = ud_proc.process(blob)
+        return [part.get_payload(decode=True) for part in message.walk()
+                if not ud.is_skippable(part)]
+
+    def test_nested_includes_fetched_concurrently_in_order(self):
+        """Includes at all levels are fetched at once, parts keep order."""
+        event = threading.Event()
+        self.contents = {
+            'http://h/1': event,
+            'http://h/2': b'#include\nhttp://h/2a\nhttp://h/2b\n',
+            'http://h/2a': b'#cloud-config\nn: 2a\n',
+            'http://h/2b': b'#!/bin/sh\necho 2b\n',
+        }
+
+        def set_after_nested(url, **kwargs):
+            response = self.read_file_or_url(url, **kwargs)
+            if url == 'http://h/2b':
+                event.set()
+            return response
+
+        with mock.patch.object(
+                ud, 'read_file_or_url', side_effect=set_after_nested):
+            parts = self.process('#include\nhttp://h/1\nhttp://h/2\n')
+        self.assertEqual(
+            [b'#cloud-config\nwaited: true\n', b'#cloud-config\nn: 2a\n',
+             b'#!/bin/sh\necho 2b\n'], parts)
+
+    def test_parts_match_serial_processing(self):
+        """Concurrent fetches give the same message as serial ones."""
+        self.contents = {
+            'http://h/1': b'#cloud-config\nn: 1\n',
+            'http://h/2': url_helper.UrlError(
+                ValueError('boom'), url='http://h/2'),
+            'http://h/3': b'#include\nhttp://h/1\n',
+        }
+        blob = '#include\nhttp://h/1\nhttp://h/2\nhttp://h/3\n'
+        self.assertEqual(
+            self.process(blob, max_workers=1), self.process(blob))
+
+    def test_include_once_cache_is_used_and_written(self):
+        """include-once urls are read from and written to the url cache."""
+        self.contents = {'http://h/once': b'#cloud-config\nn: once\n'}
+        blob = '#include-once\nhttp://h/once\n'
+        self.assertEqual([b'#cloud-config\nn: once\n'], self.process(blob))
+        self.assertEqual(['http://h/once'], self.fetched)
+        self.contents = {}
+        self.assertEqual([b'#cloud-config\nn: once\n'], self.process(blob))
+        self.assertEqual(['http://h/once'], self.fetched)
+
+    def test_only_include_parts_are_decoded_ahead(self):
+        """Parts which are not includes are decoded only once."""
+        self.contents = {'http://h/1': b'#!/bin/sh\necho 1\n'}
+        message = MIMEMultipart()
+        for payload in (b'#cloud-config\nbig: ' + b'x' * 4096 + b'\n',
+                        b'#include\nhttp://h/1\n'):
+            part = MIMEBase('text', 'plain')
+            part.set_payload(payload)
+            encoders.encode_base64(part)
+            message.attach(part)
+        decoded = []
+        decode_part = ud.UserDataProcessor._decode_part
+
+        def counting_decode_part(ud_proc, part):
+            result = decode_part(ud_proc, part)
+            decoded.append(result[2])
+            return result
+
+        with mock.patch.object(ud.UserDataProcessor, '_decode_part',
+                               counting_decode_part):
+            parts = self.process(message.as_string())
+        self.assertEqual(
+            [b'#cloud-config\nbig: ' + b'x' * 4096 + b'\n',
+             b'#!/bin/sh\necho 1\n'], parts)
+        self.assertEqual(1, decoded.count('text/cloud-config'))
+        self.assertEqual(2, decoded.count('text/x-include-url'))
+        self.assertEqual(1, decoded.count('text/x-shellscript'))
+
+    def test_may_include_peeks_at_encoded_payloads(self):
+        """Include parts are found from the start of encoded payloads."""
+        for encoder in (encoders.encode_base64, encoders.encode_quopri,
+                        encoders.encode_7or8bit):
+            for (payload, expected) in ((b'#include\nhttp://h/1', True),
+                                        (b'#cloud-config\n', False)):
+                part = MIMEBase('text', 'plain')
+                part.set_payload(payload + b'\n' * 1024)
+                encoder(part)
+                self.assertEqual(expected, ud._may_include(part))
+
+    def test_processor_pickles(self):
+        """Processors can be pickled with their datasource."""
+        ud_proc = pickle.loads(pickle.dumps(
+            ud.UserDataProcessor(self.paths, max_workers=4)))
+        self.contents = {'http://h/1': b'#cloud-config\nn: 1\n'}
+        self.assertEqual(
+            [b'#cloud-config\nn: 1\n'],
+            [part.get_payload(decode=True) for part in ud_proc.process(
+                '#include http://h/1\n').walk()
+             if not ud.is_skippable(part)])
+
 
 class TestConvertString(helpers.TestCase):
 
@@ -671,6 +819,16 @@ class TestConvertString(helpers.TestCase):
         msg = ud.convert_string(str(message))
         self.assertEqual("Just text", msg.get_payload(decode=False))
 
+    def test_handle_mime_text_and_bytes_alike(self):
+        """Mime messages given as text or as bytes are parsed alike."""
+        message = MIMEMultipart()
+        message.attach(MIMEBase("text", "plain"))
+        message.get_payload()[0].set_payload(u"J\xfcst text")
+        text = message.as_string()
+        self.assertEqual(
+            ud.convert_string(text.encode('utf-8')).as_string(),
+            ud.convert_string(text).as_string())
+
 
 class TestFetchBaseConfig(helpers.TestCase):
     def test_only_builtin_gets_builtin(self):
@@ -743,4 +901,92 @@ class TestFetchBaseConfig(helpers.TestCase):
         self.assertEqual(ret, {'key1': 'cmdline1', 'key2': 'runtime2',
                                'key3': 'builtin3', 'keyconfd1': 'kconfd1'})
 
+
+class TestFetchBaseConfigSnapshot(helpers.CiTestCase):
+
+    def setUp(self):
+        super(TestFetchBaseConfigSnapshot, self).setUp()
+        tmp = self.tmp_dir()
+        self.cloud_cfg = os.path.join(tmp, 'cloud.cfg')
+        self.snapshot = os.path.join(tmp, 'run', 'base-cfg.json')
+        util.write_file(self.cloud_cfg, 'key1: cloud\n')
+        util.write_file(
+            os.path.join(tmp, 'cloud.cfg.d', '10_a.cfg'), 'key2: confd\n')
+        for (attr, value) in (
+                ('CLOUD_CONFIG', self.cloud_cfg),
+                ('RUN_CLOUD_CONFIG', os.path.join(tmp, 'run', 'cloud.cfg'))):
+            for module in (stages, c_helpers):
+                patcher = mock.patch.object(module, attr, value)
+                patcher.start()
+                self.addCleanup(patcher.stop)
+        self.cmdline = 'root=/dev/sda1'
+        patcher = mock.patch.object(
+            util, 'get_cmdline', side_effect=lambda: self.cmdline)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self, parsed=True):
+        """Return fetch_base_config output and whether files were parsed."""
+        with mock.patch.object(
+                util, 'read_conf_with_confd',
+                side_effect=util.read_conf_with_confd) as m_read:
+            cfg = stages.fetch_base_config(self.snapshot)
+        self.assertEqual(parsed, m_read.called)
+        return cfg
+
+    def test_snapshot_is_written_and_reused(self):
+        """A valid snapshot is returned without parsing config files."""
+        cfg = self.fetch(parsed=True)
+        self.assertEqual('cloud', cfg['key1'])
+        self.assertEqual('confd', cfg['key2'])
+        self.assertTrue(os.path.exists(self.snapshot))
+        self.assertEqual(cfg, self.fetch(parsed=False))
+        self.assertEqual(cfg, stages.fetch_base_config())
+
+    def test_changed_inputs_invalidate_snapshot(self):
+        """Changed, added or removed config files and cmdline invalidate."""
+        self.fetch(parsed=True)
+        util.write_file(self.cloud_cfg, 'key1: changed\n')
+        self.assertEqual('changed', self.fetch(parsed=True)['key1'])
+        util.write_file(self.cloud_cfg + '.d/20_b.cfg', 'key2: new\n')
+        self.assertEqual('new', self.fetch(parsed=True)['key2'])
+        os.unlink(self.cloud_cfg + '.d/20_b.cfg')
+        self.assertEqual('confd', self.fetch(parsed=True)['key2'])
+        self.cmdline = 'root=/dev/sda1 cc: key3: cmdline end_cc'
+        self.assertEqual('cmdline', self.fetch(parsed=True)['key3'])
+        self.fetch(parsed=False)
+
+    def test_read_base_config_snapshot_only_returns_valid(self):
+        """Snapshots are read without the boot stages while valid."""
+        self.assertIsNone(c_helpers.read_base_config_snapshot(self.snapshot))
+        cfg = self.fetch(parsed=True)
+        self.assertEqual(
+            cfg, c_helpers.read_base_config_snapshot(self.snapshot))
+        util.write_file(self.cloud_cfg, 'key1: changed\n')
+        self.assertIsNone(c_helpers.read_base_config_snapshot(self.snapshot))
+
+    def test_read_cfg_paths_uses_valid_snapshot(self):
+        """The cli reads paths from a valid snapshot without stages.Init."""
+        util.write_file(
+            self.cloud_cfg, 'system_info: {paths: {run_dir: /my/run}}\n')
+        self.fetch(parsed=True)
+        with mock.patch('cloudinit.cmd.devel.BASE_CFG_SNAPSHOT',
+                        self.snapshot):
+            with mock.patch('cloudinit.stages.Init') as m_init:
+                paths = devel.read_cfg_paths()
+        self.assertEqual('/my/run', paths.run_dir)
+        self.assertEqual(0, m_init.call_count)
+
+    def test_corrupt_snapshot_is_rewritten(self):
+        """An unreadable snapshot is replaced."""
+        util.write_file(self.snapshot, '{"format": 1, "key"')
+        cfg = self.fetch(parsed=True)
+        self.assertEqual(cfg, self.fetch(parsed=False))
+
+    def test_config_not_representable_in_json_is_not_snapshotted(self):
+        """Config with non-string keys is returned but not snapshotted."""
+        util.write_file(self.cloud_cfg, '1: one\n')
+        self.assertEqual('one', self.fetch(parsed=True)[1])
+        self.assertFalse(os.path.exists(self.snapshot))
+
 # vi: ts=4 expandtab
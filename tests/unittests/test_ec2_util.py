@@ -176,4 +176,79 @@ class TestEc2Util(helpers.HttprettyTestCase):
         self.assertEqual(iam['info']['LastUpdated'], '2016-10-27T17:29:39Z')
         self.assertNotIn('security-credentials', iam)
 
+    def _register_crawl_tree(self):
+        base_url = 'http://169.254.169.254/%s/meta-data/' % (self.VERSION)
+        tree = {
+            '': "\n".join(['hostname', 'instance-id', 'public-keys/',
+                           'block-device-mapping/', 'iam/']),
+            'hostname': 'ec2.fake.host.name.com',
+            'instance-id': '123',
+            'public-keys/': "\n".join(['0=my-public-key', '1=my-other-key']),
+            'public-keys/0/openssh-key': 'ssh-rsa AAAA.....wZEf my-public-key',
+            'public-keys/1/openssh-key': 'ssh-rsa AAAA.....wZEf my-other-key',
+            'block-device-mapping/': "\n".join(['ami', 'ephemeral0']),
+            'block-device-mapping/ami': 'sdb',
+            'block-device-mapping/ephemeral0': 'sdc',
+            'iam/': "\n".join(['info', 'security-credentials/']),
+            'iam/info': '{"Code": "Success"}',
+        }
+        for path, body in tree.items():
+            hp.register_uri(hp.GET, uh.combine_url(base_url, path),
+                            status=200, body=body)
+
+    def test_metadata_concurrent_crawl_matches_serial_crawl(self):
+        """Crawling with max_workers > 1 returns the serial crawl result."""
+        self._register_crawl_tree()
+        serial_md = eu.get_instance_metadata(
+            self.VERSION, retries=0, timeout=0.1)
+        concurrent_md = eu.get_instance_metadata(
+            self.VERSION, retries=0, timeout=0.1, max_workers=4)
+        self.assertEqual(serial_md, concurrent_md)
+        self.assertEqual(
+            {'ami': 'sdb', 'ephemeral0': 'sdc'},
+            concurrent_md['block-device-mapping'])
+        self.assertEqual(2, len(concurrent_md['public-keys']))
+        self.assertEqual({'info': {'Code': 'Success'}}, concurrent_md['iam'])
+
+    def test_metadata_concurrent_crawl_failure_returns_empty(self):
+        """A failed read during a concurrent crawl returns empty metadata."""
+        base_url = 'http://169.254.169.254/%s/meta-data/' % (self.VERSION)
+        hp.register_uri(hp.GET, base_url, status=200,
+                        body="\n".join(['hostname', 'instance-id']))
+        hp.register_uri(hp.GET, uh.combine_url(base_url, 'hostname'),
+                        status=200, body='ec2.fake.host.name.com')
+        hp.register_uri(hp.GET, uh.combine_url(base_url, 'instance-id'),
+                        status=500)
+        md = eu.get_instance_metadata(
+            self.VERSION, retries=0, timeout=0.1, max_workers=4)
+        self.assertEqual({}, md)
+
+
+class TestMetadataMaterializer(helpers.CiTestCase):
+
+    with_logs = True
+
+    def _caller(self, tree):
+        def caller(url):
+            return tree[url]
+        return caller
+
+    def test_duplicate_keys_warn_with_workers(self):
+        """Duplicate leaf and child names warn, preferring the child."""
+        base_url = 'http://md/'
+        tree = {
+            'http://md/dup/': 'leaf',
+            'http://md/dup/leaf': 'child-value',
+            'http://md/dup': 'leaf-value',
+        }
+        for max_workers in (None, 3):
+            materializer = eu.MetadataMaterializer(
+                "dup/\ndup", base_url, self._caller(tree),
+                max_workers=max_workers)
+            self.assertEqual(
+                {'dup': {'leaf': 'child-value'}}, materializer.materialize())
+        self.assertEqual(
+            2, self.logs.getvalue().count(
+                'Duplicate key found in results from http://md/'))
+
 # vi: ts=4 expandtab
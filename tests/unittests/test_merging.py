@@ -6,6 +6,7 @@ from cloudinit.handlers import cloud_config
 from cloudinit.handlers import (CONTENT_START, CONTENT_END)
 
 from cloudinit import helpers as c_helpers
+from cloudinit import mergers
 from cloudinit import util
 
 import collections
@@ -15,6 +16,7 @@ import random
 import re
 import six
 import string
+import sys
 
 SOURCE_PAT = "source*.*yaml"
 EXPECTED_PAT = "expected%s.yaml"
@@ -258,4 +260,48 @@ class TestSimpleRun(helpers.ResourceUsingTestCase):
         d = util.mergemanydict([a, b])
         self.assertEqual(c, d)
 
+
+class TestMergers(helpers.TestCase):
+
+    def test_constructed_mergers_are_reused(self):
+        """Mergers for the same merge types are only constructed once."""
+        merger = mergers.construct(
+            mergers.string_extract_mergers('list(append)+dict()+str()'))
+        self.assertIs(merger, mergers.construct(
+            mergers.string_extract_mergers(' list(append)+dict()+str()')))
+        self.assertIsNot(merger, mergers.construct(
+            mergers.string_extract_mergers('list()+dict()+str()')))
+
+    def test_parsed_mergers_are_private_copies(self):
+        """Changing parsed mergers does not change later results."""
+        parsed = mergers.string_extract_mergers('list(append)+dict()')
+        parsed[0][1].append('prepend')
+        parsed.append(('str', []))
+        self.assertEqual(
+            [('list', ['append']), ('dict', [])],
+            mergers.string_extract_mergers('list(append)+dict()'))
+
+    def test_deeply_nested_merge_does_not_recurse(self):
+        """Config nested deeper than the recursion limit merges."""
+        depth = sys.getrecursionlimit() * 2
+        (a, b) = ({}, {})
+        (a_leaf, b_leaf) = (a, b)
+        for _ in range(depth):
+            a_leaf['k'] = {'a': 1}
+            b_leaf['k'] = {'b': [2]}
+            (a_leaf, b_leaf) = (a_leaf['k'], b_leaf['k'])
+        merged = util.mergemanydict([a, b])
+        for _ in range(depth):
+            merged = merged['k']
+            self.assertEqual(1, merged['a'])
+            self.assertEqual([2], merged['b'])
+
+    def test_tuples_merge_nested_values(self):
+        """Tuples are merged like lists, nested values included."""
+        merger = mergers.construct(
+            mergers.string_extract_mergers('list(recurse_dict)+dict()'))
+        self.assertEqual(
+            ({'a': 1, 'b': 2}, 3),
+            merger.merge(({'a': 1}, 3), [{'b': 2}]))
+
 # vi: ts=4 expandtab
@@ -2,13 +2,20 @@
 #
 # This file is part of cloud-init. See LICENSE file for license information.
 
+import copy
+import json
+import os
+import time
+
+from cloudinit.analyze import dump
 from cloudinit import reporting
 from cloudinit.reporting import events
 from cloudinit.reporting import handlers
+from cloudinit import util
 
 import mock
 
-from cloudinit.tests.helpers import TestCase
+from cloudinit.tests.helpers import CiTestCase, LocalHTTPServer, TestCase
 
 
 def _fake_registry():
@@ -155,6 +162,213 @@ class TestLogHandler(TestCase):
                       getLogger.return_value.log.call_args[0][1])
 
 
+class TestWebHookHandler(CiTestCase):
+
+    with_logs = True
+
+    def _events(self, count):
+        return [events.ReportingEvent(
+            events.START_EVENT_TYPE, 'init/event%d' % idx, 'description')
+            for idx in range(count)]
+
+    def _posted(self, server):
+        return [json.loads(body.decode('utf-8'))
+                for (_method, _path, body) in server.requests]
+
+    def test_posts_each_event_on_publish(self):
+        """Without batch_events, each event is posted as it is published."""
+        (event1, event2) = self._events(2)
+        with LocalHTTPServer() as server:
+            handler = handlers.WebHookHandler(server.url)
+            handler.publish_event(event1)
+            handler.publish_event(event2)
+            self.assertEqual(
+                [event1.as_dict(), event2.as_dict()], self._posted(server))
+
+    def test_batch_events_publish_does_not_wait_on_endpoint(self):
+        """With batch_events, a slow endpoint does not delay publishing."""
+        reporting_events = self._events(3)
+        with LocalHTTPServer(responses=[(200, 0.5)]) as server:
+            handler = handlers.WebHookHandler(
+                server.url, batch_events=True, batch_interval=0)
+            start = time.time()
+            for event in reporting_events:
+                handler.publish_event(event)
+            self.assertLess(time.time() - start, 0.5)
+            handler.flush()
+            posted = [event for batch in self._posted(server)
+                      for event in batch]
+        self.assertEqual(
+            [event.as_dict() for event in reporting_events], posted)
+        self.assertEqual(3, handler.posted_events)
+
+    def test_batch_events_posts_full_batch_before_interval(self):
+        """A batch is posted as a json list once it holds batch_size events."""
+        reporting_events = self._events(2)
+        with LocalHTTPServer() as server:
+            handler = handlers.WebHookHandler(
+                server.url, batch_events=True, batch_interval=60,
+                batch_size=2)
+            for event in reporting_events:
+                handler.publish_event(event)
+            self.assertTrue(server.wait_for_requests(1))
+            self.assertEqual(
+                [[event.as_dict() for event in reporting_events]],
+                self._posted(server))
+
+    def test_batch_events_retries_failed_posts(self):
+        """Failed posts of a batch are retried."""
+        (event,) = self._events(1)
+        with LocalHTTPServer(responses=[(500, 0), (503, 0)]) as server:
+            handler = handlers.WebHookHandler(
+                server.url, batch_events=True, batch_interval=0, retries=2)
+            handler.RETRY_DELAY = 0
+            handler.publish_event(event)
+            handler.flush()
+            self.assertEqual(
+                [[event.as_dict()]] * 3, self._posted(server))
+        self.assertEqual(
+            (1, 0), (handler.posted_events, handler.failed_events))
+
+    def test_batch_events_counts_events_failing_all_retries(self):
+        """Events of a batch failing all retries are counted as failed."""
+        (event,) = self._events(1)
+        with LocalHTTPServer(responses=[(500, 0)] * 2) as server:
+            handler = handlers.WebHookHandler(
+                server.url, batch_events=True, batch_interval=0, retries=1)
+            handler.RETRY_DELAY = 0
+            handler.publish_event(event)
+            handler.flush()
+        self.assertEqual(
+            (0, 1), (handler.posted_events, handler.failed_events))
+        self.assertIn('failed posting 1 events', self.logs.getvalue())
+
+    def test_batch_events_drops_events_when_queue_full(self):
+        """Events published while the queue is full are dropped and counted."""
+        reporting_events = self._events(5)
+        with LocalHTTPServer() as server:
+            handler = handlers.WebHookHandler(
+                server.url, batch_events=True, batch_interval=60,
+                max_queue_size=2)
+            for event in reporting_events:
+                handler.publish_event(event)
+            handler.flush()
+            self.assertEqual(
+                [[event.as_dict() for event in reporting_events[:2]]],
+                self._posted(server))
+        self.assertEqual(3, handler.dropped_events)
+        self.assertIn('2 events posted, 0 failed, 3 dropped',
+                      self.logs.getvalue())
+
+    def test_batch_events_flush_gives_up_at_flush_timeout(self):
+        """flush returns once flush_timeout passed, even if not all posted."""
+        (event,) = self._events(1)
+        with LocalHTTPServer(responses=[(200, 0.5)]) as server:
+            handler = handlers.WebHookHandler(
+                server.url, batch_events=True, batch_interval=0,
+                flush_timeout=0.1)
+            handler.publish_event(event)
+            start = time.time()
+            handler.flush()
+            self.assertLess(time.time() - start, 1)
+            self.assertIn('1 events not posted', self.logs.getvalue())
+            # Posting goes on in the background
+            handler.flush_timeout = 10
+            handler.flush()
+        self.assertEqual(1, handler.posted_events)
+
+    def test_flush_events_flushes_batched_webhook(self):
+        """reporting.flush_events posts the events queued by a webhook."""
+        (event,) = self._events(1)
+        with LocalHTTPServer() as server:
+            handler = handlers.WebHookHandler(
+                server.url, batch_events=True, batch_interval=60)
+            with mock.patch.object(
+                    reporting, 'instantiated_handler_registry',
+                    mock.Mock(registered_items={'webhook': handler})):
+                handler.publish_event(event)
+                reporting.flush_events()
+            self.assertEqual([[event.as_dict()]], self._posted(server))
+
+    def test_close_posts_queued_events_and_stops_thread(self):
+        """close posts queued events, then the publish thread exits."""
+        (event1, event2) = self._events(2)
+        with LocalHTTPServer() as server:
+            handler = handlers.WebHookHandler(
+                server.url, batch_events=True, batch_interval=60)
+            handler.publish_event(event1)
+            handler.close()
+            handler.publish_thread.join(5)
+            self.assertFalse(handler.publish_thread.is_alive())
+            self.assertEqual([[event1.as_dict()]], self._posted(server))
+            handler.publish_event(event2)
+        self.assertEqual(1, handler.dropped_events)
+        self.assertIn('closed, dropping event', self.logs.getvalue())
+
+
+class TestTraceHandler(CiTestCase):
+
+    def setUp(self):
+        super(TestTraceHandler, self).setUp()
+        self.trace_file = self.tmp_path('trace.json')
+
+    def _report_stacks(self, handler):
+        registry = mock.Mock(registered_items={'trace': handler})
+        with mock.patch.object(
+                events, 'instantiated_handler_registry', registry):
+            with events.ReportEventStack('init-local', 'top desc') as top:
+                with events.ReportEventStack('search', 'child desc',
+                                             parent=top) as child:
+                    child.result = events.status.WARN
+
+    def test_writes_complete_events_of_event_stacks(self):
+        """Each finished stack is appended as a complete trace event."""
+        handler = handlers.TraceHandler(trace_file=self.trace_file)
+        self._report_stacks(handler)
+        content = util.load_file(self.trace_file)
+        self.assertTrue(content.startswith('[\n'))
+        trace = dump.load_trace(content)
+        (process, child, top) = trace
+        self.assertEqual(
+            ('process_name', 'M', {'name': 'cloud-init init-local'}),
+            (process['name'], process['ph'], process['args']))
+        self.assertEqual(
+            ('init-local/search', 'X', 'cloudinit'),
+            (child['name'], child['ph'], child['cat']))
+        self.assertEqual(
+            {'description': 'child desc', 'result': 'WARN',
+             'stage': 'init-local', 'parent': 'init-local',
+             'boot_id': handler.boot_id},
+            dict((key, child['args'][key]) for key in (
+                'description', 'result', 'stage', 'parent', 'boot_id')))
+        self.assertIsNone(top['args']['parent'])
+        self.assertEqual(os.getpid(), top['pid'])
+        self.assertLessEqual(top['ts'], child['ts'])
+        self.assertLessEqual(
+            child['ts'] + child['dur'], top['ts'] + top['dur'])
+        self.assertGreaterEqual(top['args']['cpu_time'], 0)
+
+    def test_appends_to_existing_trace(self):
+        """Handlers of later stages append to the same trace array."""
+        self._report_stacks(handlers.TraceHandler(trace_file=self.trace_file))
+        self._report_stacks(handlers.TraceHandler(trace_file=self.trace_file))
+        content = util.load_file(self.trace_file)
+        self.assertEqual(1, content.count('['))
+        self.assertEqual(
+            ['init-local/search', 'init-local'] * 2,
+            [event['name'] for event in dump.load_trace(content)
+             if event['ph'] == 'X'])
+
+    def test_ignores_events_without_span(self):
+        """Start events and finish events outside of stacks are not traced."""
+        handler = handlers.TraceHandler(trace_file=self.trace_file)
+        handler.publish_event(events.ReportingEvent(
+            events.START_EVENT_TYPE, 'name', 'description'))
+        handler.publish_event(
+            events.FinishReportingEvent('name', 'description'))
+        self.assertFalse(os.path.exists(self.trace_file))
+
+
 class TestDefaultRegisteredHandler(TestCase):
 
     def test_log_handler_registered_by_default(self):
@@ -238,6 +452,43 @@ class TestReportingConfiguration(TestCase):
         self.assertEqual(
             0, len(reporting.instantiated_handler_registry.registered_items))
 
+    @mock.patch.object(
+        reporting, 'instantiated_handler_registry', reporting.DictRegistry())
+    @mock.patch.object(reporting, 'available_handlers')
+    def test_unchanged_handler_config_keeps_handler(self, available_handlers):
+        handler_cls = mock.Mock(side_effect=lambda **kwargs: mock.Mock())
+        available_handlers.registered_items = {'test_handler': handler_cls}
+        config = {'my_test_handler': {'type': 'test_handler', 'foo': 'bar'}}
+        reporting.update_configuration(config)
+        handler = reporting.instantiated_handler_registry.registered_items[
+            'my_test_handler']
+        reporting.update_configuration(copy.deepcopy(config))
+        self.assertEqual(1, handler_cls.call_count)
+        self.assertIs(
+            handler, reporting.instantiated_handler_registry.registered_items[
+                'my_test_handler'])
+        self.assertEqual(0, handler.close.call_count)
+
+    @mock.patch.object(
+        reporting, 'instantiated_handler_registry', reporting.DictRegistry())
+    @mock.patch.object(reporting, 'available_handlers')
+    def test_replaced_and_removed_handlers_are_closed(
+            self, available_handlers):
+        handler_cls = mock.Mock(side_effect=lambda **kwargs: mock.Mock())
+        available_handlers.registered_items = {'test_handler': handler_cls}
+        reporting.update_configuration(
+            {'my_test_handler': {'type': 'test_handler', 'foo': 'bar'}})
+        first = reporting.instantiated_handler_registry.registered_items[
+            'my_test_handler']
+        reporting.update_configuration(
+            {'my_test_handler': {'type': 'test_handler', 'foo': 'baz'}})
+        second = reporting.instantiated_handler_registry.registered_items[
+            'my_test_handler']
+        self.assertIsNot(first, second)
+        first.close.assert_called_once_with()
+        reporting.update_configuration({'my_test_handler': None})
+        second.close.assert_called_once_with()
+
 
 class TestReportingEventStack(TestCase):
     @mock.patch('cloudinit.reporting.events.report_finish_event')
@@ -249,7 +500,7 @@ class TestReportingEventStack(TestCase):
             [mock.call('myname', 'mydesc')], report_start.call_args_list)
         self.assertEqual(
             [mock.call('myname', 'mydesc', events.status.SUCCESS,
-                       post_files=[])],
+                       post_files=[], span=mock.ANY)],
             report_finish.call_args_list)
 
     @mock.patch('cloudinit.reporting.events.report_finish_event')
@@ -264,7 +515,8 @@ class TestReportingEventStack(TestCase):
             pass
         self.assertEqual([mock.call(name, desc)], report_start.call_args_list)
         self.assertEqual(
-            [mock.call(name, desc, events.status.FAIL, post_files=[])],
+            [mock.call(name, desc, events.status.FAIL, post_files=[],
+                       span=mock.ANY)],
             report_finish.call_args_list)
 
     @mock.patch('cloudinit.reporting.events.report_finish_event')
@@ -280,7 +532,8 @@ class TestReportingEventStack(TestCase):
             pass
         self.assertEqual([mock.call(name, desc)], report_start.call_args_list)
         self.assertEqual(
-            [mock.call(name, desc, events.status.WARN, post_files=[])],
+            [mock.call(name, desc, events.status.WARN, post_files=[],
+                       span=mock.ANY)],
             report_finish.call_args_list)
 
     @mock.patch('cloudinit.reporting.events.report_start_event')
@@ -309,7 +562,8 @@ class TestReportingEventStack(TestCase):
                 child.result = events.status.WARN
 
         report_finish.assert_called_with(
-            "topname", "topdesc", events.status.WARN, post_files=[])
+            "topname", "topdesc", events.status.WARN, post_files=[],
+            span=mock.ANY)
 
     @mock.patch('cloudinit.reporting.events.report_finish_event')
     def test_message_used_in_finish(self, report_finish):
@@ -318,7 +572,7 @@ class TestReportingEventStack(TestCase):
             pass
         self.assertEqual(
             [mock.call("myname", "mymessage", events.status.SUCCESS,
-                       post_files=[])],
+                       post_files=[], span=mock.ANY)],
             report_finish.call_args_list)
 
     @mock.patch('cloudinit.reporting.events.report_finish_event')
@@ -327,7 +581,7 @@ class TestReportingEventStack(TestCase):
             c.message = "all good"
         self.assertEqual(
             [mock.call("myname", "all good", events.status.SUCCESS,
-                       post_files=[])],
+                       post_files=[], span=mock.ANY)],
             report_finish.call_args_list)
 
     @mock.patch('cloudinit.reporting.events.report_start_event')
@@ -1,7 +1,8 @@
 # This file is part of cloud-init. See LICENSE file for license information.
 
 from cloudinit.reporting import events
-from cloudinit.reporting.handlers import HyperVKvpReportingHandler
+from cloudinit.reporting.handlers import (
+    HyperVKvpPool, HyperVKvpReportingHandler, ReportException)
 
 import json
 import os
@@ -26,6 +27,8 @@ class TestKvpEncoding(CiTestCase):
 
 
 class TextKvpReporter(CiTestCase):
+    with_logs = True
+
     def setUp(self):
         super(TextKvpReporter, self).setUp()
         self.tmp_file_path = self.tmp_path('kvp_pool_file')
@@ -209,3 +212,140 @@ class TextKvpReporter(CiTestCase):
         self.assertEqual(2, len(kvps))
         self.assertNotEqual(kvps[0]["key"], kvps[1]["key"],
                             "duplicate keys for KVP entries")
+
+    def test_aggregate_events_coalesces_events_per_stage(self):
+        """Events of a stage published together share a single record."""
+        reporter = HyperVKvpReportingHandler(
+            kvp_file_path=self.tmp_file_path, aggregate_events=True)
+        reporter._append_kvp_item(reporter._encode_events(
+            [events.ReportingEvent('start', name, 'desc ' + name)
+             for name in ('init-local', 'init-local/check-cache',
+                          'init-network/search-Azure', 'init-local')]))
+        kvps = list(reporter._iterate_kvps(0))
+        self.assertEqual(2, len(kvps))
+        key_prefix = '%s|batch|' % reporter.event_key_prefix
+        self.assertTrue(kvps[0]['key'].startswith(key_prefix + 'init-local|'))
+        self.assertTrue(
+            kvps[1]['key'].startswith(key_prefix + 'init-network|'))
+        self.assertEqual(
+            ['init-local', 'init-local/check-cache', 'init-local'],
+            [evt['name'] for evt in json.loads(kvps[0]['value'])])
+        self.assertEqual(
+            'desc init-network/search-Azure',
+            json.loads(kvps[1]['value'])[0]['msg'])
+
+    def test_aggregate_events_splits_full_records(self):
+        """Aggregated records never exceed the maximum kvp value size."""
+        reporter = HyperVKvpReportingHandler(
+            kvp_file_path=self.tmp_file_path, aggregate_events=True)
+        data = reporter._encode_events_aggregated(
+            [events.ReportingEvent('start', 'init-local', 'x' * 500)
+             for _ in range(10)])
+        self.assertEqual(1, len(data))
+        self.assertEqual(0, len(data[0]) % reporter.HV_KVP_RECORD_SIZE)
+        records = [
+            reporter._decode_kvp_item(
+                bytes(data[0][i:i + reporter.HV_KVP_RECORD_SIZE]))
+            for i in range(0, len(data[0]), reporter.HV_KVP_RECORD_SIZE)]
+        self.assertEqual(4, len(records))
+        self.assertEqual(
+            10, sum(len(json.loads(r['value'])) for r in records))
+
+    def test_aggregate_events_breaks_down_very_long_event(self):
+        """An event too long for a record is still broken into slices."""
+        reporter = HyperVKvpReportingHandler(
+            kvp_file_path=self.tmp_file_path, aggregate_events=True)
+        description = 'ab' * reporter.HV_KVP_EXCHANGE_MAX_VALUE_SIZE
+        reporter.publish_event(
+            events.FinishReportingEvent(
+                'event_name', description, result=events.status.FAIL))
+        reporter.q.join()
+        kvps = list(reporter._iterate_kvps(0))
+        self.assertEqual(3, len(kvps))
+        self.assertEqual(
+            description,
+            ''.join(json.loads(kvp['value'])['msg'] for kvp in kvps))
+
+    def test_max_pool_records_evicts_oldest_cloud_init_records(self):
+        """Only the oldest cloud-init records are evicted at the cap."""
+        reporter = HyperVKvpReportingHandler(
+            kvp_file_path=self.tmp_file_path, max_pool_records=3)
+        reporter._append_kvp_item(
+            [reporter._encode_kvp_item('CLOUD_INIT|1|old', 'old1'),
+             reporter._encode_kvp_item('other_key', 'other'),
+             reporter._encode_kvp_item('CLOUD_INIT|1|old', 'old2')])
+        reporter._append_kvp_item(
+            [reporter._encode_kvp_item('CLOUD_INIT|2|new', 'new1'),
+             reporter._encode_kvp_item('CLOUD_INIT|2|new', 'new2')])
+        self.assertEqual(
+            ['other', 'new1', 'new2'],
+            [kvp['value'] for kvp in reporter._iterate_kvps(0)])
+        self.assertIn(
+            'Evicting 2 cloud-init records from kvp pool file',
+            self.logs.getvalue())
+
+
+class TestKvpPool(CiTestCase):
+
+    def setUp(self):
+        super(TestKvpPool, self).setUp()
+        self.tmp_file_path = self.tmp_path('kvp_pool_file')
+        handler = HyperVKvpReportingHandler
+        records = [
+            ('CLOUD_INIT|10|start|init-local|1', 'a'),
+            ('other|key', 'other'),
+            ('CLOUD_INIT|20|start|init-local|2', 'b'),
+            ('CLOUD_INIT|bogus|start|init-local|3', 'bogus'),
+            ('CLOUD_INIT|10|finish|init-local|4', 'c')]
+        with open(self.tmp_file_path, 'wb') as f:
+            for key, value in records:
+                f.write(struct.pack("%ds%ds" % (
+                    handler.HV_KVP_EXCHANGE_MAX_KEY_SIZE,
+                    handler.HV_KVP_EXCHANGE_MAX_VALUE_SIZE),
+                    key.encode('utf-8'), value.encode('utf-8')))
+
+    def test_index_cloud_init_records_by_incarnation(self):
+        """Only cloud-init records with a valid incarnation are indexed."""
+        with HyperVKvpPool(self.tmp_file_path) as pool:
+            self.assertEqual(5, pool.record_count)
+            self.assertEqual({10: [0, 4], 20: [2]}, dict(pool.index))
+            self.assertEqual([10, 20], pool.incarnations())
+            self.assertEqual(
+                ['a', 'c'], [kvp['value'] for kvp in pool.records(10)])
+            self.assertEqual(
+                ['a', 'b', 'c'], [kvp['value'] for kvp in pool.records()])
+            self.assertEqual([], list(pool.records(30)))
+
+    def test_records_without_incarnation_end_are_skipped(self):
+        """Keys without a '|' after the incarnation are not indexed."""
+        with open(self.tmp_file_path, 'ab') as f:
+            f.write(b'CLOUD_INIT|30'.ljust(HyperVKvpPool.RECORD_SIZE))
+        with HyperVKvpPool(self.tmp_file_path) as pool:
+            self.assertEqual(6, pool.record_count)
+            self.assertEqual({10: [0, 4], 20: [2]}, dict(pool.index))
+
+    def test_empty_pool_file_has_no_records(self):
+        """An empty pool file is valid and has no records."""
+        util.write_file(self.tmp_file_path, '')
+        with HyperVKvpPool(self.tmp_file_path) as pool:
+            self.assertEqual(0, pool.record_count)
+            self.assertEqual([], list(pool.records()))
+
+    def test_prune_removes_records_of_incarnations(self):
+        """Pruning keeps other records in order and shrinks the file."""
+        with HyperVKvpPool(self.tmp_file_path, writable=True) as pool:
+            self.assertEqual(2, pool.prune([10]))
+            self.assertEqual([20], pool.incarnations())
+        reporter = HyperVKvpReportingHandler(kvp_file_path=self.tmp_file_path)
+        self.assertEqual(
+            ['other', 'b', 'bogus'],
+            [kvp['value'] for kvp in reporter._iterate_kvps(0)])
+        self.assertEqual(
+            3 * HyperVKvpPool.RECORD_SIZE,
+            os.path.getsize(self.tmp_file_path))
+
+    def test_prune_requires_writable_pool(self):
+        """Pruning a pool opened read-only raises an error."""
+        with HyperVKvpPool(self.tmp_file_path) as pool:
+            with self.assertRaises(ReportException):
+                pool.prune([10])
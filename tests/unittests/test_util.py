@@ -9,6 +9,11 @@ import shutil
 import stat
 import tempfile
 
+import email
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+import gzip
 import json
 import six
 import sys
@@ -27,6 +32,13 @@ BASH = util.which('bash')
 BOGUS_COMMAND = 'this-is-not-expected-to-be-a-program-name'
 
 
+def gzip_compress(data):
+    buf = six.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fh:
+        fh.write(data)
+    return buf.getvalue()
+
+
 class FakeSelinux(object):
 
     def __init__(self, match_what):
@@ -611,6 +623,73 @@ class TestReadDMIData(helpers.FilesystemMockingTestCase):
         self.assertIsNone(util.read_dmi_data("bogus"))
         self.assertIsNone(util.read_dmi_data("system-product-name"))
 
+    def test_cached_platform_facts_read_once(self):
+        """With platform facts cached, dmi data is read only once."""
+        key, val = ("system-product-name", "my_product")
+        self._create_sysfs_file('product_name', val)
+        util.cache_platform_facts()
+        self.assertEqual(val, util.read_dmi_data(key))
+        self._create_sysfs_file('product_name', 'changed')
+        self.assertEqual(val, util.read_dmi_data(key))
+        util.clear_platform_facts()
+        self.assertEqual('changed', util.read_dmi_data(key))
+
+
+class TestPlatformFacts(helpers.CiTestCase):
+
+    def setUp(self):
+        super(TestPlatformFacts, self).setUp()
+        self.addCleanup(util.clear_platform_facts)
+        self.di_log = self.tmp_path('ds-identify.log')
+
+    @mock.patch('cloudinit.util._is_container', return_value=False)
+    def test_is_container_detected_once_when_cached(self, m_is_container):
+        """is_container runs container detection once when cached."""
+        self.assertFalse(util.is_container())
+        self.assertFalse(util.is_container())
+        self.assertEqual(2, m_is_container.call_count)
+        util.cache_platform_facts()
+        self.assertFalse(util.is_container())
+        self.assertFalse(util.is_container())
+        self.assertEqual(3, m_is_container.call_count)
+
+    @mock.patch('cloudinit.util._read_dmi_data')
+    @mock.patch('cloudinit.util._is_container')
+    def test_seeded_from_last_ds_identify_run(self, m_is_container, m_dmi):
+        """Facts reported by the last ds-identify run seed the cache."""
+        util.write_file(self.di_log, '\n'.join([
+            'DMI_PRODUCT_NAME=old-product', 'is_container=true',
+            'DMI_PRODUCT_NAME=my-product', 'DMI_SYS_VENDOR=unavailable',
+            'DMI_PRODUCT_SERIAL=error', 'DMI_PRODUCT_UUID=',
+            'DMI_CHASSIS_ASSET_TAG=\x01\x02', 'is_container=false']))
+        util.cache_platform_facts(seed_file=self.di_log)
+        self.assertFalse(util.is_container())
+        self.assertEqual(
+            'my-product', util.read_dmi_data('system-product-name'))
+        self.assertEqual(0, m_is_container.call_count)
+        self.assertEqual(0, m_dmi.call_count)
+        for key in ('system-manufacturer', 'system-serial-number',
+                    'system-uuid', 'chassis-asset-tag'):
+            util.read_dmi_data(key)
+            m_dmi.assert_called_with(key)
+
+    @mock.patch('cloudinit.util._read_dmi_data')
+    def test_seeded_container_does_not_seed_dmi(self, m_dmi):
+        """DMI data reported by ds-identify in a container is not used."""
+        util.write_file(
+            self.di_log, 'DMI_PRODUCT_NAME=host-product\nis_container=true')
+        util.cache_platform_facts(seed_file=self.di_log)
+        self.assertTrue(util.is_container())
+        util.read_dmi_data('system-product-name')
+        m_dmi.assert_called_once_with('system-product-name')
+
+    @mock.patch('cloudinit.util._is_container', return_value=True)
+    def test_missing_seed_file_is_ignored(self, m_is_container):
+        """A missing ds-identify log leaves the cache to fill on demand."""
+        util.cache_platform_facts(seed_file=self.di_log)
+        self.assertTrue(util.is_container())
+        self.assertEqual(1, m_is_container.call_count)
+
 
 class TestGetConfigLogfiles(helpers.CiTestCase):
 
@@ -723,6 +802,110 @@ class TestMessageFromString(helpers.TestCase):
         roundtripped = util.message_from_string(u'\n').as_string()
         self.assertNotIn('\x00', roundtripped)
 
+    def test_parses_as_email_package(self):
+        """Messages larger than a chunk parse as email parses them."""
+        lines = ['Content-Type: multipart/mixed; boundary="XX"',
+                 'MIME-Version: 1.0', '', '--XX',
+                 'Content-Type: text/cloud-config', '',
+                 '#cloud-config', 'runcmd:']
+        lines.extend('- echo %d' % i for i in range(100))
+        lines.extend(['--XX--', ''])
+        blob = '\n'.join(lines)
+        msg = util.message_from_string(blob, chunk_size=7)
+        self.assertEqual(email.message_from_string(blob).as_string(),
+                         msg.as_string())
+        self.assertEqual(['multipart/mixed', 'text/cloud-config'],
+                         [part.get_content_type() for part in msg.walk()])
+
+
+class TestDecompGzip(helpers.CiTestCase):
+
+    blob = b'#cloud-config\n' + b'a' * 100000
+
+    def test_decompresses(self):
+        """Gzipped data is decompressed and decoded."""
+        self.assertEqual(
+            self.blob.decode(), util.decomp_gzip(gzip_compress(self.blob)))
+        self.assertEqual(
+            self.blob,
+            util.decomp_gzip(gzip_compress(self.blob), decode=False))
+
+    def test_concatenated_members_and_padding(self):
+        """Concatenated gzip members and trailing zeros are handled."""
+        data = gzip_compress(self.blob) + gzip_compress(b'b') + b'\x00' * 8
+        self.assertEqual(
+            self.blob + b'b', util.decomp_gzip(data, decode=False))
+
+    def test_not_gzipped_returned_when_quiet(self):
+        """Data not gzipped is returned as given when quiet."""
+        self.assertEqual(u'text', util.decomp_gzip(u'text'))
+        self.assertEqual(b'text', util.decomp_gzip(b'text', decode=False))
+
+    def test_empty_data_decompresses_to_empty(self):
+        """Empty data holds no gzip members and decompresses to nothing."""
+        self.assertEqual(u'', util.decomp_gzip(b'', quiet=False))
+        self.assertEqual(b'', util.decomp_gzip(b'', quiet=False, decode=False))
+        self.assertEqual(u'', util.decomp_gzip(b''))
+
+    def test_invalid_data_raises_when_not_quiet(self):
+        """Invalid, truncated or trailing garbage data raise errors."""
+        data = gzip_compress(self.blob)
+        for invalid in (b'text', data[:-10], data + b'garbage'):
+            with self.assertRaises(util.DecompressionError):
+                util.decomp_gzip(invalid, quiet=False)
+            self.assertEqual(invalid, util.decomp_gzip(invalid))
+
+
+class TestTransferDecodedPayload(helpers.CiTestCase):
+
+    def _part(self, payload, cte=None):
+        part = MIMEBase('text', 'cloud-config')
+        part.set_payload(payload)
+        if cte == 'base64':
+            encoders.encode_base64(part)
+        return part
+
+    def test_base64_payload(self):
+        """Base64 payloads decode as the email package decodes them."""
+        part = self._part(b'#cloud-config\n' + b'\xc3\xa9' * 1000, 'base64')
+        self.assertEqual(part.get_payload(decode=True),
+                         util.transfer_decoded_payload(part))
+        self.assertEqual(u'#cloud-config\n' + u'\xe9' * 1000,
+                         util.fully_decoded_payload(part))
+
+    def test_invalid_base64_payload(self):
+        """Base64 with broken padding falls back to the email package."""
+        part = self._part('I2Nsb3VkLWNvbmZpZwo')
+        part['Content-Transfer-Encoding'] = 'base64'
+        self.assertEqual(part.get_payload(decode=True),
+                         util.transfer_decoded_payload(part))
+
+    def test_payload_not_transfer_encoded(self):
+        """Payloads without a transfer encoding are returned as is."""
+        part = self._part('#cloud-config\n')
+        self.assertEqual(b'#cloud-config\n',
+                         util.transfer_decoded_payload(part))
+
+
+class TestWriteMessage(helpers.CiTestCase):
+
+    def test_written_as_str(self):
+        """The message is written as str() renders it, with the given mode."""
+        msg = MIMEMultipart()
+        part = MIMEBase('text', 'cloud-config')
+        part.set_payload(u'#cloud-config\nfoo: \xe9\nFrom here\n')
+        msg.attach(part)
+        path = self.tmp_path('userdata')
+        util.write_message(path, msg, 0o600)
+        self.assertEqual(str(msg), util.load_file(path))
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+
+    def test_non_message_written_as_str(self):
+        """Objects other than messages are written as their str()."""
+        path = self.tmp_path('userdata')
+        util.write_message(path, None)
+        self.assertEqual('None', util.load_file(path))
+
 
 class TestReadSeeded(helpers.TestCase):
     def setUp(self):